@@ -0,0 +1,456 @@
+# benchmarks/loadtest.py
+
+"""Load test the auth flows and report latency percentiles per endpoint.
+
+The app is served by a threaded server in a child process, against a fresh
+SQLite file or the database given with --database-uri, and sends its mail
+to a stub SMTP server. Virtual users, one thread each, register, confirm
+and log in once, then pick endpoints at random by the weights of --mix
+until --duration is over:
+
+    $ python benchmarks/loadtest.py --concurrency 8 --duration 30 \\
+        --output results/$(git rev-parse --short HEAD).json
+    $ python benchmarks/loadtest.py --compare results/baseline.json
+
+With --compare the run fails when an endpoint's p95 is more than
+--threshold slower than in the saved results.
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from timeit import default_timer as timer
+
+try:
+    # Python 3
+    from http.client import HTTPConnection
+    from urllib.parse import urlencode
+    import socketserver
+except ImportError:
+    # Python 2.7
+    from httplib import HTTPConnection
+    from urllib import urlencode
+    import SocketServer as socketserver
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('APP_MAIL_USERNAME', 'loadtest')
+os.environ.setdefault('APP_MAIL_PASSWORD', 'loadtest')
+
+from project.config import BaseConfig
+
+
+ENDPOINTS = ('register', 'confirm_email', 'login', 'profile', 'forgot')
+DEFAULT_MIX = 'login=40,profile=40,forgot=10,register=5,confirm_email=5'
+PASSWORD = 'load-test-password'
+
+
+###################
+#### stub smtp ####
+###################
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    # just enough SMTP for smtplib, messages are counted and dropped
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.reply('220 stub')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().upper()
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250-stub')
+                self.reply('250 AUTH PLAIN')
+            elif command.startswith('AUTH'):
+                self.reply('235 ok')
+            elif command == 'DATA':
+                self.reply('354 end with .')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                self.reply('250 queued')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class StubSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    messages = 0
+
+
+################
+#### server ####
+################
+
+def make_config(settings):
+    # a config class, so that it can be rebuilt in the server process
+    return type('LoadTestConfig', (BaseConfig,), settings)
+
+
+def serve(settings, ready):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from project import create_app, db
+    from project.email import send_queued_emails
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app = create_app(make_config(settings))
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietHandler)
+
+    def drain_outbox():
+        while True:
+            with app.app_context():
+                try:
+                    send_queued_emails()
+                finally:
+                    db.session.remove()
+            threading.Event().wait(0.5)
+
+    sender = threading.Thread(target=drain_outbox)
+    sender.daemon = True
+    sender.start()
+    ready.put(server.server_port)
+    server.serve_forever()
+
+
+################
+#### client ####
+################
+
+class VirtualUser(object):
+    """One visitor with its own cookies and account."""
+
+    def __init__(self, port, name, tokens):
+        self.port = port
+        self.name = name
+        self.tokens = tokens
+        self.cookies = {}
+        self.registered = 0
+        self.email = self.new_email()
+
+    def new_email(self):
+        self.registered += 1
+        return '%s-%d@loadtest.com' % (self.name, self.registered)
+
+    def request(self, method, path, form=None):
+        headers = {}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(
+                '%s=%s' % item for item in self.cookies.items())
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        connection = HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            for header, value in response.getheaders():
+                if header.lower() == 'set-cookie':
+                    name, _, value = value.split(';')[0].partition('=')
+                    self.cookies[name.strip()] = value
+            return response.status
+        finally:
+            connection.close()
+
+    def register(self, email=None):
+        self.cookies = {}
+        return self.request('POST', '/register', dict(
+            email=email or self.email, password=PASSWORD, confirm=PASSWORD))
+
+    def confirm_email(self, email=None):
+        return self.request(
+            'GET', '/confirm/' + self.tokens(email or self.email))
+
+    def login(self):
+        return self.request('POST', '/login', dict(
+            email=self.email, password=PASSWORD))
+
+    def profile(self):
+        return self.request('GET', '/profile')
+
+    def forgot(self):
+        return self.request('POST', '/forgot', dict(email=self.email))
+
+    def setup(self):
+        for status in (self.register(), self.confirm_email(), self.login()):
+            if status != 302:
+                raise RuntimeError('%s could not sign up (%d)'
+                                   % (self.email, status))
+
+    def run(self, endpoint):
+        """Make one request, returning its status and latency."""
+        if endpoint in ('register', 'confirm_email'):
+            # on a new account, then back to the confirmed one
+            email = self.new_email()
+            if endpoint == 'confirm_email':
+                self.register(email)
+            started = timer()
+            if endpoint == 'register':
+                status = self.register(email)
+            else:
+                status = self.confirm_email(email)
+            elapsed = timer() - started
+            self.cookies = {}
+            self.login()
+            return status, elapsed
+        started = timer()
+        status = getattr(self, endpoint)()
+        return status, timer() - started
+
+
+# a request worked when it answered with this status
+EXPECTED = {
+    'register': 302,
+    'confirm_email': 302,
+    'login': 302,
+    'profile': 200,
+    'forgot': 302,
+}
+
+
+def worker(user, mix, deadline, results, lock):
+    total = sum(weight for endpoint, weight in mix)
+    while timer() < deadline:
+        pick = random.uniform(0, total)
+        for endpoint, weight in mix:
+            pick -= weight
+            if pick <= 0:
+                break
+        try:
+            status, elapsed = user.run(endpoint)
+        except Exception:
+            status, elapsed = None, None
+        with lock:
+            if status == EXPECTED[endpoint]:
+                results[endpoint].append(elapsed)
+            else:
+                results['errors'][endpoint] = \
+                    results['errors'].get(endpoint, 0) + 1
+
+
+#################
+#### reports ####
+#################
+
+def percentile(values, percent):
+    # nearest rank
+    values = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[rank]
+
+
+def summarize(results, elapsed):
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        latencies = results[endpoint]
+        errors = results['errors'].get(endpoint, 0)
+        if not latencies and not errors:
+            continue
+        summary = {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / elapsed,
+        }
+        if latencies:
+            for percent in (50, 95, 99):
+                summary['p%d_ms' % percent] = \
+                    1000 * percentile(latencies, percent)
+            summary['mean_ms'] = 1000 * sum(latencies) / len(latencies)
+        endpoints[endpoint] = summary
+    return endpoints
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT
+        ).decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def print_report(report):
+    print('%-14s %8s %7s %9s %9s %9s %9s' % (
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    for endpoint in ENDPOINTS:
+        summary = report['endpoints'].get(endpoint)
+        if summary is None:
+            continue
+        print('%-14s %8d %7d %9.1f %9.1f %9.1f %9.1f' % (
+            endpoint, summary['requests'], summary['errors'],
+            summary['throughput'], summary.get('p50_ms', 0),
+            summary.get('p95_ms', 0), summary.get('p99_ms', 0)))
+    print('total: %.1f req/s over %.1f s, %d email(s) sent' % (
+        report['throughput'], report['elapsed'], report['emails_sent']))
+
+
+def compare(report, baseline, threshold):
+    """Return the endpoints whose p95 regressed by more than `threshold`."""
+    regressions = []
+    for endpoint, summary in sorted(report['endpoints'].items()):
+        before = baseline['endpoints'].get(endpoint, {}).get('p95_ms')
+        after = summary.get('p95_ms')
+        if before and after and after > before * (1 + threshold):
+            regressions.append((endpoint, before, after))
+    return regressions
+
+
+##############
+#### main ####
+##############
+
+def parse_mix(value):
+    mix = []
+    for part in value.split(','):
+        endpoint, _, weight = part.partition('=')
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError('unknown endpoint %r' % endpoint)
+        mix.append((endpoint, float(weight or 1)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.splitlines()[1:]))
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='virtual users, one thread each')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help='seconds to run after the users signed up')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help='endpoint weights, default %s' % DEFAULT_MIX)
+    parser.add_argument('--database-uri', default=None,
+                        help='defaults to a new SQLite file')
+    parser.add_argument('--bcrypt-rounds', type=int, default=None,
+                        help='defaults to BCRYPT_LOG_ROUNDS')
+    parser.add_argument('-o', '--output', default=None,
+                        help='save the results as JSON')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed p95 slowdown, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    smtp = StubSMTPServer(('127.0.0.1', 0), StubSMTPHandler)
+    smtp_thread = threading.Thread(target=smtp.serve_forever)
+    smtp_thread.daemon = True
+    smtp_thread.start()
+
+    settings = dict(
+        SQLALCHEMY_DATABASE_URI=args.database_uri or
+        'sqlite:///' + os.path.join(tmpdir, 'loadtest.sqlite'),
+        WTF_CSRF_ENABLED=False,
+        RATELIMIT_ENABLED=False,
+        MAIL_SERVER='127.0.0.1',
+        MAIL_PORT=smtp.server_address[1],
+        MAIL_USE_SSL=False,
+        MAIL_USE_TLS=False,
+    )
+    if args.bcrypt_rounds is not None:
+        settings['BCRYPT_LOG_ROUNDS'] = args.bcrypt_rounds
+
+    from project import create_app, db
+    from project.token import generate_confirmation_token
+
+    app = create_app(make_config(settings))
+    with app.app_context():
+        db.create_all()
+        db.session.remove()
+        db.engine.dispose()
+
+    def tokens(email):
+        with app.app_context():
+            return generate_confirmation_token(email)
+
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(settings, ready))
+    server.daemon = True
+    server.start()
+    try:
+        port = ready.get(timeout=60)
+        run = '%x' % random.getrandbits(32)
+        users = [VirtualUser(port, 'user%d-%s' % (i, run), tokens)
+                 for i in range(args.concurrency)]
+        results = dict((endpoint, []) for endpoint in ENDPOINTS)
+        results['errors'] = {}
+        lock = threading.Lock()
+
+        # sign everyone up first, then measure
+        for user in users:
+            user.setup()
+        started = timer()
+        deadline = started + args.duration
+        threads = [threading.Thread(
+            target=worker, args=(user, args.mix, deadline, results, lock))
+            for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = timer() - started
+        # give the outbox worker a moment to catch up
+        threading.Event().wait(1)
+    finally:
+        server.terminate()
+        smtp.shutdown()
+        shutil.rmtree(tmpdir)
+
+    endpoints = summarize(results, elapsed)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+        'bcrypt_rounds': app.config['BCRYPT_LOG_ROUNDS'],
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'mix': dict(args.mix),
+        'elapsed': elapsed,
+        'throughput': sum(e['requests'] for e in endpoints.values()) / elapsed,
+        'emails_sent': smtp.messages,
+        'endpoints': endpoints,
+    }
+    print_report(report)
+
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for endpoint, before, after in regressions:
+            print('REGRESSION %s: p95 %.1f ms -> %.1f ms' % (
+                endpoint, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
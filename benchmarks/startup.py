@@ -0,0 +1,90 @@
+# benchmarks/startup.py
+
+"""Measure how long a fresh worker takes to import, build the app and
+answer its first requests.
+
+Every run happens in a new interpreter, so nothing is shared with the
+previous one:
+
+    $ python benchmarks/startup.py --runs 10 --config project.config.DevelopmentConfig
+
+ProductionConfig works too once `project/config/production.cfg` exists.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+# runs inside the child interpreter and prints its timings as JSON
+CHILD = """
+import json, time
+start = time.time()
+import project
+imported = time.time()
+app = project.create_app(%(config)r)
+created = time.time()
+client = app.test_client()
+client.get(%(path)r)
+first = time.time()
+client.get(%(path)r)
+second = time.time()
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'first_request': first - created,
+    'second_request': second - first,
+}))
+"""
+
+STEPS = ('import', 'create_app', 'first_request', 'second_request')
+
+
+def run_once(config, path):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env.setdefault('APP_MAIL_USERNAME', 'benchmark')
+    env.setdefault('APP_MAIL_PASSWORD', 'benchmark')
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD % {'config': config, 'path': path}],
+        cwd=root, env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--config', default='project.config.TestingConfig')
+    parser.add_argument('--path', default='/login')
+    parser.add_argument('--json', action='store_true',
+                        help='print the raw results instead of a table')
+    args = parser.parse_args()
+
+    results = [run_once(args.config, args.path) for _ in range(args.runs)]
+
+    if args.json:
+        print(json.dumps({'config': args.config, 'runs': results}, indent=2))
+        return
+
+    print('%-16s %10s %10s %10s' % ('step', 'median ms', 'min ms', 'max ms'))
+    for step in STEPS + ('total',):
+        if step == 'total':
+            values = [sum(r[s] for s in STEPS) for r in results]
+        else:
+            values = [r[step] for r in results]
+        print('%-16s %10.1f %10.1f %10.1f' % (
+            step, 1000 * median(values), 1000 * min(values), 1000 * max(values)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# benchmarks/tokens.py
+
+"""Compare a serializer built per call with the cached token service.
+
+    $ python benchmarks/tokens.py --number 20000
+
+"""
+
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('APP_MAIL_USERNAME', 'benchmark')
+os.environ.setdefault('APP_MAIL_PASSWORD', 'benchmark')
+
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer
+
+from project import create_app
+from project.token import tokens
+
+
+def uncached_dumps(email):
+    # what project/token.py did before the token service
+    serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
+    return serializer.dumps(email, salt=current_app.config['SECURITY_PASSWORD_SALT'])
+
+
+def uncached_loads(token):
+    serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
+    try:
+        return serializer.loads(
+            token, salt=current_app.config['SECURITY_PASSWORD_SALT'],
+            max_age=3600)
+    except Exception:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--fallbacks', type=int, default=0,
+                        help='retired keys to configure')
+    args = parser.parse_args()
+
+    app = create_app('project.config.TestingConfig')
+    app.config['SECRET_KEY_FALLBACKS'] = [
+        'retired key %d' % i for i in range(args.fallbacks)]
+
+    with app.app_context():
+        token = uncached_dumps('test@user.com')
+        cases = [
+            ('dumps, per call', lambda: uncached_dumps('test@user.com')),
+            ('dumps, service', lambda: tokens.dumps('confirm', 'test@user.com')),
+            ('loads, per call', lambda: uncached_loads(token)),
+            ('loads, service', lambda: tokens.loads('confirm', token, 3600)),
+        ]
+        for name, func in cases:
+            seconds = min(timeit.repeat(func, number=args.number, repeat=3))
+            print('%-18s %8.2f us/call' % (name, 1e6 * seconds / args.number))
+
+
+if __name__ == '__main__':
+    main()
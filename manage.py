@@ -1,25 +1,44 @@
 # manage.py
 
 
+import io
 import os
+import sys
+import time
+import tempfile
 import unittest
-import coverage
 import datetime
+import subprocess
 
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-COV = coverage.coverage(
-        branch=True,
-        include='project/*',
-        omit=['*/__init__.py', '*/config/*']
-    )
-COV.start()
+# coverage is only started when `cov` has restarted the process with it
+COV = None
+if os.environ.get('APP_COVERAGE'):
+    import coverage
+    COV = coverage.coverage(
+            branch=True,
+            include='project/*',
+            omit=['*/__init__.py', '*/config/*']
+        )
+    COV.start()
 
-from project import app, db
+from project import create_app, db
 from project.models import User
+from project.bulk import import_users as _import_users, \
+    export_users as _export_users, seed_users as _seed_users, \
+    rebalance_users as _rebalance_users, shard_users as _shard_users, \
+    backfill_normalized_emails as _backfill_normalized_emails, \
+    parse_bool, parse_datetime, SEED_PASSWORDS
+from project.email import send_queued_emails
+from project.hashing import calibrate_rounds
+from project.password_reset import purge_expired_reset_tokens, \
+    invalidate_reset_tokens
+from project.prune import prune as _prune
+from project import bench as _bench
 
-app.config.from_object(os.environ['APP_SETTINGS'])
+app = create_app()
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -28,10 +47,52 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
-@manager.command
-def test():
+def _shard(modules, workers):
+    """Split test modules into `workers` groups of about the same size."""
+    shards = [[] for _ in range(workers)]
+    sizes = [0] * workers
+    for size, module in sorted(
+            ((os.path.getsize(os.path.join('tests', module)), module)
+             for module in modules), reverse=True):
+        smallest = sizes.index(min(sizes))
+        shards[smallest].append(module)
+        sizes[smallest] += size
+    return [shard for shard in shards if shard]
+
+
+def _run_workers(modules, workers):
+    # every worker is a `manage.py test` of its own, so it gets its own
+    # in-memory database
+    processes = []
+    for shard in _shard(modules, workers):
+        output = tempfile.TemporaryFile()
+        process = subprocess.Popen(
+            [sys.executable, sys.argv[0], 'test'] + shard,
+            stdout=output, stderr=subprocess.STDOUT)
+        processes.append((process, output))
+    failed = False
+    for process, output in processes:
+        failed = process.wait() != 0 or failed
+        output.seek(0)
+        sys.stdout.write(output.read().decode('utf-8', 'replace'))
+        output.close()
+    return 1 if failed else 0
+
+
+@manager.option('-w', '--workers', type=int, default=1,
+                help='Run the test modules in this many processes')
+@manager.option('modules', nargs='*',
+                help='Test modules to run, e.g. test_user.py (default: all)')
+def test(workers=1, modules=None):
     """Runs the unit tests without coverage."""
-    tests = unittest.TestLoader().discover('tests')
+    if not modules:
+        modules = sorted(name for name in os.listdir('tests')
+                         if name.startswith('test') and name.endswith('.py'))
+    if workers > 1:
+        return _run_workers(modules, workers)
+    loader = unittest.TestLoader()
+    tests = unittest.TestSuite(
+        loader.discover('tests', pattern=module) for module in modules)
     result = unittest.TextTestRunner(verbosity=2).run(tests)
     if result.wasSuccessful():
         return 0
@@ -42,6 +103,10 @@ def test():
 @manager.command
 def cov():
     """Runs the unit tests with coverage."""
+    if COV is None:
+        # restart, so that coverage sees the app being imported
+        os.environ['APP_COVERAGE'] = '1'
+        os.execvp(sys.executable, [sys.executable] + sys.argv)
     tests = unittest.TestLoader().discover('tests')
     unittest.TextTestRunner(verbosity=2).run(tests)
     COV.stop()
@@ -80,5 +145,237 @@ def create_admin():
     db.session.commit()
 
 
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=None, help='Emails sent per SMTP connection')
+@manager.option('--once', dest='once', action='store_true', default=False,
+                help='Send a single batch and exit')
+def send_emails(batch_size, once):
+    """Sends queued emails from the outbox."""
+    batch_size = batch_size or app.config['MAIL_OUTBOX_BATCH_SIZE']
+    while True:
+        sent = send_queued_emails(batch_size)
+        if sent:
+            print('Sent %d email(s).' % sent)
+        if once:
+            break
+        if sent < batch_size:
+            time.sleep(app.config['MAIL_OUTBOX_POLL_INTERVAL'])
+
+
+@manager.option('-t', '--target-ms', dest='target_ms', type=float,
+                default=250, help='Target time per hash in milliseconds')
+def calibrate_hash(target_ms):
+    """Suggests a BCRYPT_LOG_ROUNDS value for this host."""
+    timings = calibrate_rounds(target_ms)
+    for rounds, ms in timings:
+        print('cost %2d: %9.1f ms' % (rounds, ms))
+    within = [rounds for rounds, ms in timings if ms <= target_ms]
+    suggested = within[-1] if within else timings[0][0]
+    print('Suggested BCRYPT_LOG_ROUNDS for %g ms: %d (configured: %d)' % (
+        target_ms, suggested, app.config['BCRYPT_LOG_ROUNDS']))
+
+
+@manager.option('path', help='CSV or JSON lines file of users')
+@manager.option('-f', '--format', dest='fmt', choices=('csv', 'jsonl'),
+                default=None, help='Defaults to the file extension')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=1000, help='Users inserted per transaction')
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='Processes hashing passwords, defaults to the CPU count')
+@manager.option('--restart', dest='restart', action='store_true',
+                default=False, help='Ignore the checkpoint of a previous run')
+def import_users(path, fmt, batch_size, workers, restart):
+    """Imports users from a CSV or JSON lines file."""
+    started = time.time()
+
+    def progress(done, imported, skipped):
+        print('%d read, %d imported, %d skipped (%.0f users/s)' % (
+            done, imported, skipped, imported / (time.time() - started)))
+
+    imported, skipped = _import_users(
+        path, fmt=fmt, batch_size=batch_size, workers=workers,
+        resume=not restart, progress=progress)
+    print('Imported %d user(s), skipped %d.' % (imported, skipped))
+
+
+@manager.option('-o', '--output', dest='output', default=None,
+                help='File to write, defaults to stdout')
+@manager.option('-f', '--format', dest='fmt', choices=('csv', 'jsonl'),
+                default='csv')
+@manager.option('--confirmed', dest='confirmed', default=None,
+                help='Only (un)confirmed users: true or false')
+@manager.option('--admin', dest='admin', default=None,
+                help='Only (non-)admin users: true or false')
+@manager.option('--registered-after', dest='registered_after', default=None,
+                help='Only users registered on or after YYYY-MM-DD')
+@manager.option('--registered-before', dest='registered_before',
+                default=None, help='Only users registered before YYYY-MM-DD')
+@manager.option('--include-passwords', dest='include_passwords',
+                action='store_true', default=False,
+                help='Also export the password hashes')
+@manager.option('-p', '--page-size', dest='page_size', type=int,
+                default=1000, help='Users read per query')
+def export_users(output, fmt, confirmed, admin, registered_after,
+                 registered_before, include_passwords, page_size):
+    """Exports users as CSV or JSON lines."""
+    # UTF-8 text on both Python 2 and 3, stdout included
+    out = io.open(output or sys.stdout.fileno(), 'w', encoding='utf-8',
+                  newline='', closefd=bool(output))
+    try:
+        written = _export_users(
+            out, fmt=fmt, page_size=page_size,
+            confirmed=None if confirmed is None else parse_bool(confirmed),
+            admin=None if admin is None else parse_bool(admin),
+            registered_after=parse_datetime(registered_after),
+            registered_before=parse_datetime(registered_before),
+            include_passwords=include_passwords)
+    finally:
+        out.close()
+    sys.stderr.write('Exported %d user(s).\n' % written)
+
+
+@manager.option('-n', '--count', dest='count', type=int, required=True,
+                help='Number of users to create')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=10000, help='Users per insert')
+@manager.option('-c', '--commit-every', dest='commit_every', type=int,
+                default=100000, help='Users per transaction')
+@manager.option('--confirmed-ratio', dest='confirmed_ratio', type=float,
+                default=0.8, help='Share of confirmed users')
+@manager.option('--seed', dest='seed', type=int, default=None,
+                help='Random seed, for a repeatable data set')
+@manager.option('--start', dest='start', type=int, default=None,
+                help='Number emails after this one, defaults to the highest '
+                     'number seeded so far')
+def seed_users(count, batch_size, commit_every, confirmed_ratio, seed, start):
+    """Creates synthetic users for load and scale testing."""
+    started = time.time()
+
+    def progress(inserted):
+        print('%d inserted (%.0f users/s)' % (
+            inserted, inserted / (time.time() - started)))
+
+    inserted = _seed_users(
+        count, batch_size=batch_size, commit_every=commit_every,
+        confirmed_ratio=confirmed_ratio, seed=seed, start=start,
+        progress=progress)
+    print('Created %d user(s) in %.1fs; their passwords are %s.' % (
+        inserted, time.time() - started, ', '.join(SEED_PASSWORDS)))
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=1000, help='Users looked at per batch')
+def rebalance_users(batch_size):
+    """Moves users to their shard after SQLALCHEMY_USER_SHARDS changed."""
+    if not app.config['SQLALCHEMY_USER_SHARDS']:
+        print('SQLALCHEMY_USER_SHARDS is not set, there is nothing to move.')
+        return
+
+    def progress(seen, moved):
+        print('%d looked at, %d moved' % (seen, moved))
+
+    moved = _rebalance_users(batch_size, progress=progress)
+    print('Moved %d user(s).' % moved)
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=1000, help='Users updated per transaction')
+@manager.option('-s', '--sleep', dest='sleep', type=float, default=0.1,
+                help='Seconds to wait between batches')
+def backfill_normalized_emails(batch_size, sleep):
+    """Fills in users.normalized_email after migration 9e9c55aa23."""
+    def progress(updated):
+        print('%d updated' % updated)
+
+    updated = _backfill_normalized_emails(batch_size, sleep, progress=progress)
+    print('Updated %d user(s), now run `python manage.py db upgrade`.'
+          % updated)
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=1000, help='Users moved per batch')
+def shard_users(batch_size):
+    """Moves the users of an unsharded database onto the shards."""
+    if not app.config['SQLALCHEMY_USER_SHARDS']:
+        print('SQLALCHEMY_USER_SHARDS is not set, there is nowhere to move '
+              'the users to.')
+        return
+
+    def progress(moved):
+        print('%d moved' % moved)
+
+    moved = _shard_users(batch_size, progress=progress)
+    print('Moved %d user(s) to the shards; they have new ids and must log '
+          'in again.' % moved)
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=1000, help='Tokens deleted per transaction')
+@manager.option('-s', '--sleep', dest='sleep', type=float, default=0,
+                help='Seconds to wait between batches')
+@manager.option('--all', dest='everything', action='store_true',
+                default=False, help='Also invalidate unexpired tokens')
+def purge_reset_tokens(batch_size, sleep, everything):
+    """Deletes expired password reset tokens."""
+    if everything:
+        deleted = invalidate_reset_tokens()
+    else:
+        deleted = purge_expired_reset_tokens(batch_size, sleep)
+    print('Deleted %d reset token(s).' % deleted)
+
+
+@manager.option('-d', '--days', dest='days', type=int, default=None,
+                help='Delete users still unconfirmed after this many days')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=None, help='Rows deleted per transaction')
+@manager.option('-s', '--sleep', dest='sleep', type=float, default=None,
+                help='Seconds to wait between batches')
+def prune(days, batch_size, sleep):
+    """Deletes stale unconfirmed users, expired reset tokens and old emails."""
+    deleted = _prune(days, batch_size, sleep)
+    print('Deleted %(users)d user(s), %(password_reset_tokens)d reset '
+          'token(s) and %(email_outbox)d email(s).' % deleted)
+
+
+@manager.option('-b', '--baseline', dest='baseline',
+                default='benchmarks/baseline.json',
+                help='JSON results to compare with')
+@manager.option('--save', dest='save', action='store_true', default=False,
+                help='Write the results as the new baseline')
+@manager.option('-t', '--threshold', dest='threshold', type=float,
+                default=0.25, help='Allowed slowdown, 0.25 is 25%')
+@manager.option('-r', '--rounds', dest='rounds', default='4,8,10',
+                help='BCRYPT_LOG_ROUNDS to create users with')
+@manager.option('-n', '--repeat', dest='repeat', type=int, default=5,
+                help='Timed runs per benchmark')
+@manager.option('-k', '--only', dest='only', default=None,
+                help='Comma separated parts of the benchmarks to run')
+def bench(baseline, save, threshold, rounds, repeat, only):
+    """Runs the microbenchmarks and compares them with a baseline."""
+    def progress(name, stats):
+        print('%-30s %12.1f us  (min %.1f, stdev %.1f, %d calls)' % (
+            name, 1e6 * stats['median'], 1e6 * stats['min'],
+            1e6 * stats['stdev'], stats['calls']))
+
+    results = _bench.run(
+        rounds=[int(cost) for cost in rounds.split(',')],
+        only=only.split(',') if only else None,
+        repeat=repeat, progress=progress)
+
+    if save:
+        commit = os.popen('git rev-parse --short HEAD 2>/dev/null').read()
+        _bench.save(baseline, _bench.report(results, commit.strip() or None))
+        print('Saved the baseline to %s.' % baseline)
+        return 0
+    if not os.path.exists(baseline):
+        print('No baseline at %s, create one with --save.' % baseline)
+        return 0
+    regressions = _bench.compare(results, _bench.load(baseline), threshold)
+    for name, before, after in regressions:
+        print('REGRESSION %s: %.1f us -> %.1f us' % (
+            name, 1e6 * before, 1e6 * after))
+    return 1 if regressions else 0
+
+
 if __name__ == '__main__':
     manager.run()
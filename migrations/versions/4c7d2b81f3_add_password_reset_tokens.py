@@ -0,0 +1,43 @@
+"""add password_reset_tokens, drop users.password_reset_token
+
+Revision ID: 4c7d2b81f3
+Revises: a7d3e5c190
+Create Date: 2026-10-18 13:05:21.640311
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c7d2b81f3'
+down_revision = 'a7d3e5c190'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('password_reset_tokens',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('digest', sa.String(length=64), nullable=False),
+    sa.Column('created_on', sa.DateTime(), nullable=False),
+    sa.Column('expires_on', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_password_reset_tokens_user_id'), 'password_reset_tokens', ['user_id'], unique=False)
+    op.create_index(op.f('ix_password_reset_tokens_digest'), 'password_reset_tokens', ['digest'], unique=True)
+    op.create_index(op.f('ix_password_reset_tokens_expires_on'), 'password_reset_tokens', ['expires_on'], unique=False)
+
+    # outstanding links were signed for the old scheme and stop working
+    if op.get_bind().dialect.name != 'sqlite':
+        # SQLite cannot drop columns, the model no longer reads or writes it
+        op.drop_column('users', 'password_reset_token')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        op.add_column('users', sa.Column('password_reset_token', sa.String(), nullable=True))
+    op.drop_index(op.f('ix_password_reset_tokens_expires_on'), table_name='password_reset_tokens')
+    op.drop_index(op.f('ix_password_reset_tokens_digest'), table_name='password_reset_tokens')
+    op.drop_index(op.f('ix_password_reset_tokens_user_id'), table_name='password_reset_tokens')
+    op.drop_table('password_reset_tokens')
@@ -0,0 +1,37 @@
+"""widen users.id and password_reset_tokens.user_id to bigint
+
+Revision ID: 6b1e0f9a42
+Revises: 4c7d2b81f3
+Create Date: 2026-10-18 16:42:08.513274
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6b1e0f9a42'
+down_revision = '4c7d2b81f3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # sharded user ids take 63 bits; SQLite integers already do
+    if op.get_bind().dialect.name == 'sqlite':
+        return
+    op.alter_column('password_reset_tokens', 'user_id',
+                    type_=sa.BigInteger(), existing_type=sa.Integer(),
+                    existing_nullable=False)
+    op.alter_column('users', 'id',
+                    type_=sa.BigInteger(), existing_type=sa.Integer(),
+                    existing_nullable=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        return
+    op.alter_column('users', 'id',
+                    type_=sa.Integer(), existing_type=sa.BigInteger(),
+                    existing_nullable=False)
+    op.alter_column('password_reset_tokens', 'user_id',
+                    type_=sa.Integer(), existing_type=sa.BigInteger(),
+                    existing_nullable=False)
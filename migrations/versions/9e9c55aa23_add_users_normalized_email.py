@@ -0,0 +1,25 @@
+"""add users.normalized_email
+
+Revision ID: 9e9c55aa23
+Revises: 2f8a6d1c07
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e9c55aa23'
+down_revision = '2f8a6d1c07'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # filled in by `python manage.py backfill_normalized_emails`, which
+    # commits in batches outside of this transaction; a7d3e5c190 then adds
+    # the unique index and NOT NULL
+    op.add_column('users', sa.Column('normalized_email', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('users', 'normalized_email')
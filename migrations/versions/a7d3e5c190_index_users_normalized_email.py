@@ -0,0 +1,54 @@
+"""index users.normalized_email
+
+Revision ID: a7d3e5c190
+Revises: 9e9c55aa23
+Create Date: 2026-10-18 09:30:02.410877
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3e5c190'
+down_revision = '9e9c55aa23'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+
+
+users = table(
+    'users',
+    column('normalized_email', sa.String)
+)
+
+
+def upgrade():
+    connection = op.get_bind()
+    missing = connection.execute(
+        sa.select([sa.func.count()]).select_from(users)
+        .where(users.c.normalized_email == None)  # noqa
+    ).scalar()
+    if missing:
+        raise RuntimeError(
+            '%d user(s) have no normalized_email, run `python manage.py '
+            'backfill_normalized_emails` before upgrading' % missing)
+
+    duplicates = connection.execute(
+        sa.select([users.c.normalized_email])
+        .group_by(users.c.normalized_email)
+        .having(sa.func.count() > 1)
+    ).fetchall()
+    if duplicates:
+        raise RuntimeError(
+            'Merge or remove the accounts that differ only in case before '
+            'upgrading: %s' % ', '.join(row[0] for row in duplicates))
+
+    op.create_index(op.f('ix_users_normalized_email'), 'users', ['normalized_email'], unique=True)
+    if connection.dialect.name != 'sqlite':
+        # SQLite cannot alter columns, the model still never writes NULLs
+        op.alter_column('users', 'normalized_email', nullable=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        op.alter_column('users', 'normalized_email', nullable=True)
+    op.drop_index(op.f('ix_users_normalized_email'), table_name='users')
@@ -9,17 +9,24 @@ import os
 
 from flask import Flask, render_template
 from flask.ext.login import LoginManager
-from flask.ext.bcrypt import Bcrypt
 from flask_mail import Mail
-from flask.ext.debugtoolbar import DebugToolbarExtension
-from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from werkzeug.contrib.fixers import ProxyFix
+
+from project.cache import UserCache
+from project.hashing import PasswordHasher
+from project.queries import RepeatedQueries
+from project.ratelimit import RateLimiter
+from project.replicas import RoutingSQLAlchemy
+from project.timing import ServerTiming
+from project.warmup import set_bytecode_cache, warm_up
 
 
 ################
 #### config ####
 ################
 
-def _check_config_variables_are_set(config):
+def _check_config_variables_are_set(config, config_name):
     assert config['MAIL_USERNAME'] is not None,\
            'MAIL_USERNAME is not set, set the env variable APP_MAIL_USERNAME '\
            'or MAIL_USERNAME in the production config file.'
@@ -37,7 +44,7 @@ def _check_config_variables_are_set(config):
            'SQLALCHEMY_DATABASE_URI is not set, '\
            'set it in the production config file.'
 
-    if os.environ['APP_SETTINGS'] == 'project.config.ProductionConfig':
+    if config_name == 'project.config.ProductionConfig':
         assert config['STRIPE_SECRET_KEY'] is not None,\
                'STRIPE_SECRET_KEY is not set, '\
                'set it in the production config file.'
@@ -46,39 +53,90 @@ def _check_config_variables_are_set(config):
                'set it in the production config file.'
 
 
-app = Flask(__name__)
-
-app.config.from_object(os.environ['APP_SETTINGS'])
-
-_check_config_variables_are_set(app.config)
-
 ####################
 #### extensions ####
 ####################
 
 login_manager = LoginManager()
-login_manager.init_app(app)
-bcrypt = Bcrypt(app)
-mail = Mail(app)
-toolbar = DebugToolbarExtension(app)
-db = SQLAlchemy(app)
-
-
-####################
-#### blueprints ####
-####################
-
-from project.main.views import main_blueprint
-from project.user.views import user_blueprint
-app.register_blueprint(main_blueprint)
-app.register_blueprint(user_blueprint)
-
-
-####################
+hasher = PasswordHasher()
+user_cache = UserCache()
+limiter = RateLimiter()
+server_timing = ServerTiming()
+repeated_queries = RepeatedQueries()
+mail = Mail()
+# objects stay loaded after a commit, the session only lives for a request
+db = RoutingSQLAlchemy(session_options={'expire_on_commit': False})
+
+
+#####################
+#### app factory ####
+#####################
+
+def create_app(config_name=None):
+    """Create the app, configured from APP_SETTINGS unless given a config."""
+    config_name = config_name or os.environ['APP_SETTINGS']
+
+    app = Flask(__name__)
+
+    app.config.from_object(config_name)
+
+    _check_config_variables_are_set(app.config, config_name)
+
+    if app.config['PROXY_COUNT']:
+        # remote_addr is the client's, for the per IP rate limits
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                num_proxies=app.config['PROXY_COUNT'])
+
+    # extensions
+    login_manager.init_app(app)
+    hasher.init_app(app)
+    user_cache.init_app(app)
+    limiter.init_app(app)
+    server_timing.init_app(app)
+    repeated_queries.init_app(app)
+    mail.init_app(app)
+    db.init_app(app)
+    if app.config['DEBUG_TB_ENABLED']:
+        # only imported when enabled, it is never used in production
+        from flask.ext.debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+    set_bytecode_cache(app)
+
+    # blueprints
+    from project.main.views import main_blueprint
+    from project.user.views import user_blueprint
+    app.register_blueprint(main_blueprint)
+    app.register_blueprint(user_blueprint)
+    if app.config['METRICS_ENABLED']:
+        from project.metrics.views import metrics_blueprint, Metrics
+        app.register_blueprint(metrics_blueprint)
+        Metrics(app)
+    if app.config['PRUNE_INTERVAL']:
+        from project.prune import Pruner
+        Pruner(app)
+
+    app.teardown_request(repository.clear)
+
+    # error handlers
+    app.errorhandler(403)(forbidden_page)
+    app.errorhandler(404)(page_not_found)
+    app.errorhandler(429)(too_many_requests_page)
+    app.errorhandler(500)(server_error_page)
+    app.errorhandler(503)(service_unavailable_page)
+    # no database connection became free within SQLALCHEMY_POOL_TIMEOUT
+    app.errorhandler(PoolTimeoutError)(service_unavailable_page)
+
+    if app.config['WARMUP_ENABLED']:
+        warm_up(app)
+
+    return app
+
+
+#####################
 #### flask-login ####
-####################
+#####################
 
-from project.models import User
+from project import repository
 
 login_manager.login_view = "user.login"
 login_manager.login_message_category = "danger"
@@ -86,23 +144,33 @@ login_manager.login_message_category = "danger"
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.filter(User.id == int(user_id)).first()
+    user = user_cache.get(user_id)
+    if user is None:
+        user = repository.get_user(user_id)
+        if user is not None:
+            user_cache.set(user)
+    return user
 
 
 ########################
 #### error handlers ####
 ########################
 
-@app.errorhandler(403)
 def forbidden_page(error):
     return render_template("errors/403.html"), 403
 
 
-@app.errorhandler(404)
 def page_not_found(error):
     return render_template("errors/404.html"), 404
 
 
-@app.errorhandler(500)
+def too_many_requests_page(error):
+    return render_template("errors/429.html"), 429
+
+
 def server_error_page(error):
     return render_template("errors/500.html"), 500
+
+
+def service_unavailable_page(error):
+    return render_template("errors/503.html"), 503
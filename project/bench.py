@@ -0,0 +1,153 @@
+# project/bench.py
+
+
+import json
+import math
+import platform
+import timeit
+
+from flask import render_template, request
+
+from project import create_app, db, user_cache, load_user, repository
+from project.config import BaseConfig
+from project.models import User
+from project.token import generate_confirmation_token, confirm_token
+from project.user.forms import RegisterForm
+
+
+class BenchConfig(BaseConfig):
+    """A production-like app on an in-memory database."""
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    WTF_CSRF_ENABLED = False
+    RATELIMIT_ENABLED = False
+    SERVER_TIMING_ENABLED = False
+    METRICS_ENABLED = False
+    WARMUP_ENABLED = False
+    PRUNE_INTERVAL = 0
+
+
+def measure(func, warmup=0.1, repeat=5, min_time=0.05):
+    """Time `func` and return statistics of its duration in seconds.
+
+    `func` is first called for `warmup` seconds, then timed `repeat` times
+    in loops long enough to last `min_time` seconds each.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        seconds = timer.timeit(number)
+        if seconds >= min_time:
+            break
+        number *= 2 if seconds * 2 >= min_time else 10
+    elapsed = seconds
+    while elapsed < warmup:
+        elapsed += timer.timeit(number)
+
+    samples = sorted(seconds / number for seconds in
+                     timer.repeat(repeat=repeat, number=number))
+    mean = sum(samples) / len(samples)
+    middle = len(samples) // 2
+    median = samples[middle] if len(samples) % 2 else \
+        (samples[middle - 1] + samples[middle]) / 2
+    stdev = math.sqrt(sum((s - mean) ** 2 for s in samples) / len(samples))
+    return {
+        'calls': number * repeat,
+        'min': samples[0],
+        'median': median,
+        'mean': mean,
+        'stdev': stdev,
+    }
+
+
+def cases(app, rounds):
+    """Yield (name, function) for every primitive to measure.
+
+    Must be called in a request context of `app`.
+    """
+    user = User.query.filter_by(email='bench@example.com').first()
+    user_id = str(user.id)
+
+    for cost in rounds:
+        def new_user(cost=cost):
+            app.config['BCRYPT_LOG_ROUNDS'] = cost
+            User(email='new@example.com', password='password', confirmed=False)
+        yield 'user_init_rounds_%d' % cost, new_user
+    app.config['BCRYPT_LOG_ROUNDS'] = BenchConfig.BCRYPT_LOG_ROUNDS
+
+    token = generate_confirmation_token(user.email)
+    yield 'generate_confirmation_token', \
+        lambda: generate_confirmation_token(user.email)
+    yield 'confirm_token', lambda: confirm_token(token)
+
+    def load_user_uncached():
+        user_cache.invalidate(user_id)
+        repository.clear()
+        db.session.expunge_all()
+        load_user(user_id)
+    yield 'load_user_cached', lambda: load_user(user_id)
+    yield 'load_user_uncached', load_user_uncached
+
+    yield 'register_form_validate', \
+        lambda: RegisterForm(request.form).validate()
+
+    confirm_url = 'http://localhost/confirm/' + token
+    yield 'render_activate', lambda: render_template(
+        'user/activate.html', confirm_url=confirm_url)
+
+
+def run(rounds=(4, 8, 10), only=None, warmup=0.1, repeat=5, progress=None):
+    """Measure every case and return the results by name."""
+    app = create_app(BenchConfig)
+    results = {}
+    with app.test_request_context('/register', method='POST', data=dict(
+            email='new@example.com', password='password',
+            confirm='password')):
+        db.create_all()
+        db.session.add(User(email='bench@example.com', password='password',
+                            confirmed=True))
+        db.session.commit()
+        try:
+            for name, func in cases(app, rounds):
+                if only and not any(part in name for part in only):
+                    continue
+                results[name] = measure(func, warmup, repeat)
+                if progress is not None:
+                    progress(name, results[name])
+        finally:
+            db.session.remove()
+            db.drop_all()
+    return results
+
+
+def report(results, commit=None):
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Return the cases whose median regressed by more than `threshold`.
+
+    Every regression is a (name, baseline median, median) tuple.
+    """
+    regressions = []
+    for name in sorted(results):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        after = results[name]['median']
+        if after > before['median'] * (1 + threshold):
+            regressions.append((name, before['median'], after))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
@@ -0,0 +1,591 @@
+# project/bulk.py
+
+
+import csv
+import datetime
+import io
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import time
+from multiprocessing import Pool
+
+from flask import current_app
+from sqlalchemy import func, select
+
+from project import db, user_cache
+from project.hashing import _generate_password_hash, is_password_hash
+from project.models import OutboxEmail, PasswordResetToken, User, \
+    normalize_email
+from project.sharding import email_bucket, id_bucket, new_user_id
+
+
+# the csv module only reads and writes bytes on Python 2
+_PY2 = sys.version_info[0] == 2
+
+DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+# export columns, named as import_users expects them
+EXPORT_FIELDS = ('id', 'email', 'confirmed', 'admin', 'registered_on',
+                 'confirmed_on')
+
+# seeded user n has the password SEED_PASSWORDS[n % len(SEED_PASSWORDS)]
+SEED_PASSWORDS = tuple('seed-password-%d' % i for i in range(4))
+
+_FIRST_NAMES = ('james', 'mary', 'john', 'patricia', 'robert', 'jennifer',
+                'michael', 'linda', 'william', 'elizabeth', 'david', 'maria',
+                'richard', 'susan', 'joseph', 'margaret', 'thomas', 'sarah',
+                'carlos', 'yuki', 'wei', 'fatima', 'olga', 'ahmed')
+_LAST_NAMES = ('smith', 'johnson', 'williams', 'brown', 'jones', 'garcia',
+               'miller', 'davis', 'rodriguez', 'martinez', 'wilson', 'lee',
+               'nguyen', 'kim', 'muller', 'rossi', 'tanaka', 'ivanova',
+               'khan', 'silva')
+# the number in the email of a seeded user
+_SEED_NUMBER = re.compile(r'^[a-z]+\.[a-z]+\.(\d+)@', re.IGNORECASE)
+# (domain, weight)
+_DOMAINS = (('gmail.com', 45), ('yahoo.com', 15), ('hotmail.com', 12),
+            ('outlook.com', 10), ('icloud.com', 8), ('example.org', 5),
+            ('example.com', 5))
+
+
+def import_users(path, fmt=None, batch_size=1000, workers=None,
+                 resume=True, progress=None):
+    """Stream users from a CSV or JSON lines file into the users table.
+
+    Each record needs an `email` and either a `password`, which is hashed on
+    a pool of `workers` processes, or a bcrypt `password_hash` that is kept
+    as is. `confirmed`, `admin`, `registered_on` and `confirmed_on` are
+    optional. Emails that are already registered are skipped.
+
+    Records are inserted `batch_size` at a time, one transaction per batch.
+    After every batch the number of records read is saved next to the file
+    in `<path>.checkpoint`, and a later run with `resume` set continues from
+    there; a checkpoint past the end of the file raises a ValueError.
+    `progress` is called after every batch with the number of records read,
+    imported and skipped so far.
+
+    Returns a (imported, skipped) tuple.
+    """
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+    checkpoint_path = path + '.checkpoint'
+    done = 0
+    if resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            done = int(f.read().strip() or 0)
+    rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+    pool = Pool(workers) if workers != 1 else None
+    imported = skipped = 0
+    ids = itertools.count()
+    try:
+        records = _read_records(path, fmt)
+        if sum(1 for _ in itertools.islice(records, done)) < done:
+            raise ValueError(
+                '%s does not match the input: it is past the end of %s, '
+                'run again without resuming' % (checkpoint_path, path))
+        for batch in _batches(records, batch_size):
+            jobs = [(record, rounds) for record in batch]
+            rows = pool.map(_to_row, jobs) if pool else map(_to_row, jobs)
+            rows = _new_rows(rows)
+            _insert_users(rows, ids)
+            db.session.commit()
+            done += len(batch)
+            imported += len(rows)
+            skipped += len(batch) - len(rows)
+            _write_checkpoint(checkpoint_path, done)
+            if progress is not None:
+                progress(done, imported, skipped)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return imported, skipped
+
+
+def export_users(out, fmt='csv', page_size=1000, confirmed=None,
+                 admin=None, registered_after=None, registered_before=None,
+                 include_passwords=False):
+    """Stream users to the text file object `out` as CSV or JSON lines.
+
+    The table is walked in primary key order, one page of `page_size` rows
+    per query, and each page is its own short read, so neither the table nor
+    a long transaction is ever held. `confirmed` and `admin` filter on the
+    flags when not None, `registered_after` and `registered_before` bound
+    `registered_on`. With `include_passwords` the bcrypt hashes are exported
+    as `password_hash`, which import_users accepts as is. With
+    SQLALCHEMY_USER_SHARDS the shards are exported one after the other.
+
+    Returns the number of users written.
+    """
+    users = User.__table__
+    fields = EXPORT_FIELDS + (('password_hash',) if include_passwords else ())
+    columns = [users.c[name] for name in EXPORT_FIELDS]
+    if include_passwords:
+        columns.append(users.c.password.label('password_hash'))
+    query = select(columns).order_by(users.c.id).limit(page_size)
+    if confirmed is not None:
+        query = query.where(users.c.confirmed == confirmed)
+    if admin is not None:
+        query = query.where(users.c.admin == admin)
+    if registered_after is not None:
+        query = query.where(users.c.registered_on >= registered_after)
+    if registered_before is not None:
+        query = query.where(users.c.registered_on < registered_before)
+
+    if fmt == 'csv':
+        writer = _csv_writer(out)
+        writer.writerow(fields)
+    session = db.session()
+    written = 0
+    for shard in session.shards():
+        last_id = 0
+        while True:
+            with session.using_shard(shard):
+                rows = db.session.execute(
+                    query.where(users.c.id > last_id)).fetchall()
+                # end the read, the next page starts a new transaction
+                db.session.commit()
+            if not rows:
+                break
+            for row in rows:
+                values = [_export_value(row[name]) for name in fields]
+                if fmt == 'csv':
+                    writer.writerow(values)
+                else:
+                    out.write(_text(
+                        json.dumps(dict(zip(fields, values))) + '\n'))
+            written += len(rows)
+            last_id = rows[-1]['id']
+    return written
+
+
+def seed_users(count, batch_size=10000, commit_every=100000,
+               confirmed_ratio=0.8, years=3, seed=None, start=None,
+               progress=None):
+    """Insert `count` synthetic users, for load and scale testing.
+
+    Emails look like `first.last.n@domain`, with `n` continuing after
+    `start`, by default the highest number already seeded, so seeding can be
+    repeated after users were deleted. A `start` below that number raises a
+    ValueError before anything is inserted. Registration dates spread
+    over the last `years` years, more of them recent, and `confirmed_ratio`
+    of the users confirmed a few hours after registering. Passwords are
+    SEED_PASSWORDS, hashed once each instead of once per user.
+
+    Rows are inserted `batch_size` at a time and committed every
+    `commit_every` rows. `progress` is called after every commit with the
+    number of users inserted so far. Returns that number.
+    """
+    rng = random.Random(seed)
+    rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+    hashes = [_generate_password_hash(password, rounds)
+              for password in SEED_PASSWORDS]
+    domains = [domain for domain, weight in _DOMAINS for _ in range(weight)]
+    now = datetime.datetime.now()
+    span = years * 365 * 24 * 3600
+    last = _last_seeded_number()
+    if start is None:
+        start = last
+    elif start < last:
+        raise ValueError('Users are seeded up to number %d, start from it or '
+                         'above' % last)
+    ids = itertools.count()
+
+    inserted = 0
+    while inserted < count:
+        rows = []
+        for n in range(start + inserted + 1,
+                       start + min(inserted + batch_size, count) + 1):
+            email = '%s.%s.%d@%s' % (
+                rng.choice(_FIRST_NAMES), rng.choice(_LAST_NAMES), n,
+                rng.choice(domains))
+            if rng.random() < 0.1:
+                email = email.capitalize()
+            # the square root skews the age towards recent registrations
+            registered_on = now - datetime.timedelta(
+                seconds=int(span * (1 - rng.random() ** 0.5)))
+            confirmed = rng.random() < confirmed_ratio
+            rows.append(dict(
+                email=email,
+                normalized_email=normalize_email(email),
+                password=hashes[n % len(hashes)],
+                registered_on=registered_on,
+                admin=False,
+                confirmed=confirmed,
+                confirmed_on=registered_on + datetime.timedelta(
+                    seconds=int(rng.expovariate(1 / 3600.0)))
+                if confirmed else None
+            ))
+        _insert_users(rows, ids)
+        inserted += len(rows)
+        if inserted % commit_every < len(rows) or inserted == count:
+            db.session.commit()
+            if progress is not None:
+                progress(inserted)
+    return inserted
+
+
+def _last_seeded_number(page_size=10000):
+    """Return the highest number in the emails of seeded users, or 0."""
+    users = User.__table__
+    query = select([users.c.id, users.c.email]).where(
+        users.c.email.like('%.%.%@%')).order_by(users.c.id).limit(page_size)
+    session = db.session()
+    last = 0
+    for shard in session.shards():
+        last_id = 0
+        while True:
+            with session.using_shard(shard):
+                rows = db.session.execute(
+                    query.where(users.c.id > last_id)).fetchall()
+                db.session.commit()
+            if not rows:
+                break
+            for row in rows:
+                match = _SEED_NUMBER.match(row.email)
+                if match:
+                    last = max(last, int(match.group(1)))
+            last_id = rows[-1].id
+    return last
+
+
+def rebalance_users(batch_size=1000, progress=None):
+    """Move the users, and their reset tokens, to the shard of their bucket.
+
+    Run it after adding databases to SQLALCHEMY_USER_SHARDS: each shard is
+    walked in id order, `batch_size` users at a time, and the users that now
+    belong elsewhere are copied to their shard and then deleted from this
+    one. The copy is committed first and users already copied are skipped,
+    so an interrupted run can simply be repeated. Until it finishes, users
+    that are still to move cannot be found.
+
+    `progress` is called after every batch with the number of users looked
+    at and moved so far. Returns the number moved.
+    """
+    session = db.session()
+    users = User.__table__
+    tokens = PasswordResetToken.__table__
+    seen = moved = 0
+    for source in range(session.shard_count):
+        last_id = 0
+        while True:
+            with session.using_shard(source):
+                rows = db.session.execute(
+                    select([users]).where(users.c.id > last_id)
+                    .order_by(users.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            misplaced = {}
+            for row in rows:
+                target = session.shard_of_bucket(id_bucket(row['id']))
+                if target != source:
+                    misplaced.setdefault(target, []).append(dict(row))
+            for target, target_rows in sorted(misplaced.items()):
+                ids = [row['id'] for row in target_rows]
+                with session.using_shard(source):
+                    user_tokens = [dict(row) for row in db.session.execute(
+                        select([tokens]).where(tokens.c.user_id.in_(ids)))]
+                with session.using_shard(target):
+                    copied = set(row[0] for row in db.session.execute(
+                        select([users.c.id]).where(users.c.id.in_(ids))))
+                    new_rows = [row for row in target_rows
+                                if row['id'] not in copied]
+                    if new_rows:
+                        db.session.execute(users.insert(), new_rows)
+                    new_tokens = [row for row in user_tokens
+                                  if row['user_id'] not in copied]
+                    for row in new_tokens:
+                        # token ids are only unique within a shard
+                        del row['id']
+                    if new_tokens:
+                        db.session.execute(tokens.insert(), new_tokens)
+                    db.session.commit()
+                with session.using_shard(source):
+                    db.session.execute(
+                        tokens.delete().where(tokens.c.user_id.in_(ids)))
+                    db.session.execute(
+                        users.delete().where(users.c.id.in_(ids)))
+                    db.session.commit()
+                moved += len(ids)
+            seen += len(rows)
+            last_id = rows[-1]['id']
+            if progress is not None:
+                progress(seen, moved)
+    return moved
+
+
+def shard_users(batch_size=1000, progress=None):
+    """Move the users, and their reset tokens, from the primary to the shards.
+
+    Run it once after setting SQLALCHEMY_USER_SHARDS on a database that was
+    not sharded. Those users have ids that do not carry their bucket, so
+    each one gets a new id in the bucket of its email on the way to its
+    shard, and its reset tokens follow it. Users are copied `batch_size` at
+    a time and committed on their shards before they are deleted from the
+    primary; users already copied are matched by email and skipped, so an
+    interrupted run can simply be repeated. Their old ids stop working,
+    which logs everyone out. Emails still queued in the outbox then move to
+    the shard of their recipient; one may be sent twice if the run is
+    interrupted while moving them.
+
+    `progress` is called after every batch with the number of users moved
+    so far. Returns that number.
+    """
+    session = db.session()
+    users = User.__table__
+    tokens = PasswordResetToken.__table__
+    # the session sends these tables to the shards, read the primary's own
+    primary = db.engine
+    ids = itertools.count()
+    moved = 0
+    while True:
+        rows = [dict(row) for row in primary.execute(
+            select([users]).order_by(users.c.id).limit(batch_size))]
+        if not rows:
+            break
+        old_ids = [row['id'] for row in rows]
+        user_tokens = [dict(row) for row in primary.execute(
+            select([tokens]).where(tokens.c.user_id.in_(old_ids)))]
+        shard_rows = {}
+        for row in rows:
+            bucket = email_bucket(row['normalized_email'])
+            shard_rows.setdefault(
+                session.shard_of_bucket(bucket), []).append((bucket, row))
+        for shard, bucket_rows in sorted(shard_rows.items()):
+            with session.using_shard(shard):
+                copied = set(row[0] for row in db.session.execute(
+                    select([users.c.normalized_email]).where(
+                        users.c.normalized_email.in_(
+                            [row['normalized_email']
+                             for _, row in bucket_rows]))))
+                new_ids = {}
+                new_rows = []
+                for bucket, row in bucket_rows:
+                    if row['normalized_email'] not in copied:
+                        new_ids[row['id']] = new_user_id(bucket, next(ids))
+                        new_rows.append(dict(row, id=new_ids[row['id']]))
+                new_tokens = [dict(row, user_id=new_ids[row['user_id']])
+                              for row in user_tokens
+                              if row['user_id'] in new_ids]
+                for row in new_tokens:
+                    # token ids are only unique within a shard
+                    del row['id']
+                if new_rows:
+                    db.session.execute(users.insert(), new_rows)
+                if new_tokens:
+                    db.session.execute(tokens.insert(), new_tokens)
+                db.session.commit()
+        with primary.begin() as connection:
+            connection.execute(
+                tokens.delete().where(tokens.c.user_id.in_(old_ids)))
+            connection.execute(users.delete().where(users.c.id.in_(old_ids)))
+        for user_id in old_ids:
+            user_cache.invalidate(user_id)
+        moved += len(rows)
+        if progress is not None:
+            progress(moved)
+    _shard_outbox(batch_size)
+    return moved
+
+
+def _shard_outbox(batch_size):
+    session = db.session()
+    outbox = OutboxEmail.__table__
+    primary = db.engine
+    while True:
+        rows = [dict(row) for row in primary.execute(
+            select([outbox]).where(outbox.c.sent_on == None)  # noqa
+            .order_by(outbox.c.id).limit(batch_size))]
+        if not rows:
+            break
+        ids = [row.pop('id') for row in rows]
+        shard_rows = {}
+        for row in rows:
+            bucket = email_bucket(normalize_email(row['recipient']))
+            shard_rows.setdefault(
+                session.shard_of_bucket(bucket), []).append(row)
+        for shard, rows in sorted(shard_rows.items()):
+            with session.using_shard(shard):
+                db.session.execute(outbox.insert(), rows)
+                db.session.commit()
+        primary.execute(outbox.delete().where(outbox.c.id.in_(ids)))
+
+
+def backfill_normalized_emails(batch_size=1000, sleep=0, progress=None):
+    """Fill in the users.normalized_email left empty by migration 9e9c55aa23.
+
+    Users are updated in id order, `batch_size` at a time, each batch in a
+    transaction of its own `sleep` seconds apart, so signups and logins only
+    ever wait for one batch. `progress` is called after every batch with the
+    number of users updated so far. Returns that number.
+    """
+    users = User.__table__
+    empty = users.c.normalized_email == None  # noqa
+    session = db.session()
+    updated = 0
+    for shard in session.shards():
+        last_id = 0
+        while True:
+            with session.using_shard(shard):
+                ids = [row[0] for row in db.session.execute(
+                    select([users.c.id]).where(users.c.id > last_id)
+                    .where(empty).order_by(users.c.id).limit(batch_size))]
+                if not ids:
+                    db.session.commit()
+                    break
+                updated += db.session.execute(
+                    users.update().where(users.c.id.in_(ids)).where(empty)
+                    .values(normalized_email=func.lower(
+                        func.trim(users.c.email)))).rowcount
+                db.session.commit()
+            last_id = ids[-1]
+            if progress is not None:
+                progress(updated)
+            if sleep and len(ids) == batch_size:
+                time.sleep(sleep)
+    return updated
+
+
+def _export_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATETIME_FORMATS[0])
+    return value
+
+
+def _read_records(path, fmt):
+    if fmt == 'csv' and _PY2:
+        with open(path, 'rb') as f:
+            for record in csv.DictReader(f):
+                yield dict((_text(key), _text(value))
+                           for key, value in record.items())
+        return
+    with io.open(path, encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _text(value):
+    # UTF-8 bytes from csv or json on Python 2 to text
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _csv_writer(out):
+    if not _PY2:
+        return csv.writer(out)
+    return _Py2CsvWriter(out)
+
+
+class _Py2CsvWriter(object):
+    # csv.writer for text files on Python 2: every row is written to a
+    # buffer as UTF-8 and passed on decoded
+
+    def __init__(self, out):
+        self._out = out
+        self._buffer = io.BytesIO()
+        self._writer = csv.writer(self._buffer)
+
+    def writerow(self, values):
+        self._writer.writerow([
+            value.encode('utf-8') if isinstance(value, type(u'')) else value
+            for value in values])
+        self._out.write(_text(self._buffer.getvalue()))
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _to_row(job):
+    # runs on the pool, so it must not touch the app or the database
+    record, rounds = job
+    password_hash = record.get('password_hash')
+    if not password_hash or not is_password_hash(password_hash):
+        if not record.get('password'):
+            raise ValueError('%s has neither a password nor a password_hash'
+                             % record['email'])
+        password_hash = _generate_password_hash(record['password'], rounds)
+    email = record['email'].strip()
+    return dict(
+        email=email,
+        normalized_email=normalize_email(email),
+        password=password_hash,
+        registered_on=parse_datetime(record.get('registered_on')) or
+        datetime.datetime.now(),
+        admin=parse_bool(record.get('admin')),
+        confirmed=parse_bool(record.get('confirmed')),
+        confirmed_on=parse_datetime(record.get('confirmed_on'))
+    )
+
+
+def _new_rows(rows):
+    # drop emails that are registered already or repeated within the batch
+    rows = dict((row['normalized_email'], row) for row in rows)
+    if not rows:
+        return []
+    existing = db.session.query(User.normalized_email).filter(
+        User.normalized_email.in_(list(rows))).all()
+    for (email,) in existing:
+        del rows[email]
+    return list(rows.values())
+
+
+def _insert_users(rows, ids):
+    # with shards, each row goes to the shard of its email with an id in the
+    # same bucket, numbered from the counter `ids`
+    session = db.session()
+    insert = User.__table__.insert()
+    if not session.shard_count:
+        if rows:
+            db.session.execute(insert, rows)
+        return
+    shard_rows = {}
+    for row in rows:
+        bucket = email_bucket(row['normalized_email'])
+        row['id'] = new_user_id(bucket, next(ids))
+        shard_rows.setdefault(session.shard_of_bucket(bucket), []).append(row)
+    for shard, rows in sorted(shard_rows.items()):
+        with session.using_shard(shard):
+            db.session.execute(insert, rows)
+
+
+def _write_checkpoint(path, done):
+    with open(path + '.tmp', 'w') as f:
+        f.write(str(done))
+    os.rename(path + '.tmp', path)
+
+
+def parse_bool(value):
+    """Parse a boolean from an import file or the command line."""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 't', 'yes', 'y')
+
+
+def parse_datetime(value):
+    """Parse a date or datetime in one of DATETIME_FORMATS."""
+    if not value:
+        return None
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Unknown date format: %s' % value)
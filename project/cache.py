@@ -0,0 +1,188 @@
+# project/cache.py
+
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from werkzeug.utils import import_string
+
+
+class MemoryCache(object):
+    """A bounded in-process LRU cache whose entries expire after a TTL.
+
+    It follows the `werkzeug.contrib.cache` interface, so any of those
+    caches (e.g. `RedisCache`) can be used instead to share entries between
+    worker processes.
+    """
+
+    def __init__(self, threshold=1024, default_timeout=60):
+        self.threshold = threshold
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # re-insert to mark it as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout, value)
+            while len(self._entries) > self.threshold:
+                self._entries.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        """Set key only if it is not set yet."""
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.time():
+                return False
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout, value)
+            while len(self._entries) > self.threshold:
+                self._entries.popitem(last=False)
+        return True
+
+    def inc(self, key, delta=1):
+        """Increment key, keeping its expiry time."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                entry = (time.time() + self.default_timeout, 0)
+            expires, value = entry
+            self._entries[key] = (expires, value + delta)
+            while len(self._entries) > self.threshold:
+                self._entries.popitem(last=False)
+            return value + delta
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        return True
+
+
+class UserSnapshot(object):
+    """The fields of a `User` that Flask-Login and the templates need."""
+
+    fields = ('id', 'email', 'admin', 'confirmed')
+
+    def __init__(self, id, email, admin, confirmed):
+        self.id = id
+        self.email = email
+        self.admin = admin
+        self.confirmed = confirmed
+
+    def is_authenticated(self):
+        return True
+
+    def is_active(self):
+        return True
+
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return self.id
+
+    def __repr__(self):
+        return '<email {}'.format(self.email)
+
+
+class UserCache(object):
+    """Caches `UserSnapshot`s for the Flask-Login user loader.
+
+    Entries must be invalidated whenever a cached user changes. The backend
+    is a `MemoryCache` unless USER_CACHE_BACKEND names a `werkzeug.contrib.
+    cache` compatible class, which is built with USER_CACHE_BACKEND_OPTIONS.
+    Every app keeps its own backend and hit counts in
+    `app.extensions['user_cache']`.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        ttl = app.config['USER_CACHE_TTL']
+        backend = app.config['USER_CACHE_BACKEND']
+        if backend is None:
+            backend = MemoryCache(app.config['USER_CACHE_SIZE'], ttl)
+        else:
+            backend = import_string(backend)(
+                **app.config['USER_CACHE_BACKEND_OPTIONS'])
+        app.extensions['user_cache'] = _UserCacheState(
+            app.config['USER_CACHE_ENABLED'], ttl, backend)
+
+    @property
+    def state(self):
+        """The `_UserCacheState` of the current app."""
+        return current_app.extensions['user_cache']
+
+    @property
+    def hits(self):
+        return self.state.hits
+
+    @property
+    def misses(self):
+        return self.state.misses
+
+    def get(self, user_id):
+        state = self.state
+        if not state.enabled:
+            return None
+        fields = state.backend.get(self._key(user_id))
+        if fields is None:
+            state.misses += 1
+            return None
+        state.hits += 1
+        return UserSnapshot(**fields)
+
+    def set(self, user):
+        state = self.state
+        if state.enabled:
+            fields = dict((name, getattr(user, name))
+                          for name in UserSnapshot.fields)
+            state.backend.set(self._key(user.id), fields, state.ttl)
+
+    def invalidate(self, user_id):
+        state = self.state
+        if state.enabled:
+            state.backend.delete(self._key(user_id))
+
+    def clear(self):
+        state = self.state
+        state.backend.clear()
+        state.hits = state.misses = 0
+
+    def _key(self, user_id):
+        return 'user:%d' % int(user_id)
+
+
+class _UserCacheState(object):
+
+    def __init__(self, enabled, ttl, backend):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
@@ -1,6 +1,8 @@
 # project/config.py
 
 import os
+import multiprocessing
+import tempfile
 try:
     # Python 2.7
     import ConfigParser as configparser
@@ -25,18 +27,134 @@ def _get_bool_env_var(varname, default=None):
         return bool(value)
 
 
+def _get_optional_env_var(varname, convert):
+    # None keeps the library's default
+    value = os.environ.get(varname)
+    if not value:
+        return None
+    return convert(value)
+
+
 class BaseConfig(object):
     """Base configuration."""
 
     # main config
     SECRET_KEY = 'my_precious'
     SECURITY_PASSWORD_SALT = 'my_precious_two'
+    # retired secret keys, tokens signed with them are still accepted
+    SECRET_KEY_FALLBACKS = [key for key in os.environ.get(
+        'APP_SECRET_KEY_FALLBACKS', '').split(',') if key]
     DEBUG = False
-    BCRYPT_LOG_ROUNDS = 13
+    # seconds a password reset link stays valid
+    PASSWORD_RESET_TOKEN_TTL = int(os.environ.get('APP_PASSWORD_RESET_TOKEN_TTL', 3600))
+    # run `python manage.py calibrate_hash` to pick a value for this host
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('APP_BCRYPT_LOG_ROUNDS', 13))
     WTF_CSRF_ENABLED = True
     DEBUG_TB_ENABLED = False
     DEBUG_TB_INTERCEPT_REDIRECTS = False
 
+    # password hashing pool, see project/hashing.py
+    BCRYPT_POOL_TYPE = os.environ.get('APP_BCRYPT_POOL_TYPE', 'thread')
+    BCRYPT_POOL_SIZE = int(os.environ.get(
+        'APP_BCRYPT_POOL_SIZE', multiprocessing.cpu_count()))
+    BCRYPT_POOL_QUEUE_SIZE = int(os.environ.get(
+        'APP_BCRYPT_POOL_QUEUE_SIZE', 4 * multiprocessing.cpu_count()))
+
+    # cache of logged in users, see project/cache.py
+    USER_CACHE_ENABLED = _get_bool_env_var('APP_USER_CACHE_ENABLED', True)
+    USER_CACHE_SIZE = int(os.environ.get('APP_USER_CACHE_SIZE', 10000))
+    USER_CACHE_TTL = int(os.environ.get('APP_USER_CACHE_TTL', 60))
+    # e.g. 'werkzeug.contrib.cache.RedisCache' to share it between workers
+    USER_CACHE_BACKEND = os.environ.get('APP_USER_CACHE_BACKEND', None)
+    USER_CACHE_BACKEND_OPTIONS = {}
+
+    # how many proxies in front of the app append to X-Forwarded-For; the
+    # client IP is read from there instead of the proxy's own address
+    PROXY_COUNT = int(os.environ.get('APP_PROXY_COUNT', 0))
+
+    # login, password reset and confirmation limits as (attempts, seconds)
+    # per client IP, email address or user, see project/ratelimit.py
+    RATELIMIT_ENABLED = _get_bool_env_var('APP_RATELIMIT_ENABLED', True)
+    RATELIMITS = {
+        'login_ip': (30, 60),
+        'login_email': (10, 300),
+        'forgot_ip': (10, 300),
+        'forgot_email': (3, 900),
+        'resend_ip': (10, 300),
+        'resend_user': (3, 900),
+    }
+    RATELIMIT_MEMORY_SIZE = 100000
+    # e.g. 'werkzeug.contrib.cache.RedisCache' to share it between workers
+    RATELIMIT_BACKEND = os.environ.get('APP_RATELIMIT_BACKEND', None)
+    RATELIMIT_BACKEND_OPTIONS = {}
+
+    # per request phase timings, see project/timing.py
+    SERVER_TIMING_ENABLED = _get_bool_env_var('APP_SERVER_TIMING_ENABLED', False)
+    SERVER_TIMING_LOG = _get_bool_env_var('APP_SERVER_TIMING_LOG', False)
+
+    # compile templates and connect to the database in create_app instead
+    # of on the first request, see project/warmup.py
+    WARMUP_ENABLED = _get_bool_env_var('APP_WARMUP_ENABLED', False)
+    # compiled templates shared by all workers, e.g. /var/cache/project/jinja
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('APP_JINJA_BYTECODE_CACHE_DIR', None)
+
+    # warn about SQL statements repeated within a request, see
+    # project/queries.py
+    WARN_REPEATED_QUERIES = _get_bool_env_var('APP_WARN_REPEATED_QUERIES', False)
+
+    # /metrics endpoint, METRICS_DIR shares the values of all worker
+    # processes and should be emptied when the app is restarted
+    METRICS_ENABLED = _get_bool_env_var('APP_METRICS_ENABLED', False)
+    METRICS_DIR = os.environ.get('APP_METRICS_DIR', None)
+
+    # `python manage.py prune`, or every PRUNE_INTERVAL seconds when set by
+    # the one worker on the host that holds PRUNE_LOCK_FILE, see
+    # project/prune.py
+    PRUNE_UNCONFIRMED_AFTER_DAYS = int(os.environ.get(
+        'APP_PRUNE_UNCONFIRMED_AFTER_DAYS', 30))
+    PRUNE_BATCH_SIZE = int(os.environ.get('APP_PRUNE_BATCH_SIZE', 500))
+    PRUNE_SLEEP = float(os.environ.get('APP_PRUNE_SLEEP', 0.1))
+    PRUNE_INTERVAL = int(os.environ.get('APP_PRUNE_INTERVAL', 0))
+    PRUNE_LOCK_FILE = os.environ.get(
+        'APP_PRUNE_LOCK_FILE',
+        os.path.join(tempfile.gettempdir(), 'project-prune.lock'))
+
+    # databases to spread the users and their reset tokens over by a hash of
+    # the email, see project/sharding.py; after changing the list run
+    # `python manage.py rebalance_users`
+    SQLALCHEMY_USER_SHARDS = [uri for uri in os.environ.get(
+        'APP_DATABASE_USER_SHARDS', '').split(',') if uri]
+
+    # database connection pool of each worker process, see project/pool.py;
+    # unset values keep SQLAlchemy's defaults of 5 connections, 10 more in
+    # overflow and a 30 second wait for a free one
+    SQLALCHEMY_POOL_SIZE = _get_optional_env_var('APP_DATABASE_POOL_SIZE', int)
+    SQLALCHEMY_MAX_OVERFLOW = _get_optional_env_var(
+        'APP_DATABASE_MAX_OVERFLOW', int)
+    SQLALCHEMY_POOL_TIMEOUT = _get_optional_env_var(
+        'APP_DATABASE_POOL_TIMEOUT', float)
+    # seconds after which a connection is replaced, below the server's idle
+    # timeout
+    SQLALCHEMY_POOL_RECYCLE = _get_optional_env_var(
+        'APP_DATABASE_POOL_RECYCLE', int)
+    # test connections on checkout, so a failover costs a reconnect rather
+    # than failed requests
+    SQLALCHEMY_POOL_PRE_PING = _get_bool_env_var(
+        'APP_DATABASE_POOL_PRE_PING', False)
+    # answer 503 right away instead of waiting when every connection is in use
+    SQLALCHEMY_POOL_FAIL_FAST = _get_bool_env_var(
+        'APP_DATABASE_POOL_FAIL_FAST', False)
+    # seconds, PostgreSQL and MySQL only
+    SQLALCHEMY_STATEMENT_TIMEOUT = _get_optional_env_var(
+        'APP_DATABASE_STATEMENT_TIMEOUT', float)
+
+    # read replicas, see project/replicas.py: the reads of a request go to
+    # one of them unless the user wrote in the last REPLICA_STICKY_SECONDS
+    SQLALCHEMY_REPLICAS = [uri for uri in os.environ.get(
+        'APP_DATABASE_REPLICA_URIS', '').split(',') if uri]
+    SQLALCHEMY_REPLICA_STICKY_SECONDS = int(os.environ.get(
+        'APP_DATABASE_REPLICA_STICKY_SECONDS', 10))
+
     # mail settings
     # defaults are:
     #  - MAIL_SERVER = 'smtp.googlemail.com'
@@ -55,6 +173,17 @@ class BaseConfig(object):
     # mail accounts
     MAIL_DEFAULT_SENDER = 'from@example.com'
 
+    # mail outbox, drained by `python manage.py send_emails`
+    MAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('APP_MAIL_OUTBOX_BATCH_SIZE', 100))
+    MAIL_OUTBOX_POLL_INTERVAL = int(os.environ.get('APP_MAIL_OUTBOX_POLL_INTERVAL', 5))
+    MAIL_OUTBOX_MAX_ATTEMPTS = 5
+    # seconds before the first retry, doubled after every failed attempt
+    MAIL_OUTBOX_RETRY_DELAY = 60
+    # days sent and failed emails are kept, see project/prune.py
+    MAIL_OUTBOX_KEEP_DAYS = int(os.environ.get('APP_MAIL_OUTBOX_KEEP_DAYS', 30))
+    # seconds a sender holds the emails it is sending, more than a batch takes
+    MAIL_OUTBOX_LEASE = int(os.environ.get('APP_MAIL_OUTBOX_LEASE', 600))
+
 
 class DevelopmentConfig(BaseConfig):
     """Development configuration."""
@@ -62,6 +191,7 @@ class DevelopmentConfig(BaseConfig):
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'dev.sqlite')
     DEBUG_TB_ENABLED = True
+    WARN_REPEATED_QUERIES = True
 
 
 class TestingConfig(BaseConfig):
@@ -72,6 +202,10 @@ class TestingConfig(BaseConfig):
     BCRYPT_LOG_ROUNDS = 1
     WTF_CSRF_ENABLED = False
     DEBUG_TB_ENABLED = False
+    RATELIMIT_ENABLED = False
+    SERVER_TIMING_ENABLED = True
+    METRICS_ENABLED = True
+    WARN_REPEATED_QUERIES = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
 
 
@@ -87,6 +221,10 @@ class ProductionConfig(BaseConfig):
     STRIPE_PUBLISHABLE_KEY = None
 
     SQLALCHEMY_DATABASE_URI = None
+    SQLALCHEMY_POOL_PRE_PING = _get_bool_env_var(
+        'APP_DATABASE_POOL_PRE_PING', True)
+    SQLALCHEMY_POOL_RECYCLE = _get_optional_env_var(
+        'APP_DATABASE_POOL_RECYCLE', int) or 1800
 
     # production config takes precedence over env variables
 
@@ -102,6 +240,9 @@ class ProductionConfig(BaseConfig):
 
         SECRET_KEY = config.get('keys', 'SECRET_KEY')
         SECURITY_PASSWORD_SALT = config.get('keys', 'SECRET_KEY')
+        if config.has_option('keys', 'SECRET_KEY_FALLBACKS'):
+            SECRET_KEY_FALLBACKS = config.get(
+                'keys', 'SECRET_KEY_FALLBACKS').split()
 
         # mail settings
         MAIL_SERVER = config.get('mail', 'MAIL_SERVER')
@@ -116,6 +257,33 @@ class ProductionConfig(BaseConfig):
 
         # database URI
         SQLALCHEMY_DATABASE_URI = config.get('db', 'SQLALCHEMY_DATABASE_URI')
+        if config.has_option('db', 'SQLALCHEMY_REPLICAS'):
+            SQLALCHEMY_REPLICAS = config.get(
+                'db', 'SQLALCHEMY_REPLICAS').split()
+        if config.has_option('db', 'SQLALCHEMY_USER_SHARDS'):
+            SQLALCHEMY_USER_SHARDS = config.get(
+                'db', 'SQLALCHEMY_USER_SHARDS').split()
+        # connection pool, see BaseConfig
+        if config.has_option('db', 'SQLALCHEMY_POOL_SIZE'):
+            SQLALCHEMY_POOL_SIZE = config.getint('db', 'SQLALCHEMY_POOL_SIZE')
+        if config.has_option('db', 'SQLALCHEMY_MAX_OVERFLOW'):
+            SQLALCHEMY_MAX_OVERFLOW = config.getint(
+                'db', 'SQLALCHEMY_MAX_OVERFLOW')
+        if config.has_option('db', 'SQLALCHEMY_POOL_TIMEOUT'):
+            SQLALCHEMY_POOL_TIMEOUT = config.getfloat(
+                'db', 'SQLALCHEMY_POOL_TIMEOUT')
+        if config.has_option('db', 'SQLALCHEMY_POOL_RECYCLE'):
+            SQLALCHEMY_POOL_RECYCLE = config.getint(
+                'db', 'SQLALCHEMY_POOL_RECYCLE')
+        if config.has_option('db', 'SQLALCHEMY_POOL_PRE_PING'):
+            SQLALCHEMY_POOL_PRE_PING = config.getboolean(
+                'db', 'SQLALCHEMY_POOL_PRE_PING')
+        if config.has_option('db', 'SQLALCHEMY_POOL_FAIL_FAST'):
+            SQLALCHEMY_POOL_FAIL_FAST = config.getboolean(
+                'db', 'SQLALCHEMY_POOL_FAIL_FAST')
+        if config.has_option('db', 'SQLALCHEMY_STATEMENT_TIMEOUT'):
+            SQLALCHEMY_STATEMENT_TIMEOUT = config.getfloat(
+                'db', 'SQLALCHEMY_STATEMENT_TIMEOUT')
 
         # stripe keys
         STRIPE_SECRET_KEY = config.get('stripe', 'STRIPE_SECRET_KEY')
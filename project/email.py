@@ -1,15 +1,161 @@
 # project/email.py
 
+import datetime
+import smtplib
+import socket
+import time
+
+from flask import current_app
 from flask.ext.mail import Message
+from sqlalchemy.orm.attributes import set_committed_value
 
-from project import app, mail
+from project import db, mail
+from project.metrics.registry import SMTP_SEND_SECONDS, EMAILS_SENT
+from project.models import OutboxEmail
+from project.timing import timed
 
 
 def send_email(to, subject, template):
-    msg = Message(
-        subject,
-        recipients=[to],
-        html=template,
-        sender=app.config['MAIL_DEFAULT_SENDER']
-    )
-    mail.send(msg)
+    """Queue an email in the outbox.
+
+    The email is only added to the session, so it is committed in the same
+    transaction as the caller's changes. `send_queued_emails` delivers it.
+    """
+    with timed('mail'):
+        db.session.add(
+            OutboxEmail(recipient=to, subject=subject, html=template))
+
+
+def send_queued_emails(batch_size=None):
+    """Send a batch of due outbox emails over a single SMTP connection.
+
+    Failed emails are retried with exponential backoff until
+    MAIL_OUTBOX_MAX_ATTEMPTS is reached. With SQLALCHEMY_USER_SHARDS the
+    outbox of every shard is drained in turn, a batch and a connection for
+    each. Returns the number of emails sent.
+    """
+    if batch_size is None:
+        batch_size = current_app.config['MAIL_OUTBOX_BATCH_SIZE']
+    session = db.session()
+    sent = 0
+    for shard in session.shards():
+        # emails stay where they were queued, even if their user has moved
+        with session.using_shard(shard):
+            sent += _send_batch(batch_size)
+    return sent
+
+
+def _send_batch(batch_size):
+    emails = _claim(OutboxEmail.query.filter(
+        OutboxEmail.sent_on == None,  # noqa
+        OutboxEmail.attempts < current_app.config['MAIL_OUTBOX_MAX_ATTEMPTS'],
+        OutboxEmail.next_attempt_on <= datetime.datetime.now()
+    ).order_by(OutboxEmail.id).limit(batch_size).all())
+    if not emails:
+        return 0
+
+    sent = 0
+    handled = set()
+    try:
+        with mail.connect() as conn:
+            for email in emails:
+                try:
+                    with SMTP_SEND_SECONDS.time():
+                        conn.send(Message(
+                            email.subject,
+                            recipients=[email.recipient],
+                            html=email.html,
+                            sender=current_app.config['MAIL_DEFAULT_SENDER']
+                        ))
+                except (smtplib.SMTPRecipientsRefused,
+                        smtplib.SMTPSenderRefused,
+                        smtplib.SMTPDataError) as e:
+                    # the message was rejected, the connection is still fine
+                    _defer(email, e)
+                else:
+                    email.sent_on = datetime.datetime.now()
+                    EMAILS_SENT.inc(result='sent')
+                    sent += 1
+                handled.add(email.id)
+    except (smtplib.SMTPException, socket.error) as e:
+        for email in emails:
+            if email.id not in handled:
+                _defer(email, e)
+    db.session.commit()
+    return sent
+
+
+def purge_outbox(older_than, batch_size=1000, sleep=0):
+    """Delete outbox emails older than `older_than` days, returning how many.
+
+    Sent emails go `older_than` days after they were sent, and emails that
+    used up their MAIL_OUTBOX_MAX_ATTEMPTS that long after they were queued;
+    emails still to be sent are kept. Every batch is its own short
+    transaction, `sleep` seconds apart, and with SQLALCHEMY_USER_SHARDS each
+    shard is purged in turn.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=older_than)
+    done = db.or_(
+        OutboxEmail.sent_on < cutoff,
+        db.and_(OutboxEmail.sent_on == None,  # noqa
+                OutboxEmail.attempts >=
+                current_app.config['MAIL_OUTBOX_MAX_ATTEMPTS'],
+                OutboxEmail.created_on < cutoff))
+    session = db.session()
+    deleted = 0
+    for shard in session.shards():
+        with session.using_shard(shard):
+            deleted += _purge_shard(done, batch_size, sleep)
+    return deleted
+
+
+def _purge_shard(done, batch_size, sleep):
+    deleted = 0
+    last_id = 0
+    while True:
+        ids = [row[0] for row in db.session.query(OutboxEmail.id)
+               .filter(OutboxEmail.id > last_id, done)
+               .order_by(OutboxEmail.id)
+               .limit(batch_size)]
+        if not ids:
+            break
+        deleted += OutboxEmail.query.filter(
+            OutboxEmail.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        last_id = ids[-1]
+        if sleep and len(ids) == batch_size:
+            time.sleep(sleep)
+    return deleted
+
+
+def _claim(emails):
+    """Lease `emails` to this sender and return the ones it got.
+
+    Each one is claimed by moving its next attempt MAIL_OUTBOX_LEASE seconds
+    ahead, only if no other sender has changed it since it was read, so
+    concurrent senders never send the same email. If a sender dies, the
+    emails it held are due again once the lease is over.
+    """
+    leased_until = datetime.datetime.now() + datetime.timedelta(
+        seconds=current_app.config['MAIL_OUTBOX_LEASE'])
+    claimed = []
+    for email in emails:
+        if OutboxEmail.query.filter(
+                OutboxEmail.id == email.id,
+                OutboxEmail.sent_on == None,  # noqa
+                OutboxEmail.next_attempt_on == email.next_attempt_on
+        ).update(dict(next_attempt_on=leased_until),
+                 synchronize_session=False):
+            set_committed_value(email, 'next_attempt_on', leased_until)
+            claimed.append(email)
+    db.session.commit()
+    return claimed
+
+
+def _defer(email, error):
+    EMAILS_SENT.inc(result='failed')
+    email.attempts += 1
+    email.last_error = str(error)[:255]
+    delay = current_app.config['MAIL_OUTBOX_RETRY_DELAY'] * 2 ** (email.attempts - 1)
+    email.next_attempt_on = datetime.datetime.now() + \
+        datetime.timedelta(seconds=delay)
@@ -0,0 +1,144 @@
+# project/hashing.py
+
+
+import os
+import re
+import threading
+import timeit
+from multiprocessing.pool import Pool, ThreadPool
+
+from flask import current_app
+from flask_bcrypt import Bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+from project.metrics.registry import BCRYPT_HASH_SECONDS, \
+    BCRYPT_VERIFY_SECONDS
+from project.timing import timed
+
+
+# unbound instance, safe to use from pool processes
+_bcrypt = Bcrypt()
+
+_BCRYPT_HASH = re.compile(r'^\$2[aby]?\$(\d\d)\$[./A-Za-z0-9]{53}$')
+
+# bcrypt clamps the cost to this range
+MIN_ROUNDS, MAX_ROUNDS = 4, 31
+
+
+def _generate_password_hash(password, rounds):
+    return _bcrypt.generate_password_hash(password, rounds)
+
+
+def _check_password_hash(pw_hash, password):
+    return _bcrypt.check_password_hash(pw_hash, password)
+
+
+def is_password_hash(value):
+    """Whether value looks like a bcrypt hash."""
+    return _BCRYPT_HASH.match(value) is not None
+
+
+class HashingPoolSaturated(ServiceUnavailable):
+    description = 'The server is busy right now, please try again shortly.'
+
+
+class PasswordHasher(object):
+    """Runs bcrypt on a bounded worker pool.
+
+    Hashing is moved off the request thread to BCRYPT_POOL_SIZE threads (or
+    processes, see BCRYPT_POOL_TYPE). At most BCRYPT_POOL_QUEUE_SIZE calls
+    wait for a free worker, any further call fails fast with a 503. A pool
+    size of 0 hashes inline. Every app gets its own pool, kept in
+    `app.extensions['password_hasher']`.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['password_hasher'] = _HashingPool(
+            app.config['BCRYPT_POOL_TYPE'], app.config['BCRYPT_POOL_SIZE'],
+            app.config['BCRYPT_POOL_QUEUE_SIZE'])
+
+    @property
+    def pool(self):
+        """The `_HashingPool` of the current app."""
+        return current_app.extensions['password_hasher']
+
+    def generate_password_hash(self, password):
+        rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+        with BCRYPT_HASH_SECONDS.time():
+            return self._run(_generate_password_hash, password, rounds)
+
+    def check_password_hash(self, pw_hash, password):
+        with BCRYPT_VERIFY_SECONDS.time():
+            return self._run(_check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Whether pw_hash is not a bcrypt hash of the configured cost."""
+        match = _BCRYPT_HASH.match(pw_hash)
+        if match is None:
+            return True
+        rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+        return int(match.group(1)) != min(max(rounds, MIN_ROUNDS), MAX_ROUNDS)
+
+    def _run(self, func, *args):
+        with timed('bcrypt'):
+            return self.pool.run(func, *args)
+
+
+class _HashingPool(object):
+    # the workers of one app, started on first use
+
+    def __init__(self, pool_type, size, queue_size):
+        self.pool_type = pool_type
+        self.size = size
+        self.queue_size = queue_size
+        self.slots = None
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def run(self, func, *args):
+        if not self.size:
+            return func(*args)
+        pool = self.get()
+        if not self.slots.acquire(False):
+            raise HashingPoolSaturated()
+        try:
+            return pool.apply_async(func, args).get()
+        finally:
+            self.slots.release()
+
+    def get(self):
+        # pools do not survive a fork, so each worker process builds its own
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    pool_class = Pool if self.pool_type == 'process' \
+                        else ThreadPool
+                    self.slots = threading.BoundedSemaphore(
+                        self.size + self.queue_size)
+                    self._pool = pool_class(self.size)
+                    self._pid = os.getpid()
+        return self._pool
+
+
+def calibrate_rounds(target_ms):
+    """Time bcrypt at increasing costs until a hash takes over target_ms.
+
+    Returns a list of (rounds, milliseconds) for every cost tried. The last
+    cost within the target is the one to use for BCRYPT_LOG_ROUNDS.
+    """
+    timings = []
+    for rounds in range(MIN_ROUNDS, MAX_ROUNDS + 1):
+        # cheap costs are noisy, so take the best of a few runs
+        repeat = 5 if rounds < 10 else 1
+        seconds = min(timeit.repeat(
+            lambda: _generate_password_hash('calibration', rounds),
+            repeat=repeat, number=1))
+        timings.append((rounds, seconds * 1000))
+        if seconds * 1000 > target_ms:
+            break
+    return timings
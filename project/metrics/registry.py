@@ -0,0 +1,352 @@
+# project/metrics/registry.py
+
+
+import errno
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+
+class MemoryValues(object):
+    """Metric values of this process, kept in a dict."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class MmapValues(object):
+    """Metric values of this process, kept in a memory mapped file.
+
+    Every process writes its own file, so writes only take a thread lock and
+    the files can be read by any other process at any time. The file starts
+    with the number of bytes used, followed by entries made of the key
+    length, the utf-8 key padded to 8 bytes and the value as a double.
+    """
+
+    def __init__(self, path, initial_size=1 << 16):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        self._capacity = os.fstat(self._file.fileno()).st_size
+        if self._capacity == 0:
+            self._capacity = initial_size
+            self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+        self._used = struct.unpack_from('<i', self._map, 0)[0] or 8
+        self._positions = dict(
+            (key, position)
+            for key, position in _entries(self._map, self._used))
+
+    def inc(self, key, amount):
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._append(key)
+            value = struct.unpack_from('<d', self._map, position)[0]
+            struct.pack_into('<d', self._map, position, value + amount)
+
+    def items(self):
+        with self._lock:
+            return [(key, struct.unpack_from('<d', self._map, position)[0])
+                    for key, position in self._positions.items()]
+
+    def _append(self, key):
+        encoded = key.encode('utf-8')
+        padded = _padded(len(encoded))
+        while self._used + 4 + padded + 8 > self._capacity:
+            self._grow()
+        struct.pack_into('<i%dsd' % padded, self._map, self._used,
+                         len(encoded), encoded, 0.0)
+        position = self._used + 4 + padded
+        self._used = position + 8
+        # readers only look up to here, so this is written last
+        struct.pack_into('<i', self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def _grow(self):
+        self._capacity *= 2
+        self._map.close()
+        self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+
+
+def read_values(path):
+    """Return the (key, value) pairs of a file written by `MmapValues`."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < 8:
+        return []
+    used = struct.unpack_from('<i', data, 0)[0]
+    return [(key, struct.unpack_from('<d', data, position)[0])
+            for key, position in _entries(data, used)]
+
+
+def _padded(length):
+    # pad the key so the value after it is 8 byte aligned
+    return length + (-(4 + length) % 8)
+
+
+def _entries(data, used):
+    position = 8
+    while position < used:
+        length = struct.unpack_from('<i', data, position)[0]
+        key = bytes(data[position + 4:position + 4 + length]).decode('utf-8')
+        position += 4 + _padded(length)
+        yield key, position
+        position += 8
+
+
+class Registry(object):
+    """Holds the metrics and their values.
+
+    Nothing is recorded until `configure` is called, which the app only does
+    with METRICS_ENABLED. Without a directory values are only kept in
+    memory, per process. With one, each process writes its values to
+    `metrics_<pid>.db` there, and `collect` sums up the files of all
+    processes; gauges only those of processes still running. The directory
+    should be emptied whenever the whole application is restarted.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self.enabled = False
+        self._values = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, directory=None):
+        """Start recording, shared through `directory` if given."""
+        with self._lock:
+            self.directory = directory
+            self._values = None
+            self.enabled = True
+
+    @property
+    def values(self):
+        # a forked worker must not share its parent's values
+        if self._values is None or self._pid != os.getpid():
+            with self._lock:
+                if self._values is None or self._pid != os.getpid():
+                    if self.directory is None:
+                        self._values = MemoryValues()
+                    else:
+                        self._values = MmapValues(os.path.join(
+                            self.directory, 'metrics_%d.db' % os.getpid()))
+                    self._pid = os.getpid()
+        return self._values
+
+    def collect(self):
+        """Return the values of all processes, summed per sample."""
+        if self.directory is None:
+            files = [(True, self.values.items())]
+        else:
+            files = []
+            for path in glob.glob(os.path.join(self.directory, 'metrics_*.db')):
+                pid = int(os.path.basename(path)[len('metrics_'):-len('.db')])
+                files.append((_is_running(pid), read_values(path)))
+        # a gauge of a process that exited no longer holds
+        gauges = set(metric.name for metric in self.metrics
+                     if metric.type == 'gauge')
+        samples = {}
+        for running, pairs in files:
+            for key, value in pairs:
+                name, labels = json.loads(key)
+                if not running and name in gauges:
+                    continue
+                sample = (name, tuple(tuple(label) for label in labels))
+                samples[sample] = samples.get(sample, 0.0) + value
+        return samples
+
+    def render(self):
+        """Render all metrics in the Prometheus text format."""
+        samples = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.render(samples))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _is_running(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM: running as another user
+        return e.errno == errno.EPERM
+    return True
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        registry.metrics.append(self)
+
+    def _inc(self, sample_name, labels, amount):
+        if not self.registry.enabled:
+            return
+        key = json.dumps([sample_name, sorted(labels.items())])
+        self.registry.values.inc(key, amount)
+
+    def _labels(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s takes the labels %s, not %s' % (
+                self.name, self.labelnames, tuple(labels)))
+        return dict((name, str(value)) for name, value in labels.items())
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        self._inc(self.name, self._labels(labels), amount)
+
+    def value(self, **labels):
+        """Return the current value, summed over all processes."""
+        sample = (self.name, tuple(sorted(self._labels(labels).items())))
+        return self.registry.collect().get(sample, 0.0)
+
+    def render(self, samples):
+        return [_sample(name, labels, value)
+                for (name, labels), value in sorted(samples.items())
+                if name == self.name]
+
+
+class Gauge(Counter):
+    """A value that also goes down, summed over the running processes."""
+
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(
+            .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+            registry=REGISTRY):
+        super(Histogram, self).__init__(
+            name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        labels = self._labels(labels)
+        # buckets are stored per bound and only made cumulative when rendered
+        for bound in self.buckets:
+            if value <= bound:
+                labels['le'] = repr(float(bound))
+                break
+        else:
+            labels['le'] = '+Inf'
+        self._inc(self.name + '_bucket', labels, 1)
+        del labels['le']
+        self._inc(self.name + '_sum', labels, value)
+        self._inc(self.name + '_count', labels, 1)
+
+    @contextmanager
+    def time(self, **labels):
+        if not self.registry.enabled:
+            yield
+            return
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def render(self, samples):
+        lines = []
+        label_sets = sorted(set(
+            labels for name, labels in samples if name == self.name + '_count'))
+        for labels in label_sets:
+            cumulative = 0.0
+            for bound in [repr(float(b)) for b in self.buckets] + ['+Inf']:
+                bucket = tuple(sorted(labels + (('le', bound),)))
+                cumulative += samples.get((self.name + '_bucket', bucket), 0.0)
+                lines.append(_sample(self.name + '_bucket', bucket, cumulative))
+            for suffix in ('_sum', '_count'):
+                lines.append(_sample(self.name + suffix, labels,
+                                     samples[(self.name + suffix, labels)]))
+        return lines
+
+
+def _sample(name, labels, value):
+    if not labels:
+        return '%s %r' % (name, value)
+    return '%s{%s} %r' % (name, ','.join(
+        '%s="%s"' % (label, value.replace('\\', r'\\').replace('"', r'\"')
+                     .replace('\n', r'\n'))
+        for label, value in labels), value)
+
+
+#####################
+#### app metrics ####
+#####################
+
+BCRYPT_HASH_SECONDS = Histogram(
+    'bcrypt_hash_seconds', 'Time to hash a password, including queueing.',
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+BCRYPT_VERIFY_SECONDS = Histogram(
+    'bcrypt_verify_seconds', 'Time to verify a password, including queueing.',
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+SMTP_SEND_SECONDS = Histogram(
+    'smtp_send_seconds', 'Time to send one email over SMTP.',
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+DB_QUERY_SECONDS = Histogram(
+    'db_query_seconds', 'Time per SQL statement by endpoint.', ['endpoint'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+DB_QUERIES_PER_REQUEST = Histogram(
+    'db_queries_per_request', 'SQL statements per request by endpoint.',
+    ['endpoint'], buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    'db_pool_checkout_seconds',
+    'Time to get a connection from the pool, waiting included.',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5, 30))
+DB_POOL_IN_USE = Gauge(
+    'db_pool_connections_in_use', 'Connections checked out of the pool.')
+DB_POOL_TIMEOUTS = Counter(
+    'db_pool_timeouts_total', 'Checkouts that found the pool exhausted.')
+
+LOGINS = Counter('logins_total', 'Login attempts by result.', ['result'])
+REGISTRATIONS = Counter('registrations_total', 'Registered users.')
+CONFIRMATIONS = Counter('confirmations_total', 'Confirmed accounts.')
+PASSWORD_RESETS = Counter(
+    'password_resets_total', 'Password resets by stage.', ['stage'])
+RATE_LIMITED = Counter('rate_limited_total', 'Rejected attempts by scope.',
+                       ['scope'])
+EMAILS_SENT = Counter('emails_sent_total', 'Outbox emails by result.',
+                      ['result'])
@@ -0,0 +1,66 @@
+# project/metrics/views.py
+
+
+#################
+#### imports ####
+#################
+
+from flask import Blueprint, Response, g, has_request_context, request
+
+from project.metrics.registry import REGISTRY, DB_QUERY_SECONDS, \
+    DB_QUERIES_PER_REQUEST
+from project.queries import on_statement
+
+
+################
+#### config ####
+################
+
+metrics_blueprint = Blueprint('metrics', __name__,)
+
+
+class Metrics(object):
+    """Stores metrics in METRICS_DIR and records SQL time per endpoint.
+
+    Nothing is hooked up unless METRICS_ENABLED is set.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['METRICS_ENABLED']:
+            return
+        REGISTRY.configure(app.config['METRICS_DIR'])
+        app.before_request(_start_request)
+        app.after_request(_end_request)
+        on_statement(_observe_query)
+
+
+def _start_request():
+    g._metrics_queries = 0
+
+
+def _end_request(response):
+    DB_QUERIES_PER_REQUEST.observe(
+        getattr(g, '_metrics_queries', 0), endpoint=request.endpoint)
+    return response
+
+
+def _observe_query(engine, statement, parameters, seconds):
+    endpoint = None
+    if has_request_context():
+        endpoint = request.endpoint
+        g._metrics_queries = getattr(g, '_metrics_queries', 0) + 1
+    DB_QUERY_SECONDS.observe(seconds, endpoint=endpoint)
+
+
+################
+#### routes ####
+################
+
+@metrics_blueprint.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
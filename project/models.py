@@ -3,32 +3,50 @@
 
 import datetime
 
-from project import db, bcrypt
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import validates
+
+from project import db, hasher
+from project.sharding import ShardedQuery, email_bucket, new_user_id
+
+# user ids take 63 bits with sharding, on SQLite only INTEGER autoincrements
+_UserId = db.BigInteger().with_variant(db.Integer(), 'sqlite')
+
+
+def normalize_email(email):
+    """Return the form of an email address used to look users up."""
+    return email.strip().lower()
 
 
 class User(db.Model):
 
     __tablename__ = "users"
+    query_class = ShardedQuery
 
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(_UserId, primary_key=True)
     email = db.Column(db.String, unique=True, nullable=False)
+    normalized_email = db.Column(db.String, unique=True, index=True,
+                                 nullable=False)
     password = db.Column(db.String, nullable=False)
     registered_on = db.Column(db.DateTime, nullable=False)
     admin = db.Column(db.Boolean, nullable=False, default=False)
     confirmed = db.Column(db.Boolean, nullable=False, default=False)
     confirmed_on = db.Column(db.DateTime, nullable=True)
-    password_reset_token = db.Column(db.String, nullable=True)
 
     def __init__(self, email, password, confirmed,
-                 admin=False, confirmed_on=None,
-                 password_reset_token=None):
+                 admin=False, confirmed_on=None):
         self.email = email
-        self.password = bcrypt.generate_password_hash(password)
+        self.password = hasher.generate_password_hash(password)
         self.registered_on = datetime.datetime.now()
         self.admin = admin
         self.confirmed = confirmed
         self.confirmed_on = confirmed_on
-        self.password_reset_token = password_reset_token
+
+    @validates('email')
+    def _set_normalized_email(self, key, email):
+        self.normalized_email = normalize_email(email)
+        return email
 
     def is_authenticated(self):
         return True
@@ -44,3 +62,62 @@ class User(db.Model):
 
     def __repr__(self):
         return '<email {}'.format(self.email)
+
+
+@event.listens_for(User, 'before_insert')
+def _assign_sharded_id(mapper, connection, user):
+    # the id keeps the bucket of the email, see project/sharding.py
+    if user.id is None and current_app.config['SQLALCHEMY_USER_SHARDS']:
+        user.id = new_user_id(email_bucket(user.normalized_email))
+
+
+class OutboxEmail(db.Model):
+
+    __tablename__ = "email_outbox"
+    # kept on the shard of the recipient
+    query_class = ShardedQuery
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String, nullable=False)
+    subject = db.Column(db.String, nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    created_on = db.Column(db.DateTime, nullable=False)
+    next_attempt_on = db.Column(db.DateTime, nullable=False, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String, nullable=True)
+    sent_on = db.Column(db.DateTime, nullable=True, index=True)
+
+    def __init__(self, recipient, subject, html):
+        self.recipient = recipient
+        self.subject = subject
+        self.html = html
+        self.created_on = datetime.datetime.now()
+        self.next_attempt_on = self.created_on
+        self.attempts = 0
+
+    def __repr__(self):
+        return '<outbox {} {}>'.format(self.id, self.recipient)
+
+
+class PasswordResetToken(db.Model):
+
+    __tablename__ = "password_reset_tokens"
+    # kept on the shard of their user
+    query_class = ShardedQuery
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(_UserId, db.ForeignKey('users.id'), nullable=False,
+                        index=True)
+    # sha256 of the token sent by email, the token itself is never stored
+    digest = db.Column(db.String(64), unique=True, index=True, nullable=False)
+    created_on = db.Column(db.DateTime, nullable=False)
+    expires_on = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __init__(self, user_id, digest, lifetime):
+        self.user_id = user_id
+        self.digest = digest
+        self.created_on = datetime.datetime.now()
+        self.expires_on = self.created_on + datetime.timedelta(seconds=lifetime)
+
+    def __repr__(self):
+        return '<reset token {} user {}>'.format(self.id, self.user_id)
@@ -0,0 +1,100 @@
+# project/password_reset.py
+
+
+import binascii
+import datetime
+import hashlib
+import os
+import time
+
+from flask import current_app
+
+from project import db
+from project.models import PasswordResetToken
+from project.token import generate_password_reset_token, \
+    confirm_password_reset_token
+
+
+def digest_token(token):
+    """Return the form of a reset token stored in the database."""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def check_reset_token(token):
+    """Return the digest of a reset token, or None if it is not one of ours.
+
+    The signature and age are checked first, so made up tokens never reach
+    the database.
+    """
+    if not confirm_password_reset_token(
+            token, current_app.config['PASSWORD_RESET_TOKEN_TTL']):
+        return None
+    return digest_token(token)
+
+
+def issue_reset_token(user):
+    """Add a reset token for the user to the session and return it.
+
+    Like `send_email`, the caller commits.
+    """
+    nonce = binascii.hexlify(os.urandom(16)).decode('ascii')
+    token = generate_password_reset_token(nonce)
+    db.session.add(PasswordResetToken(
+        user.id, digest_token(token),
+        current_app.config['PASSWORD_RESET_TOKEN_TTL']))
+    return token
+
+
+def use_reset_tokens(user_id):
+    """Delete the user's reset tokens, returning False if there were none.
+
+    Deleting in one statement makes a token single use: of two requests
+    racing with the same token only one sees a row to delete.
+    """
+    return PasswordResetToken.query.filter_by(user_id=user_id).delete(
+        synchronize_session=False) > 0
+
+
+def invalidate_reset_tokens(issued_before=None):
+    """Delete every outstanding reset token, or those issued before a time."""
+    query = PasswordResetToken.query
+    if issued_before is not None:
+        query = query.filter(PasswordResetToken.created_on < issued_before)
+    count = query.delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def purge_expired_reset_tokens(batch_size=1000, sleep=0):
+    """Delete expired reset tokens in batches, returning how many.
+
+    Every batch is its own short transaction, `sleep` seconds apart, and
+    with SQLALCHEMY_USER_SHARDS each shard is purged in turn.
+    """
+    now = datetime.datetime.now()
+    session = db.session()
+    deleted = 0
+    for shard in session.shards():
+        with session.using_shard(shard):
+            deleted += _purge_shard(now, batch_size, sleep)
+    return deleted
+
+
+def _purge_shard(now, batch_size, sleep):
+    deleted = 0
+    last_id = 0
+    while True:
+        ids = [row[0] for row in db.session.query(PasswordResetToken.id)
+               .filter(PasswordResetToken.id > last_id,
+                       PasswordResetToken.expires_on < now)
+               .order_by(PasswordResetToken.id)
+               .limit(batch_size)]
+        if not ids:
+            break
+        deleted += PasswordResetToken.query.filter(
+            PasswordResetToken.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        last_id = ids[-1]
+        if sleep and len(ids) == batch_size:
+            time.sleep(sleep)
+    return deleted
@@ -0,0 +1,109 @@
+# project/pool.py
+
+
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from project.metrics.registry import DB_POOL_CHECKOUT_SECONDS, \
+    DB_POOL_IN_USE, DB_POOL_TIMEOUTS
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long getting a connection takes."""
+
+    def connect(self):
+        return self._timed(QueuePool.connect)
+
+    def unique_connection(self):
+        return self._timed(QueuePool.unique_connection)
+
+    def _timed(self, checkout):
+        started = time.time()
+        try:
+            return checkout(self)
+        except exc.TimeoutError:
+            DB_POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.time() - started)
+
+
+def apply_pool_options(app, info, options):
+    """Add the pool options of the app's config to `create_engine` options.
+
+    SQLALCHEMY_POOL_SIZE, _MAX_OVERFLOW, _TIMEOUT and _RECYCLE are already
+    applied by Flask-SQLAlchemy. Pooled engines get a TimedQueuePool, which
+    with SQLALCHEMY_POOL_FAIL_FAST does not wait for a connection once the
+    pool and its overflow are in use. SQLALCHEMY_POOL_PRE_PING tests every
+    connection as it is checked out and replaces it when the database went
+    away, and SQLALCHEMY_STATEMENT_TIMEOUT is set on every new connection of
+    PostgreSQL and MySQL.
+    """
+    sqlite = info.drivername.startswith('sqlite')
+    if 'poolclass' not in options and (
+            not sqlite or info.database not in (None, '', ':memory:')):
+        options['poolclass'] = TimedQueuePool
+        if sqlite:
+            # a pooled connection may be used by another thread later on
+            options.setdefault('connect_args', {})['check_same_thread'] = \
+                False
+        if app.config['SQLALCHEMY_POOL_FAIL_FAST']:
+            options['pool_timeout'] = 0
+
+    events = []
+    if app.config['SQLALCHEMY_POOL_PRE_PING']:
+        # first, so a replaced connection is only counted once
+        events.append((_ping, 'checkout'))
+    if app.config['METRICS_ENABLED']:
+        events.append((_checked_out, 'checkout'))
+        events.append((_checked_in, 'checkin'))
+    timeout = app.config['SQLALCHEMY_STATEMENT_TIMEOUT']
+    if timeout:
+        statement = _statement_timeout(info.drivername, timeout)
+        if statement is not None:
+            events.append((_run_on_connect(statement), 'connect'))
+    options['pool_events'] = events
+
+
+def _ping(dbapi_connection, connection_record, connection_proxy):
+    try:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+    except Exception:
+        # the pool reconnects and retries the checkout
+        raise exc.DisconnectionError()
+
+
+def _checked_out(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_IN_USE.inc()
+
+
+def _checked_in(dbapi_connection, connection_record):
+    DB_POOL_IN_USE.dec()
+
+
+def _statement_timeout(drivername, seconds):
+    milliseconds = int(seconds * 1000)
+    if drivername.startswith('postgresql'):
+        return 'SET statement_timeout = %d' % milliseconds
+    if drivername.startswith('mysql'):
+        # MySQL 5.7.8 and later, SELECTs only
+        return 'SET SESSION max_execution_time = %d' % milliseconds
+    return None
+
+
+def _run_on_connect(statement):
+    def run(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(statement)
+        finally:
+            cursor.close()
+        # or the reset of the connection when it is returned undoes it
+        dbapi_connection.commit()
+    return run
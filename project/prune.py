@@ -0,0 +1,142 @@
+# project/prune.py
+
+
+import datetime
+import fcntl
+import threading
+import time
+
+from flask import current_app
+
+from project import db, user_cache
+from project.models import User, PasswordResetToken
+from project.email import purge_outbox
+from project.password_reset import purge_expired_reset_tokens
+
+
+def prune_unconfirmed_users(older_than, batch_size=500, sleep=0):
+    """Delete users that have not confirmed within `older_than` days.
+
+    Walks the users table in primary key order, deleting at most
+    `batch_size` rows per transaction and waiting `sleep` seconds between
+    batches, so no lock is held for long. With SQLALCHEMY_USER_SHARDS each
+    shard is walked in turn. Returns how many were deleted.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=older_than)
+    stale = db.and_(User.confirmed == False, User.registered_on < cutoff)
+    session = db.session()
+    deleted = 0
+    for shard in session.shards():
+        with session.using_shard(shard):
+            deleted += _prune_shard(stale, batch_size, sleep)
+    return deleted
+
+
+def _prune_shard(stale, batch_size, sleep):
+    deleted = 0
+    last_id = 0
+    while True:
+        ids = [row[0] for row in db.session.query(User.id)
+               .filter(User.id > last_id, stale)
+               .order_by(User.id)
+               .limit(batch_size)]
+        if not ids:
+            break
+        PasswordResetToken.query.filter(
+            PasswordResetToken.user_id.in_(ids)
+        ).delete(synchronize_session=False)
+        # checked again, a user may have confirmed since the select
+        deleted += User.query.filter(User.id.in_(ids), stale).delete(
+            synchronize_session=False)
+        db.session.commit()
+        for user_id in ids:
+            user_cache.invalidate(user_id)
+        last_id = ids[-1]
+        if sleep and len(ids) == batch_size:
+            time.sleep(sleep)
+    return deleted
+
+
+def prune(older_than=None, batch_size=None, sleep=None):
+    """Delete stale unconfirmed users, expired reset tokens and old emails.
+
+    Unset arguments come from the PRUNE_* settings, emails are kept for
+    MAIL_OUTBOX_KEEP_DAYS. Returns the number of rows deleted from each
+    table.
+    """
+    config = current_app.config
+    if older_than is None:
+        older_than = config['PRUNE_UNCONFIRMED_AFTER_DAYS']
+    if batch_size is None:
+        batch_size = config['PRUNE_BATCH_SIZE']
+    if sleep is None:
+        sleep = config['PRUNE_SLEEP']
+    return {
+        'users': prune_unconfirmed_users(older_than, batch_size, sleep),
+        'password_reset_tokens': purge_expired_reset_tokens(batch_size, sleep),
+        'email_outbox': purge_outbox(
+            config['MAIL_OUTBOX_KEEP_DAYS'], batch_size, sleep),
+    }
+
+
+class Pruner(object):
+    """Runs `prune` every PRUNE_INTERVAL seconds in a background thread.
+
+    The thread is started by the first request of each worker process, so it
+    also runs in workers forked from a preloaded app, but only the process
+    holding the lock on PRUNE_LOCK_FILE prunes; the others keep trying to
+    take it over. The lock is per host, so run the app with PRUNE_INTERVAL
+    on a single host, or leave it at 0 and prune from cron with
+    `python manage.py prune` instead.
+    """
+
+    def __init__(self, app=None):
+        self._thread = None
+        self._lock = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['PRUNE_INTERVAL']:
+            return
+        app.before_first_request(lambda: self.start(app))
+
+    def start(self, app):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, args=(app,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, app):
+        while True:
+            time.sleep(app.config['PRUNE_INTERVAL'])
+            if not self.is_leader(app):
+                continue
+            with app.app_context():
+                try:
+                    deleted = prune()
+                    app.logger.info('prune: deleted %(users)d user(s), '
+                                    '%(password_reset_tokens)d reset '
+                                    'token(s) and %(email_outbox)d email(s)'
+                                    % deleted)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('prune failed')
+                finally:
+                    db.session.remove()
+
+    def is_leader(self, app):
+        """Take the lock on PRUNE_LOCK_FILE unless another process has it.
+
+        Once taken the lock is kept until the process exits.
+        """
+        if self._lock is None:
+            lock = open(app.config['PRUNE_LOCK_FILE'], 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock.close()
+                return False
+            self._lock = lock
+        return True
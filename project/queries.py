@@ -0,0 +1,131 @@
+# project/queries.py
+
+
+import time
+import warnings
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# called with (engine, statement, parameters, seconds) after every statement
+_statement_listeners = []
+
+
+def on_statement(listener):
+    """Call `listener` after every SQL statement of any engine.
+
+    It gets the engine, the statement, its parameters and the seconds it
+    took. The engines are only hooked once, by the first listener, however
+    many listeners and apps there are.
+    """
+    if not _statement_listeners:
+        event.listen(Engine, 'before_cursor_execute', _before_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_execute)
+    if listener not in _statement_listeners:
+        _statement_listeners.append(listener)
+
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    conn.info.setdefault('query_started', []).append(time.time())
+
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    seconds = time.time() - conn.info['query_started'].pop()
+    for listener in _statement_listeners:
+        listener(conn.engine, statement, parameters, seconds)
+
+
+class RepeatedQueryWarning(UserWarning):
+    """The same SQL statement ran more than once during a request."""
+
+
+class QueryRecorder(object):
+    """Records the statements run on an engine while it is active.
+
+        with QueryRecorder(db.engine) as queries:
+            client.get('/profile')
+        queries.count, queries.statements
+    """
+
+    def __init__(self, engine, ignore=()):
+        self.engine = engine
+        # statements starting with one of these are not recorded
+        self.ignore = tuple(ignore)
+        self.statements = []
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if self.ignore and statement.startswith(self.ignore):
+            return
+        self.statements.append((statement, parameters))
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __str__(self):
+        return '\n'.join('%s %r' % query for query in self.statements)
+
+
+class RepeatedQueries(object):
+    """Warns when a request runs the same SQL statement more than once.
+
+    A statement repeated with other parameters is usually a lookup done in
+    a loop (N+1), with the same parameters a lookup that should have been
+    shared. Statements are counted per database, so a lookup sent to every
+    shard is not a repeat. Enabled by WARN_REPEATED_QUERIES, which is on in
+    development and testing; tests turn the RepeatedQueryWarning into an
+    error.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['WARN_REPEATED_QUERIES']:
+            return
+        app.before_request(_start_request)
+        app.after_request(_check_request)
+        on_statement(_record)
+
+
+def _start_request():
+    g._statements = {}
+
+
+def _record(engine, statement, parameters, seconds):
+    if not has_request_context():
+        return
+    statements = getattr(g, '_statements', None)
+    if statements is not None:
+        statements.setdefault((engine, statement), []).append(
+            repr(parameters))
+
+
+def _check_request(response):
+    statements = getattr(g, '_statements', None)
+    g._statements = None
+    if not statements:
+        return response
+    for (engine, statement), parameters in statements.items():
+        if len(parameters) > 1:
+            warnings.warn(
+                '%s %s ran the same statement %d times (%d distinct '
+                'parameters): %s' % (
+                    request.method, request.path, len(parameters),
+                    len(set(parameters)), ' '.join(statement.split())),
+                RepeatedQueryWarning)
+    return response
@@ -0,0 +1,77 @@
+# project/ratelimit.py
+
+
+import time
+
+from flask import current_app
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.utils import import_string
+
+from project.cache import MemoryCache
+from project.metrics.registry import RATE_LIMITED
+
+
+class RateLimitExceeded(TooManyRequests):
+    description = 'Too many attempts, please wait a moment and try again.'
+
+
+class RateLimiter(object):
+    """Sliding window rate limits, checked before any expensive work.
+
+    RATELIMITS maps a scope to (attempts, seconds). The count of the current
+    fixed window is added to the previous window's count weighted by how
+    much of it still overlaps the sliding window, which takes two counters
+    per key instead of a log of timestamps. Counters live in a bounded
+    `MemoryCache` unless RATELIMIT_BACKEND names a `werkzeug.contrib.cache`
+    compatible class (e.g. `RedisCache`) to share them between workers.
+    Every app keeps its own limits and counters in
+    `app.extensions['ratelimit']`.
+    """
+
+    # seconds since the epoch, replaced in tests
+    clock = staticmethod(time.time)
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['RATELIMIT_BACKEND']
+        if backend is None:
+            backend = MemoryCache(app.config['RATELIMIT_MEMORY_SIZE'])
+        else:
+            backend = import_string(backend)(
+                **app.config['RATELIMIT_BACKEND_OPTIONS'])
+        app.extensions['ratelimit'] = _RateLimitState(
+            app.config['RATELIMIT_ENABLED'], app.config['RATELIMITS'],
+            backend)
+
+    @property
+    def state(self):
+        """The `_RateLimitState` of the current app."""
+        return current_app.extensions['ratelimit']
+
+    def hit(self, scope, identity):
+        """Count an attempt by identity, failing with a 429 past the limit."""
+        state = self.state
+        if not state.enabled or not identity:
+            return
+        limit, period = state.limits[scope]
+        now = self.clock()
+        window = int(now // period)
+        key = 'ratelimit:%s:%s:' % (scope, identity)
+        state.backend.add(key + str(window), 0, timeout=2 * period)
+        current = state.backend.inc(key + str(window))
+        previous = state.backend.get(key + str(window - 1)) or 0
+        overlap = 1 - (now % period) / float(period)
+        if previous * overlap + current > limit:
+            RATE_LIMITED.inc(scope=scope)
+            raise RateLimitExceeded()
+
+
+class _RateLimitState(object):
+
+    def __init__(self, enabled, limits, backend):
+        self.enabled = enabled
+        self.limits = limits
+        self.backend = backend
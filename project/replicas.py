@@ -0,0 +1,168 @@
+# project/replicas.py
+
+
+import random
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, session
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy.sql.expression import Select
+
+from project.pool import apply_pool_options
+from project.sharding import SHARDED_TABLES, ShardedQuery, ShardingError, \
+    bucket_shard, instance_bucket, is_shard_bind, is_sharded, shard_bind, \
+    where_buckets
+
+
+# the flask session key holding when the user's reads may leave the primary
+_PRIMARY_UNTIL = '_db_primary_until'
+
+
+def _replica_bind(index):
+    return 'replica%d' % index
+
+
+class RoutingSession(SignallingSession):
+    """Sends the reads of a request to a replica, the rest to the primary.
+
+    Only plain SELECTs made while handling a request are routed, to one
+    replica picked for the whole session; manage.py commands, which
+    Flask-Script runs in a request context of their own, use the primary.
+    Once the session has written, its reads stay on the primary until it
+    ends, and the user's reads stay on the primary for
+    SQLALCHEMY_REPLICA_STICKY_SECONDS after that, so a user always reads
+    their own writes despite the replicas lagging behind.
+
+    With SQLALCHEMY_USER_SHARDS, the users and their reset tokens live on
+    those databases instead, see project/sharding.py. Rows go to the shard
+    of their bucket, queries through a ShardedQuery, and other statements
+    to the shard set with `using_shard`.
+    """
+
+    def __init__(self, db, **options):
+        self._db = db
+        self._replica = None
+        self._wrote = False
+        self.pinned_shard = None
+        self.shard_count = len(db.get_app().config['SQLALCHEMY_USER_SHARDS'])
+        if self.shard_count:
+            options.setdefault('query_cls', ShardedQuery)
+        SignallingSession.__init__(self, db, **options)
+        if self.shard_count:
+            # flushes ask for the connection of every row
+            self.connection_callable = self._connection_for_instance
+
+    def shards(self):
+        """Return the shards, or [None] without sharding."""
+        return list(range(self.shard_count)) or [None]
+
+    @contextmanager
+    def using_shard(self, shard):
+        """Send the sharded statements of the block to `shard`."""
+        pinned, self.pinned_shard = self.pinned_shard, shard
+        try:
+            yield
+        finally:
+            self.pinned_shard = pinned
+
+    def shard_of_bucket(self, bucket):
+        return bucket_shard(bucket, self.shard_count)
+
+    def get_bind(self, mapper=None, clause=None, shard=None, instance=None,
+                 **kw):
+        if self.shard_count and is_sharded(mapper, clause):
+            if shard is None:
+                shard = self._choose_shard(mapper, clause, instance)
+            return self._db.get_engine(self.app, shard_bind(shard))
+        replicas = self.app.config['SQLALCHEMY_REPLICAS']
+        if replicas and _handling_request():
+            if _is_read(clause):
+                if not self._wrote and \
+                        session.get(_PRIMARY_UNTIL, 0) < time.time():
+                    return self._get_replica(len(replicas))
+            else:
+                self._written()
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def _connection_for_instance(self, mapper, instance):
+        return self.connection(mapper, instance=instance)
+
+    def _choose_shard(self, mapper, clause, instance):
+        if self.pinned_shard is not None:
+            return self.pinned_shard
+        if instance is not None:
+            bucket = instance_bucket(mapper, instance)
+            if bucket is not None:
+                return self.shard_of_bucket(bucket)
+        buckets = where_buckets(getattr(clause, '_whereclause', None))
+        if buckets is not None:
+            shards = set(self.shard_of_bucket(bucket) for bucket in buckets)
+            if len(shards) == 1:
+                return shards.pop()
+        raise ShardingError(
+            'No single shard for %s, run it in db.session().using_shard()'
+            % (clause if clause is not None else mapper))
+
+    def _get_replica(self, count):
+        if self._replica is None:
+            self._replica = self._db.get_engine(
+                self.app, _replica_bind(random.randrange(count)))
+        return self._replica
+
+    def _written(self):
+        if not self._wrote:
+            self._wrote = True
+            session[_PRIMARY_UNTIL] = time.time() + \
+                self.app.config['SQLALCHEMY_REPLICA_STICKY_SECONDS']
+
+
+def _start_request():
+    g._db_route_reads = True
+
+
+def _handling_request():
+    return has_request_context() and getattr(g, '_db_route_reads', False)
+
+
+def _is_read(clause):
+    # SELECT ... FOR UPDATE takes locks on the primary
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with SQLALCHEMY_REPLICAS and _USER_SHARDS as binds.
+
+    `create_all` and `drop_all` also create the sharded tables on every
+    shard.
+
+    Every engine, replicas included, gets the pool options of
+    project/pool.py.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICAS', [])
+        app.config.setdefault('SQLALCHEMY_REPLICA_STICKY_SECONDS', 10)
+        app.config.setdefault('SQLALCHEMY_USER_SHARDS', [])
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for index, uri in enumerate(app.config['SQLALCHEMY_REPLICAS']):
+            binds[_replica_bind(index)] = uri
+        for index, uri in enumerate(app.config['SQLALCHEMY_USER_SHARDS']):
+            binds[shard_bind(index)] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds
+        if app.config['SQLALCHEMY_REPLICAS']:
+            app.before_request(_start_request)
+        SQLAlchemy.init_app(self, app)
+
+    def get_tables_for_bind(self, bind=None):
+        if is_shard_bind(bind):
+            return [self.Model.metadata.tables[name]
+                    for name in SHARDED_TABLES]
+        return SQLAlchemy.get_tables_for_bind(self, bind)
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        apply_pool_options(app, info, options)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
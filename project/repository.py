@@ -0,0 +1,68 @@
+# project/repository.py
+
+
+import datetime
+
+from flask import g
+
+from project.models import User, PasswordResetToken, normalize_email
+from project.password_reset import check_reset_token
+
+
+def _identity_map():
+    users = getattr(g, '_users', None)
+    if users is None:
+        users = g._users = {}
+    return users
+
+
+def get_user(user_id):
+    """Return the user with the given id, querying at most once a request."""
+    users = _identity_map()
+    key = ('id', int(user_id))
+    if key not in users:
+        _remember(users, key, User.query.get(int(user_id)))
+    return users[key]
+
+
+def get_user_by_email(email):
+    """Return the user with the given email, querying at most once a request.
+
+    Emails are matched case-insensitively through `User.normalized_email`.
+    """
+    users = _identity_map()
+    key = ('email', normalize_email(email))
+    if key not in users:
+        _remember(users, key, User.query.filter_by(
+            normalized_email=key[1]).first())
+    return users[key]
+
+
+def get_user_by_reset_token(token):
+    """Return the user an unexpired reset token was issued to.
+
+    Looks the token's digest up in the same query as the user.
+    """
+    digest = check_reset_token(token)
+    if digest is None:
+        return None
+    user = User.query.join(
+        PasswordResetToken, PasswordResetToken.user_id == User.id
+    ).filter(
+        PasswordResetToken.digest == digest,
+        PasswordResetToken.expires_on > datetime.datetime.now()
+    ).first()
+    if user is not None:
+        _remember(_identity_map(), ('id', user.id), user)
+    return user
+
+
+def clear(exception=None):
+    g._users = None
+
+
+def _remember(users, key, user):
+    users[key] = user
+    if user is not None:
+        users[('id', user.id)] = user
+        users[('email', user.normalized_email)] = user
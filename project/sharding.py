@@ -0,0 +1,232 @@
+# project/sharding.py
+
+
+import hashlib
+import random
+import time
+
+from flask.ext.sqlalchemy import BaseQuery
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import BinaryExpression, BindParameter, \
+    BooleanClauseList, ColumnClause, Grouping
+from sqlalchemy.sql.util import find_tables
+
+
+# Users are split into BUCKETS buckets by a hash of their email, and the
+# bucket is kept in the low bits of their id. Shards hold whole buckets, so
+# a user is found from either key and moving buckets keeps every id.
+BUCKETS = 1024
+# ids are milliseconds since _EPOCH, 12 random bits and the bucket
+_EPOCH = 1420070400000
+
+# queued emails live with their recipient, so a user and the emails about
+# them are committed in one transaction on one database
+SHARDED_TABLES = ('users', 'password_reset_tokens', 'email_outbox')
+
+# the columns that tell the bucket of a row, by table, in order of preference
+_BUCKET_COLUMNS = {
+    'users': ('id', 'normalized_email'),
+    'password_reset_tokens': ('user_id',),
+    'email_outbox': ('recipient',),
+}
+
+
+class ShardingError(Exception):
+    """A statement could not be sent to a single shard."""
+
+
+def shard_bind(index):
+    return 'users_shard%d' % index
+
+
+def is_shard_bind(bind):
+    return bind is not None and bind.startswith('users_shard')
+
+
+def email_bucket(normalized_email):
+    # a stable hash, unlike hash() it is the same in every process
+    digest = hashlib.md5(normalized_email.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % BUCKETS
+
+
+def id_bucket(user_id):
+    return int(user_id) % BUCKETS
+
+
+def new_user_id(bucket, sequence=None):
+    """Return a new 63 bit user id in the bucket.
+
+    Bulk inserts pass a counter as `sequence` instead of the random bits,
+    so the ids of one batch never collide.
+    """
+    milliseconds = int(time.time() * 1000) - _EPOCH
+    if sequence is None:
+        sequence = random.getrandbits(12)
+    return (milliseconds << 22) | ((sequence & 0xFFF) << 10) | bucket
+
+
+def bucket_shard(bucket, shards):
+    """Return the shard of a bucket.
+
+    Jump consistent hashing: going from n to n + 1 shards moves only the
+    buckets that the new shard takes over.
+    """
+    key = bucket
+    shard, candidate = -1, 0
+    while candidate < shards:
+        shard = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((shard + 1) * (float(1 << 31) / ((key >> 33) + 1)))
+    return shard
+
+
+def is_sharded(mapper=None, clause=None):
+    """Whether a mapper or statement is about the sharded tables."""
+    if mapper is not None:
+        return mapper.mapped_table.name in SHARDED_TABLES
+    if clause is not None:
+        return any(table.name in SHARDED_TABLES
+                   for table in find_tables(clause, include_crud=True))
+    return False
+
+
+def instance_bucket(mapper, instance):
+    """Return the bucket of a mapped row, or None if it cannot tell."""
+    for column in _BUCKET_COLUMNS.get(mapper.mapped_table.name, ()):
+        value = getattr(instance, column, None)
+        if value is not None:
+            return _bucket(column, value)
+    return None
+
+
+def where_buckets(whereclause, params=None):
+    """Return the buckets a WHERE clause limits rows to, or None for all.
+
+    Only conditions ANDed at the top, of the form `column == value` or
+    `column IN (values)` on a column of _BUCKET_COLUMNS, are understood.
+    """
+    if whereclause is None:
+        return None
+    if isinstance(whereclause, BooleanClauseList) and \
+            whereclause.operator is operators.and_:
+        conditions = whereclause.clauses
+    else:
+        conditions = [whereclause]
+    for condition in conditions:
+        buckets = _condition_buckets(condition, params or {})
+        if buckets is not None:
+            return buckets
+    return None
+
+
+def _condition_buckets(condition, params):
+    if not isinstance(condition, BinaryExpression) or \
+            not isinstance(condition.left, ColumnClause) or \
+            condition.left.table is None:
+        return None
+    column = condition.left
+    if column.name not in _BUCKET_COLUMNS.get(column.table.name, ()):
+        return None
+    if condition.operator is operators.eq:
+        binds = [condition.right]
+    elif condition.operator is operators.in_op and \
+            isinstance(condition.right, Grouping):
+        binds = condition.right.element.clauses
+    else:
+        return None
+    if not all(isinstance(bind, BindParameter) for bind in binds):
+        return None
+    values = [params.get(bind.key, bind.value) for bind in binds]
+    if None in values:
+        return None
+    return set(_bucket(column.name, value) for value in values)
+
+
+def _bucket(column, value):
+    if column == 'normalized_email':
+        return email_bucket(value)
+    if column == 'recipient':
+        # normalized as in project/models.py
+        return email_bucket(value.strip().lower())
+    return id_bucket(value)
+
+
+class ShardedQuery(BaseQuery):
+    """Queries the shards that can hold the rows asked for.
+
+    A query of a sharded model limited to ids, emails or user ids, see
+    `where_buckets`, runs on their shards, any other runs on every shard
+    with the results of each shard in turn; ordering, limits and offsets
+    apply per shard. Other queries, and any without SQLALCHEMY_USER_SHARDS,
+    are plain queries.
+    """
+
+    _shard = None
+
+    def set_shard(self, shard):
+        """Return the query limited to one shard."""
+        query = self._clone()
+        query._shard = shard
+        return query
+
+    def get(self, ident):
+        shards = self._get_shards()
+        if shards is None or self._shard is not None:
+            return super(ShardedQuery, self).get(ident)
+        return super(ShardedQuery, self.set_shard(
+            self.session.shard_of_bucket(id_bucket(ident)))).get(ident)
+
+    def count(self):
+        shards = self._get_shards()
+        if shards is None:
+            return super(ShardedQuery, self).count()
+        # the count wraps the query in one that has no mapper to route by
+        count = 0
+        for shard in shards:
+            with self.session.using_shard(shard):
+                count += super(ShardedQuery, self).count()
+        return count
+
+    def delete(self, synchronize_session='evaluate'):
+        return self._on_each_shard(BaseQuery.delete, synchronize_session)
+
+    def update(self, values, synchronize_session='evaluate'):
+        return self._on_each_shard(
+            BaseQuery.update, values, synchronize_session)
+
+    def _execute_and_instances(self, context):
+        shards = self._get_shards()
+        if shards is None:
+            return super(ShardedQuery, self)._execute_and_instances(context)
+        rows = []
+        for shard in shards:
+            result = self._connection_from_session(
+                mapper=self._mapper_zero(), shard=shard).execute(
+                context.statement, self._params)
+            rows.extend(self.instances(result, context))
+        return iter(rows)
+
+    def _on_each_shard(self, operation, *args):
+        # bulk updates and deletes only go through Session.execute
+        shards = self._get_shards()
+        if shards is None:
+            return operation(self, *args)
+        rows = 0
+        for shard in shards:
+            with self.session.using_shard(shard):
+                rows += operation(self, *args)
+        return rows
+
+    def _get_shards(self):
+        count = getattr(self.session, 'shard_count', 0)
+        if not count or not is_sharded(self._mapper_zero_or_none()):
+            return None
+        if self._shard is not None:
+            return [self._shard]
+        if self.session.pinned_shard is not None:
+            return [self.session.pinned_shard]
+        buckets = where_buckets(self._criterion, self._params)
+        if buckets is None:
+            return list(range(count))
+        return sorted(set(self.session.shard_of_bucket(bucket)
+                          for bucket in buckets))
@@ -0,0 +1,107 @@
+# project/timing.py
+
+
+import json
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from jinja2 import Template
+
+from project.queries import on_statement
+
+
+# order of the phases in the Server-Timing header
+PHASES = ('db', 'bcrypt', 'template', 'mail')
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to `phase` of the current request."""
+    timings = _timings()
+    if timings is None:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        _add(timings, phase, time.time() - started)
+
+
+class TimedTemplate(Template):
+
+    def render(self, *args, **kwargs):
+        with timed('template'):
+            return Template.render(self, *args, **kwargs)
+
+
+class ServerTiming(object):
+    """Times the phases of every request and reports them.
+
+    With SERVER_TIMING_ENABLED the time spent in SQL, bcrypt, template
+    rendering and queueing mail is added to each response as a
+    `Server-Timing` header, and logged as one JSON line if SERVER_TIMING_LOG
+    is set. When disabled nothing is registered, so the only cost left is a
+    context check in `timed`.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['SERVER_TIMING_ENABLED']:
+            return
+        app.jinja_env.template_class = TimedTemplate
+        app.before_request(self._start)
+        app.after_request(self._report)
+        on_statement(_add_query)
+
+    def _start(self):
+        g._timings = {}
+        g._timings_started = time.time()
+
+    def _report(self, response):
+        timings = _timings()
+        if timings is None:
+            return response
+        total = time.time() - g._timings_started
+        metrics = []
+        for phase in PHASES:
+            if phase in timings:
+                seconds, count = timings[phase]
+                metrics.append('%s;dur=%.2f;desc="%d call%s"' % (
+                    phase, seconds * 1000, count, '' if count == 1 else 's'))
+        metrics.append('total;dur=%.2f' % (total * 1000))
+        response.headers['Server-Timing'] = ', '.join(metrics)
+        if current_app.config['SERVER_TIMING_LOG']:
+            record = dict(
+                (phase, round(seconds * 1000, 2))
+                for phase, (seconds, count) in timings.items())
+            record.update(
+                endpoint=request.endpoint,
+                method=request.method,
+                status=response.status_code,
+                total=round(total * 1000, 2),
+                queries=timings.get('db', (0, 0))[1])
+            current_app.logger.info(json.dumps(record, sort_keys=True))
+        g._timings = None
+        return response
+
+
+def _timings():
+    if not has_request_context():
+        return None
+    return getattr(g, '_timings', None)
+
+
+def _add(timings, phase, seconds):
+    total, count = timings.get(phase, (0.0, 0))
+    timings[phase] = (total + seconds, count + 1)
+
+
+def _add_query(engine, statement, parameters, seconds):
+    timings = _timings()
+    if timings is not None:
+        _add(timings, 'db', seconds)
@@ -1,23 +1,117 @@
 # project/token.py
 
-from itsdangerous import URLSafeTimedSerializer
+from collections import namedtuple
 
-from project import app
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer, TimestampSigner, \
+    BadData, BadSignature, SignatureExpired
+
+
+# statuses of a checked token
+OK = 'ok'
+EXPIRED = 'expired'
+BAD_SIGNATURE = 'bad_signature'
+
+
+class TokenResult(namedtuple('TokenResult', 'status value')):
+    """Outcome of checking a token, `value` is only set when it is OK."""
+
+    @property
+    def ok(self):
+        return self.status == OK
+
+
+class _Serializer(URLSafeTimedSerializer):
+    # signers keep no state between calls, so the one for the serializer's
+    # own salt is reused
+
+    def make_signer(self, salt=None):
+        if salt is not None and salt != self.salt:
+            return URLSafeTimedSerializer.make_signer(self, salt)
+        signer = getattr(self, '_signer', None)
+        if signer is None:
+            signer = self._signer = URLSafeTimedSerializer.make_signer(self)
+        return signer
+
+
+class TokenService(object):
+    """Signs and checks the tokens sent by email.
+
+    Every purpose ('confirm', 'reset') gets its own salt, so that a token
+    made for one can not be used for another. Tokens are signed with
+    SECRET_KEY and also accepted when signed with one of the retired keys in
+    SECRET_KEY_FALLBACKS, which allows rotating the key without breaking the
+    links already sent.
+
+    A serializer is created once per key and purpose, with its signing key
+    derived up front rather than on every call.
+    """
+
+    def __init__(self):
+        self._serializers = {}
+
+    def dumps(self, purpose, value):
+        return self._get_serializers(purpose)[0].dumps(value)
+
+    def loads(self, purpose, token, max_age):
+        for serializer in self._get_serializers(purpose):
+            try:
+                value = serializer.loads(token, max_age=max_age)
+            except SignatureExpired:
+                return TokenResult(EXPIRED, None)
+            except BadSignature:
+                # signed with another key, or not by us
+                continue
+            except BadData:
+                break
+            return TokenResult(OK, value)
+        return TokenResult(BAD_SIGNATURE, None)
+
+    def _get_serializers(self, purpose):
+        config = current_app.config
+        salt = _salt(config['SECURITY_PASSWORD_SALT'], purpose)
+        keys = [config['SECRET_KEY']] + list(config['SECRET_KEY_FALLBACKS'])
+        return [self._get_serializer(key, salt) for key in keys]
+
+    def _get_serializer(self, secret_key, salt):
+        serializer = self._serializers.get((secret_key, salt))
+        if serializer is None:
+            # the same signatures as URLSafeTimedSerializer(secret_key)
+            key = TimestampSigner(secret_key, salt=salt).derive_key()
+            serializer = _Serializer(
+                key, salt=salt, signer_kwargs={'key_derivation': 'none'})
+            self._serializers[(secret_key, salt)] = serializer
+        return serializer
+
+
+def _salt(salt, purpose):
+    # confirmation tokens keep the plain salt, so links sent before
+    # tokens were scoped still work
+    if purpose == 'confirm':
+        return salt
+    return salt + '.' + purpose
+
+
+tokens = TokenService()
 
 
 def generate_confirmation_token(email):
-    serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
-    return serializer.dumps(email, salt=app.config['SECURITY_PASSWORD_SALT'])
+    return tokens.dumps('confirm', email)
 
 
 def confirm_token(token, expiration=3600):
-    serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
-    try:
-        email = serializer.loads(
-            token,
-            salt=app.config['SECURITY_PASSWORD_SALT'],
-            max_age=expiration
-        )
-    except:
+    result = tokens.loads('confirm', token, expiration)
+    if not result.ok:
+        return False
+    return result.value
+
+
+def generate_password_reset_token(nonce):
+    return tokens.dumps('reset', nonce)
+
+
+def confirm_password_reset_token(token, expiration=3600):
+    result = tokens.loads('reset', token, expiration)
+    if not result.ok:
         return False
-    return email
+    return result.value
@@ -5,7 +5,7 @@ from flask_wtf import Form
 from wtforms import TextField, PasswordField
 from wtforms.validators import DataRequired, Email, Length, EqualTo
 
-from project.models import User
+from project.repository import get_user_by_email
 
 
 class LoginForm(Form):
@@ -29,16 +29,6 @@ class RegisterForm(Form):
         ]
     )
 
-    def validate(self):
-        initial_validation = super(RegisterForm, self).validate()
-        if not initial_validation:
-            return False
-        user = User.query.filter_by(email=self.email.data).first()
-        if user:
-            self.email.errors.append("Email already registered")
-            return False
-        return True
-
 
 class ForgotForm(Form):
     email = TextField(
@@ -49,7 +39,7 @@ class ForgotForm(Form):
         initial_validation = super(ForgotForm, self).validate()
         if not initial_validation:
             return False
-        user = User.query.filter_by(email=self.email.data).first()
+        user = get_user_by_email(self.email.data)
         if not user:
             self.email.errors.append("This email is not registered")
             return False
@@ -8,15 +8,21 @@
 import datetime
 
 from flask import render_template, Blueprint, url_for, \
-    redirect, flash, request
+    redirect, flash, request, abort
 from flask_login import login_user, logout_user, \
     login_required, current_user
+from sqlalchemy.exc import IntegrityError
 
-from project.models import User
+from project.models import User, normalize_email
 from project.email import send_email
+from project.repository import get_user, get_user_by_email, \
+    get_user_by_reset_token
 from project.token import generate_confirmation_token, confirm_token
+from project.password_reset import issue_reset_token, use_reset_tokens
 from project.decorators import check_confirmed
-from project import db, bcrypt
+from project.metrics.registry import LOGINS, REGISTRATIONS, \
+    CONFIRMATIONS, PASSWORD_RESETS
+from project import db, hasher, user_cache, limiter
 from .forms import LoginForm, RegisterForm, ChangePasswordForm, ForgotForm
 
 
@@ -41,13 +47,25 @@ def register():
             confirmed=False
         )
         db.session.add(user)
-        db.session.commit()
 
         token = generate_confirmation_token(user.email)
         confirm_url = url_for('user.confirm_email', token=token, _external=True)
         html = render_template('user/activate.html', confirm_url=confirm_url)
         subject = "Please confirm your email"
         send_email(user.email, subject, html)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # duplicates are caught by the unique index instead of a SELECT,
+            # at the price of hashing their password first; the driver's
+            # message does not say which constraint failed, so look again
+            db.session.rollback()
+            if User.query.filter_by(
+                    normalized_email=user.normalized_email).first() is None:
+                raise
+            form.email.errors.append("Email already registered")
+            return render_template('user/register.html', form=form)
+        REGISTRATIONS.inc()
 
         login_user(user)
 
@@ -61,13 +79,23 @@ def register():
 def login():
     form = LoginForm(request.form)
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
-        if user and bcrypt.check_password_hash(
+        limiter.hit('login_ip', request.remote_addr)
+        limiter.hit('login_email', normalize_email(form.email.data))
+        user = get_user_by_email(form.email.data)
+        if user and hasher.check_password_hash(
                 user.password, request.form['password']):
+            if hasher.needs_rehash(user.password):
+                # upgrade (or downgrade) the hash to the configured cost
+                user.password = hasher.generate_password_hash(
+                    request.form['password'])
+                db.session.commit()
+                user_cache.invalidate(user.id)
             login_user(user)
+            LOGINS.inc(result='success')
             flash('Welcome.', 'success')
             return redirect(url_for('main.home'))
         else:
+            LOGINS.inc(result='failure')
             flash('Invalid email and/or password.', 'danger')
             return render_template('user/login.html', form=form)
     return render_template('user/login.html', form=form)
@@ -87,10 +115,11 @@ def logout():
 def profile():
     form = ChangePasswordForm(request.form)
     if form.validate_on_submit():
-        user = User.query.filter_by(email=current_user.email).first()
+        user = get_user(current_user.id)
         if user:
-            user.password = bcrypt.generate_password_hash(form.password.data)
+            user.password = hasher.generate_password_hash(form.password.data)
             db.session.commit()
+            user_cache.invalidate(user.id)
             flash('Password successfully changed.', 'success')
             return redirect(url_for('user.profile'))
         else:
@@ -106,12 +135,16 @@ def confirm_email(token):
         flash('Account already confirmed. Please login.', 'success')
         return redirect(url_for('main.home'))
     email = confirm_token(token)
-    user = User.query.filter_by(email=current_user.email).first_or_404()
+    user = get_user(current_user.id)
+    if user is None:
+        abort(404)
     if user.email == email:
         user.confirmed = True
         user.confirmed_on = datetime.datetime.now()
         db.session.add(user)
         db.session.commit()
+        user_cache.invalidate(user.id)
+        CONFIRMATIONS.inc()
         flash('You have confirmed your account. Thanks!', 'success')
     else:
         flash('The confirmation link is invalid or has expired.', 'danger')
@@ -130,24 +163,28 @@ def unconfirmed():
 @user_blueprint.route('/resend')
 @login_required
 def resend_confirmation():
+    limiter.hit('resend_ip', request.remote_addr)
+    limiter.hit('resend_user', current_user.id)
     token = generate_confirmation_token(current_user.email)
     confirm_url = url_for('user.confirm_email', token=token, _external=True)
     html = render_template('user/activate.html', confirm_url=confirm_url)
     subject = "Please confirm your email"
     send_email(current_user.email, subject, html)
+    db.session.commit()
     flash('A new confirmation email has been sent.', 'success')
     return redirect(url_for('user.unconfirmed'))
 
 @user_blueprint.route('/forgot',  methods=['GET', 'POST'])
 def forgot():
     form = ForgotForm(request.form)
+    if request.method == 'POST':
+        # before validating, which already looks the email up
+        limiter.hit('forgot_ip', request.remote_addr)
+        limiter.hit('forgot_email', normalize_email(form.email.data or ''))
     if form.validate_on_submit():
 
-        user = User.query.filter_by(email=form.email.data).first()
-        token = generate_confirmation_token(user.email)
-
-        user.password_reset_token = token
-        db.session.commit()
+        user = get_user_by_email(form.email.data)
+        token = issue_reset_token(user)
 
         reset_url = url_for('user.forgot_new', token=token, _external=True)
         html = render_template('user/reset.html',
@@ -155,6 +192,8 @@ def forgot():
                                reset_url=reset_url)
         subject = "Reset your password"
         send_email(user.email, subject, html)
+        db.session.commit()
+        PASSWORD_RESETS.inc(stage='requested')
 
         flash('A password reset email has been sent via email.', 'success')
         return redirect(url_for("main.home"))
@@ -165,30 +204,27 @@ def forgot():
 @user_blueprint.route('/forgot/new/<token>', methods=['GET', 'POST'])
 def forgot_new(token):
 
-    email = confirm_token(token)
-    user = User.query.filter_by(email=email).first_or_404()
-
-    if user.password_reset_token is not None:
-        form = ChangePasswordForm(request.form)
-        if form.validate_on_submit():
-            user = User.query.filter_by(email=email).first()
-            if user:
-                user.password = bcrypt.generate_password_hash(form.password.data)
-                user.password_reset_token = None
-                db.session.commit()
+    user = get_user_by_reset_token(token)
+    if user is None:
+        # unknown, used or expired
+        flash('Can not reset the password, try again.', 'danger')
+        return redirect(url_for('main.home'))
 
-                login_user(user)
+    form = ChangePasswordForm(request.form)
+    if form.validate_on_submit():
+        if not use_reset_tokens(user.id):
+            # used by another request in the meantime
+            flash('Can not reset the password, try again.', 'danger')
+            return redirect(url_for('main.home'))
+        user.password = hasher.generate_password_hash(form.password.data)
+        db.session.commit()
+        user_cache.invalidate(user.id)
+        PASSWORD_RESETS.inc(stage='completed')
 
-                flash('Password successfully changed.', 'success')
-                return redirect(url_for('user.profile'))
+        login_user(user)
 
-            else:
-                flash('Password change was unsuccessful.', 'danger')
-                return redirect(url_for('user.profile'))
-        else:
-            flash('You can now change your password.', 'success')
-            return render_template('user/forgot_new.html', form=form)
+        flash('Password successfully changed.', 'success')
+        return redirect(url_for('user.profile'))
     else:
-        flash('Can not reset the password, try again.', 'danger')
-
-    return redirect(url_for('main.home'))
+        flash('You can now change your password.', 'success')
+        return render_template('user/forgot_new.html', form=form)
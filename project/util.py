@@ -1,30 +1,208 @@
 # project/util.py
 
 
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+from contextlib import contextmanager
+
+from flask import _app_ctx_stack
 from flask.ext.testing import TestCase
+from sqlalchemy import event, orm
 
-from project import app, db
+from project import create_app, db, user_cache
+from project.config import TestingConfig
 from project.models import User
+from project.queries import QueryRecorder, RepeatedQueryWarning
+from project.replicas import RoutingSession
 
 
-class BaseTestCase(TestCase):
+app = create_app('project.config.TestingConfig')
 
-    def create_app(self):
-        app.config.from_object('project.config.TestingConfig')
-        return app
+# a statement repeated within a request fails the test that made it
+warnings.simplefilter('error', RepeatedQueryWarning)
+
+
+def _enable_sqlite_savepoints(engine):
+    # pysqlite begins and commits transactions on its own, which breaks
+    # SAVEPOINT, so let SQLAlchemy emit BEGIN instead
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(connection):
+        connection.execute('BEGIN')
+
+
+class _TestSession(RoutingSession):
+    # routes statements like the app's session, then runs them on the
+    # test's connection to the engine it picked
+
+    def __init__(self, db, connection_for, **options):
+        self._connection_for = connection_for
+        RoutingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        return self._connection_for(
+            RoutingSession.get_bind(self, mapper, clause, **kw))
+
+
+_SAVEPOINT_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT',
+                         'ROLLBACK TO SAVEPOINT')
 
-    @classmethod
-    def setUpClass(self):
+
+def _restart_savepoint(session, transaction):
+    # the code under test committed or rolled back the SAVEPOINT
+    if transaction.nested and not transaction._parent.nested:
+        session.begin_nested()
+
+
+# engines whose SQLite connections take SAVEPOINTs
+_savepoint_engines = set()
+
+
+def _create_database():
+    """Create the schema and the test user, once per process."""
+    with app.app_context():
+        if db.engine.name == 'sqlite':
+            _enable_sqlite_savepoints(db.engine)
+            _savepoint_engines.add(db.engine)
         db.create_all()
-        user = User(
+        db.session.add(User(
             email="test@user.com",
             password="just_a_test_user",
             confirmed=False
-        )
-        db.session.add(user)
+        ))
         db.session.commit()
-
-    @classmethod
-    def tearDownClass(self):
         db.session.remove()
-        db.drop_all()
+
+_create_database()
+
+
+class BaseTestCase(TestCase):
+    """Runs every test in a transaction that is rolled back afterwards.
+
+    The session of the test, and of any request it makes, routes statements
+    as usual but runs them on a connection with an open transaction to the
+    database it picked, and always works inside a SAVEPOINT, so the commits
+    and rollbacks of the code under test only release or undo that
+    SAVEPOINT.
+    """
+
+    def create_app(self):
+        return app
+
+    def _pre_setup(self):
+        super(BaseTestCase, self)._pre_setup()
+        user_cache.clear()
+        self._connections = {}
+        self._connection_for(db.engine)
+
+        factory = orm.sessionmaker(
+            class_=_TestSession, db=db, connection_for=self._connection_for,
+            expire_on_commit=False)
+        event.listen(factory, 'after_transaction_end', _restart_savepoint)
+
+        def create_session():
+            session = factory()
+            session.begin_nested()
+            return session
+
+        self._session = db.session
+        db.session = orm.scoped_session(
+            create_session, scopefunc=_app_ctx_stack.__ident_func__)
+
+    def _post_teardown(self):
+        try:
+            # while the app context is still pushed
+            user_cache.clear()
+            super(BaseTestCase, self)._post_teardown()
+        finally:
+            db.session.remove()
+            db.session = self._session
+            for connection, transaction in self._connections.values():
+                transaction.rollback()
+                connection.close()
+
+    def _connection_for(self, engine):
+        if engine not in self._connections:
+            if engine.name == 'sqlite' and engine not in _savepoint_engines:
+                _enable_sqlite_savepoints(engine)
+                _savepoint_engines.add(engine)
+                # pooled connections were opened without the hooks
+                engine.dispose()
+            connection = engine.connect()
+            self._connections[engine] = (connection, connection.begin())
+        return self._connections[engine][0]
+
+    @contextmanager
+    def assertMaxQueries(self, n):
+        """Fail if the block runs more than n SQL statements.
+
+        The SAVEPOINTs of the test's transaction are not counted.
+        """
+        with QueryRecorder(db.engine, ignore=_SAVEPOINT_STATEMENTS) as queries:
+            yield queries
+        self.assertTrue(
+            queries.count <= n,
+            '%d queries, expected at most %d:\n%s' % (queries.count, n, queries))
+
+
+def create_temporary_app(tmpdir, blueprints=(), **settings):
+    """Create an app whose databases are SQLite files in `tmpdir`.
+
+    `settings` override TestingConfig, the primary database is
+    `primary.sqlite` unless given, and `blueprints` are registered on the
+    app. Nothing is created, call `db.create_all(app=app)` for the schema.
+    """
+    options = dict(SQLALCHEMY_DATABASE_URI=temporary_uri(tmpdir, 'primary'))
+    options.update(settings)
+    app = create_app(type('TemporaryConfig', (TestingConfig,), options))
+    for blueprint in blueprints:
+        app.register_blueprint(blueprint)
+    return app
+
+
+def temporary_uri(tmpdir, name):
+    return 'sqlite:///' + os.path.join(tmpdir, name + '.sqlite')
+
+
+def dispose_engines(app):
+    """Close the pooled connections of every database of `app`."""
+    with app.app_context():
+        for bind in [None] + list(app.config['SQLALCHEMY_BINDS']):
+            db.get_engine(app, bind).dispose()
+
+
+class TemporaryDatabaseTestCase(unittest.TestCase):
+    """Runs every test on an app of its own with fresh SQLite files.
+
+    For tests that need real engines, such as replicas, shards or a small
+    pool, which the shared connection of BaseTestCase would hide.
+    `settings()` returns the config of `self.app`, `create_app` makes
+    another one on the same files, and `blueprints` are registered on them.
+    """
+
+    blueprints = ()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = self.create_app()
+
+    def tearDown(self):
+        dispose_engines(self.app)
+        shutil.rmtree(self.tmpdir)
+
+    def settings(self):
+        return {}
+
+    def create_app(self, **settings):
+        options = self.settings()
+        options.update(settings)
+        return create_temporary_app(self.tmpdir, self.blueprints, **options)
+
+    def uri(self, name):
+        return temporary_uri(self.tmpdir, name)
@@ -0,0 +1,64 @@
+# project/warmup.py
+
+
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+
+def set_bytecode_cache(app):
+    """Keep compiled templates in JINJA_BYTECODE_CACHE_DIR.
+
+    Workers started later load the compiled templates from there instead of
+    parsing them again. The cache is keyed on the template source, so it is
+    safe to keep it between deploys.
+    """
+    directory = app.config['JINJA_BYTECODE_CACHE_DIR']
+    if not directory:
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def warm_up(app):
+    """Do the work of a worker's first request before it serves one.
+
+    Compiles every template of the app, opens a database connection and
+    returns it to the pool, sorts the URL map and creates a token. Returns
+    the time taken by each step in seconds. This runs in the process calling
+    `create_app`, so with a preforking server that loads the app before
+    forking it should be left to the workers.
+    """
+    timings = {}
+
+    started = time.time()
+    for name in app.jinja_loader.list_templates():
+        app.jinja_env.get_template(name)
+    timings['templates'] = time.time() - started
+
+    started = time.time()
+    app.url_map.update()
+    timings['urls'] = time.time() - started
+
+    # imported here, both need the app to have been created
+    from project import db
+    from project.token import generate_confirmation_token
+
+    with app.app_context():
+        started = time.time()
+        try:
+            db.engine.connect().close()
+        except Exception:
+            # the first request will report it, the app can still start
+            app.logger.exception('warm-up: could not connect to the database')
+        timings['db'] = time.time() - started
+
+        started = time.time()
+        generate_confirmation_token('warm-up@example.com')
+        timings['token'] = time.time() - started
+
+    app.logger.info('warm-up: ' + ', '.join(
+        '%s %.1f ms' % (step, 1000 * timings[step]) for step in sorted(timings)))
+    return timings
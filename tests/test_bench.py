@@ -0,0 +1,37 @@
+# tests/test_bench.py
+
+
+import unittest
+
+from project.bench import measure, compare, report
+
+
+class TestBench(unittest.TestCase):
+
+    def test_measure(self):
+        # Ensure a function is timed in loops with statistics per call.
+        calls = []
+        stats = measure(lambda: calls.append(1), warmup=0, repeat=3,
+                        min_time=0.001)
+        self.assertTrue(len(calls) > stats['calls'])
+        self.assertTrue(stats['calls'] % 3 == 0)
+        self.assertTrue(stats['min'] <= stats['median'] <= stats['min'] * 100)
+        self.assertTrue(stats['stdev'] >= 0)
+
+    def test_compare(self):
+        # Ensure only medians slower than the threshold are regressions.
+        baseline = report({
+            'fast': {'median': 1.0},
+            'slow': {'median': 1.0},
+        })
+        results = {
+            'fast': {'median': 1.2},
+            'slow': {'median': 1.3},
+            'new': {'median': 5.0},
+        }
+        self.assertTrue(compare(results, baseline, 0.25) ==
+                        [('slow', 1.0, 1.3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
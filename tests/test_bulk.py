@@ -0,0 +1,250 @@
+# tests/test_bulk.py
+
+
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from project import db, hasher
+from project.bulk import import_users, export_users, seed_users, \
+    backfill_normalized_emails, SEED_PASSWORDS
+from project.models import User
+from project.util import BaseTestCase, TemporaryDatabaseTestCase
+
+
+class TestImportUsers(BaseTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_import_csv(self):
+        # Ensure passwords are hashed and existing emails skipped.
+        pw_hash = hasher.generate_password_hash('prehashed')
+        path = self.write('users.csv', '\n'.join([
+            'email,password,password_hash,confirmed,registered_on',
+            'one@import.com,first_password,,true,2014-01-02 03:04:05',
+            'Two@Import.com,,%s,false,' % pw_hash,
+            'TEST@user.com,whatever,,true,',
+        ]))
+        imported, skipped = import_users(path, workers=1)
+        self.assertTrue((imported, skipped) == (2, 1))
+        one = User.query.filter_by(normalized_email='one@import.com').first()
+        self.assertTrue(one.confirmed)
+        self.assertTrue(one.registered_on.year == 2014)
+        self.assertTrue(hasher.check_password_hash(one.password,
+                                                   'first_password'))
+        two = User.query.filter_by(normalized_email='two@import.com').first()
+        self.assertTrue(two.email == 'Two@Import.com')
+        self.assertTrue(two.password == pw_hash)
+        self.assertFalse(two.confirmed)
+
+    def test_import_resumes_from_checkpoint(self):
+        # Ensure a second run continues after the last committed batch.
+        path = self.write('users.jsonl', '\n'.join(
+            json.dumps(dict(email='user%d@resume.com' % i, password='secret'))
+            for i in range(5)))
+        self.write('users.jsonl.checkpoint', '3')
+        seen = []
+        imported, skipped = import_users(
+            path, batch_size=1, workers=1,
+            progress=lambda *counts: seen.append(counts))
+        self.assertTrue((imported, skipped) == (2, 0))
+        self.assertTrue(seen == [(4, 1, 0), (5, 2, 0)])
+        self.assertTrue(User.query.filter(
+            User.email.like('%@resume.com')).count() == 2)
+        with open(path + '.checkpoint') as f:
+            self.assertTrue(f.read() == '5')
+
+    def test_import_refuses_a_stale_checkpoint(self):
+        # Ensure a checkpoint past the end of the file is an error.
+        path = self.write('users.jsonl', json.dumps(
+            dict(email='user@stale.com', password='secret')))
+        self.write('users.jsonl.checkpoint', '3')
+        with self.assertRaises(ValueError) as context:
+            import_users(path, workers=1)
+        self.assertIn('does not match the input', str(context.exception))
+        self.assertTrue(User.query.filter_by(
+            email='user@stale.com').count() == 0)
+
+
+class TestExportUsers(BaseTestCase):
+
+    def setUp(self):
+        User.query.filter(User.email != 'test@user.com').delete(
+            synchronize_session=False)
+        for i in range(5):
+            db.session.add(User(
+                email='user%d@export.com' % i,
+                password='exported',
+                confirmed=i % 2 == 0,
+                confirmed_on=None
+            ))
+        db.session.commit()
+
+    def test_export_jsonl_pages(self):
+        # Ensure every user is written once across pages.
+        out = io.StringIO()
+        self.assertTrue(export_users(out, fmt='jsonl', page_size=2) == 6)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertTrue(len(set(record['id'] for record in records)) == 6)
+        self.assertTrue('password_hash' not in records[0])
+
+    def test_export_filters(self):
+        # Ensure filters on the flags and registration date apply.
+        out = io.StringIO()
+        count = export_users(
+            out, confirmed=True,
+            registered_after=datetime.datetime.now() - datetime.timedelta(1))
+        self.assertTrue(count == 3)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('id,email,confirmed'))
+        self.assertTrue(len(lines) == 4)
+        out = io.StringIO()
+        self.assertTrue(export_users(
+            out, registered_before=datetime.datetime(2000, 1, 1)) == 0)
+
+    def test_export_round_trips_through_import(self):
+        # Ensure exported password hashes are imported as is.
+        path = os.path.join(tempfile.mkdtemp(), 'users.csv')
+        try:
+            with io.open(path, 'w', newline='') as out:
+                export_users(out, include_passwords=True)
+            user = User.query.filter_by(email='user1@export.com').first()
+            db.session.delete(user)
+            db.session.commit()
+            self.assertTrue(import_users(path, workers=1) == (1, 5))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        user = User.query.filter_by(email='user1@export.com').first()
+        self.assertTrue(hasher.check_password_hash(user.password, 'exported'))
+        self.assertFalse(user.confirmed)
+
+    def test_export_non_ascii_round_trips(self):
+        # Ensure non-ASCII emails are written and read back as text.
+        db.session.add(User(email=u'zo\xeb@export.com', password='exported',
+                            confirmed=True))
+        db.session.commit()
+        out = io.StringIO()
+        export_users(out, fmt='jsonl')
+        self.assertIn(u'zo\\u00eb@export.com', out.getvalue())
+        path = os.path.join(tempfile.mkdtemp(), 'users.csv')
+        try:
+            with io.open(path, 'w', encoding='utf-8', newline='') as out:
+                export_users(out, include_passwords=True)
+            with io.open(path, encoding='utf-8') as f:
+                self.assertIn(u'zo\xeb@export.com', f.read())
+            User.query.filter_by(email=u'zo\xeb@export.com').delete()
+            db.session.commit()
+            self.assertTrue(import_users(path, workers=1) == (1, 6))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        self.assertTrue(User.query.filter_by(
+            normalized_email=u'zo\xeb@export.com').count() == 1)
+
+
+class TestSeedUsers(BaseTestCase):
+
+    def test_seed_users(self):
+        # Ensure users are created in batches with the shared passwords.
+        committed = []
+        self.assertTrue(seed_users(25, batch_size=10, commit_every=20,
+                                   seed=1, progress=committed.append) == 25)
+        self.assertTrue(committed == [20, 25])
+        users = User.query.filter(User.email != 'test@user.com').all()
+        self.assertTrue(len(users) == 25)
+        self.assertTrue(len(set(user.password for user in users)) ==
+                        len(SEED_PASSWORDS))
+        user = users[0]
+        self.assertTrue(user.normalized_email == user.email.lower())
+        n = int(user.email.split('@')[0].split('.')[-1])
+        self.assertTrue(hasher.check_password_hash(
+            user.password, SEED_PASSWORDS[n % len(SEED_PASSWORDS)]))
+        for user in users:
+            self.assertTrue(user.registered_on <= datetime.datetime.now())
+            self.assertTrue(user.confirmed == (user.confirmed_on is not None))
+
+    def test_seed_users_again(self):
+        # Ensure a second run does not repeat emails.
+        seed_users(5, seed=1)
+        seed_users(5, seed=1)
+        self.assertTrue(User.query.count() == 11)
+        numbers = sorted(
+            int(user.email.split('@')[0].split('.')[-1])
+            for user in User.query.filter(User.email != 'test@user.com'))
+        self.assertTrue(numbers == list(range(1, 11)))
+        seed_users(1, start=100)
+        self.assertTrue(User.query.filter(
+            User.email.like('%.101@%')).count() == 1)
+
+    def test_seed_users_after_deletions(self):
+        # Ensure seeding after deletions continues after the highest number.
+        seed_users(5, seed=1)
+        User.query.filter(User.email.like('%.2@%') |
+                          User.email.like('%.3@%')).delete(
+            synchronize_session=False)
+        db.session.commit()
+        seed_users(5, seed=1)
+        numbers = sorted(
+            int(user.email.split('@')[0].split('.')[-1])
+            for user in User.query.filter(User.email != 'test@user.com'))
+        self.assertTrue(numbers == [1] + list(range(4, 11)))
+
+    def test_seed_users_start_below_seeded(self):
+        # Ensure a start below the seeded numbers is refused up front.
+        seed_users(5, seed=1)
+        self.assertRaises(ValueError, seed_users, 5, start=3)
+        self.assertTrue(User.query.count() == 6)
+
+
+class TestBackfillNormalizedEmails(TemporaryDatabaseTestCase):
+
+    def setUp(self):
+        super(TestBackfillNormalizedEmails, self).setUp()
+        self.context = self.app.app_context()
+        self.context.push()
+        # the users table as migration 9e9c55aa23 leaves it
+        metadata = db.MetaData()
+        users = User.__table__.tometadata(metadata)
+        users.c.normalized_email.nullable = True
+        metadata.create_all(db.engine)
+        db.engine.execute(users.insert(), [dict(
+            email=email, normalized_email=None, password='x',
+            registered_on=datetime.datetime.now(), admin=False,
+            confirmed=False) for email in (
+                ' One@Backfill.com', 'two@backfill.com', 'THREE@backfill.com',
+                'four@backfill.com', 'Five@backfill.com ')])
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        super(TestBackfillNormalizedEmails, self).tearDown()
+
+    def test_backfill_in_batches(self):
+        # Ensure every user is normalized, one committed batch at a time.
+        updated = []
+        self.assertTrue(backfill_normalized_emails(
+            batch_size=2, progress=updated.append) == 5)
+        self.assertTrue(updated == [2, 4, 5])
+        emails = [row[0] for row in db.engine.execute(
+            'SELECT normalized_email FROM users ORDER BY id')]
+        self.assertTrue(emails == [
+            'one@backfill.com', 'two@backfill.com', 'three@backfill.com',
+            'four@backfill.com', 'five@backfill.com'])
+        self.assertTrue(backfill_normalized_emails() == 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
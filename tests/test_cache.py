@@ -0,0 +1,62 @@
+# tests/test_cache.py
+
+
+import unittest
+
+from project import load_user, user_cache
+from project.cache import MemoryCache, UserSnapshot
+from project.models import User
+from project.token import generate_confirmation_token
+from project.util import BaseTestCase
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        # Ensure the cache never grows past its threshold.
+        cache = MemoryCache(threshold=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue(cache.get('a') == 1)
+        self.assertTrue(cache.get('b') is None)
+        self.assertTrue(cache.get('c') == 3)
+
+    def test_entries_expire(self):
+        # Ensure entries are dropped after their timeout.
+        cache = MemoryCache()
+        cache.set('a', 1, timeout=-1)
+        self.assertTrue(cache.get('a') is None)
+
+
+class TestUserCache(BaseTestCase):
+
+    def setUp(self):
+        user_cache.clear()
+
+    def test_load_user_uses_cache(self):
+        # Ensure a loaded user is served from the cache the next time.
+        user = User.query.filter_by(email='test@user.com').first()
+        self.assertIsInstance(load_user(user.id), User)
+        cached = load_user(user.id)
+        self.assertIsInstance(cached, UserSnapshot)
+        self.assertTrue(cached.email == 'test@user.com')
+        self.assertTrue(user_cache.misses == 1)
+        self.assertTrue(user_cache.hits == 1)
+
+    def test_confirm_email_invalidates_cache(self):
+        # Ensure the cached user is refreshed once it is confirmed.
+        with self.client:
+            self.client.post('/login', data=dict(
+                email='test@user.com', password='just_a_test_user'
+            ), follow_redirects=True)
+            token = generate_confirmation_token('test@user.com')
+            self.client.get('/confirm/' + token, follow_redirects=True)
+            response = self.client.get('/profile')
+            self.assertTrue(response.status_code == 200)
+            self.assertTemplateUsed('user/profile.html')
+
+
+if __name__ == '__main__':
+    unittest.main()
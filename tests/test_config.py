@@ -6,45 +6,76 @@ import unittest
 from flask import current_app
 from flask_testing import TestCase
 
-from project import app
+from project import create_app, hasher, limiter, user_cache
+from project.config import TestingConfig
 
 
 class TestDevelopmentConfig(TestCase):
 
     def create_app(self):
+        app = create_app('project.config.TestingConfig')
         app.config.from_object('project.config.DevelopmentConfig')
         return app
 
     def test_app_is_development(self):
-        self.assertTrue(app.config['DEBUG'] is True)
-        self.assertTrue(app.config['WTF_CSRF_ENABLED'] is False)
-        self.assertTrue(app.config['DEBUG_TB_ENABLED'] is True)
+        self.assertTrue(self.app.config['DEBUG'] is True)
+        self.assertTrue(self.app.config['WTF_CSRF_ENABLED'] is False)
+        self.assertTrue(self.app.config['DEBUG_TB_ENABLED'] is True)
 
 
 class TestTestingConfig(TestCase):
 
     def create_app(self):
+        app = create_app('project.config.TestingConfig')
         app.config.from_object('project.config.TestingConfig')
         return app
 
     def test_app_is_testing(self):
         self.assertTrue(current_app.config['TESTING'])
-        self.assertTrue(app.config['DEBUG'] is False)
-        self.assertTrue(app.config['BCRYPT_LOG_ROUNDS'] == 1)
-        self.assertTrue(app.config['WTF_CSRF_ENABLED'] is False)
+        self.assertTrue(self.app.config['DEBUG'] is False)
+        self.assertTrue(self.app.config['BCRYPT_LOG_ROUNDS'] == 1)
+        self.assertTrue(self.app.config['WTF_CSRF_ENABLED'] is False)
+
+    def test_debug_toolbar_is_not_created(self):
+        # Ensure the debug toolbar is only set up when it is enabled.
+        self.assertTrue('debugtoolbar' not in self.app.blueprints)
 
 
 class TestProductionConfig(TestCase):
 
     def create_app(self):
+        app = create_app('project.config.TestingConfig')
         app.config.from_object('project.config.ProductionConfig')
         return app
 
     def test_app_is_production(self):
-        self.assertTrue(app.config['DEBUG'] is False)
-        self.assertTrue(app.config['DEBUG_TB_ENABLED'] is False)
-        self.assertTrue(app.config['WTF_CSRF_ENABLED'] is True)
-        self.assertTrue(app.config['BCRYPT_LOG_ROUNDS'] == 13)
+        self.assertTrue(self.app.config['DEBUG'] is False)
+        self.assertTrue(self.app.config['DEBUG_TB_ENABLED'] is False)
+        self.assertTrue(self.app.config['WTF_CSRF_ENABLED'] is True)
+        self.assertTrue(self.app.config['BCRYPT_LOG_ROUNDS'] == 13)
+
+
+class TestAppFactory(unittest.TestCase):
+
+    def test_extensions_keep_per_app_state(self):
+        # Ensure a second app does not take over the extensions of the first.
+        first = create_app('project.config.TestingConfig')
+
+        class OtherConfig(TestingConfig):
+            RATELIMIT_ENABLED = True
+            USER_CACHE_ENABLED = False
+            BCRYPT_POOL_SIZE = 0
+
+        second = create_app(OtherConfig)
+        with first.app_context():
+            self.assertFalse(limiter.state.enabled)
+            self.assertTrue(user_cache.state.enabled)
+            self.assertTrue(hasher.pool.size ==
+                            first.config['BCRYPT_POOL_SIZE'])
+        with second.app_context():
+            self.assertTrue(limiter.state.enabled)
+            self.assertFalse(user_cache.state.enabled)
+            self.assertTrue(hasher.pool.size == 0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,122 @@
+# tests/test_email.py
+
+
+import datetime
+import socket
+import unittest
+
+from project import db, mail
+from project.models import OutboxEmail
+from project.email import send_email, send_queued_emails, purge_outbox, \
+    _claim
+from project.util import BaseTestCase
+
+
+class _RefusedConnection(object):
+
+    def __enter__(self):
+        raise socket.error('Connection refused')
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+class TestEmailOutbox(BaseTestCase):
+
+    def setUp(self):
+        OutboxEmail.query.delete()
+        db.session.commit()
+
+    def test_register_queues_confirmation_email(self):
+        # Ensure registration queues the email instead of sending it.
+        with mail.record_messages() as outbox:
+            self.client.post('/register', data=dict(
+                email='new@outbox.com',
+                password='outbox_user',
+                confirm='outbox_user'
+            ), follow_redirects=True)
+            self.assertTrue(len(outbox) == 0)
+        email = OutboxEmail.query.filter_by(recipient='new@outbox.com').first()
+        self.assertTrue(email is not None)
+        self.assertTrue(email.sent_on is None)
+
+    def test_send_queued_emails(self):
+        # Ensure queued emails are sent once.
+        send_email('test@user.com', 'Hello', '<p>Hello</p>')
+        db.session.commit()
+        with mail.record_messages() as outbox:
+            self.assertTrue(send_queued_emails() == 1)
+            self.assertTrue(send_queued_emails() == 0)
+        self.assertTrue(len(outbox) == 1)
+        self.assertTrue(outbox[0].recipients == ['test@user.com'])
+        email = OutboxEmail.query.first()
+        self.assertIsInstance(email.sent_on, datetime.datetime)
+
+    def test_failed_email_is_retried_later(self):
+        # Ensure a failed email is deferred with backoff.
+        send_email('test@user.com', 'Hello', '<p>Hello</p>')
+        db.session.commit()
+        mail.connect = _RefusedConnection
+        try:
+            self.assertTrue(send_queued_emails() == 0)
+        finally:
+            del mail.connect
+        email = OutboxEmail.query.first()
+        self.assertTrue(email.sent_on is None)
+        self.assertTrue(email.attempts == 1)
+        self.assertTrue(email.next_attempt_on > datetime.datetime.now())
+        self.assertIn('Connection refused', email.last_error)
+        # not due yet
+        self.assertTrue(send_queued_emails() == 0)
+
+    def test_claimed_emails_are_skipped(self):
+        # Ensure an email leased by one sender is not sent by another.
+        send_email('test@user.com', 'Hello', '<p>Hello</p>')
+        db.session.commit()
+        read = OutboxEmail.query.all()
+        # another sender claims it after this one read it
+        OutboxEmail.query.update(dict(
+            next_attempt_on=datetime.datetime.now() +
+            datetime.timedelta(minutes=10)), synchronize_session=False)
+        db.session.commit()
+        self.assertTrue(_claim(read) == [])
+        with mail.record_messages() as outbox:
+            self.assertTrue(send_queued_emails() == 0)
+        self.assertTrue(len(outbox) == 0)
+
+    def test_expired_lease_is_taken_over(self):
+        # Ensure the emails of a sender that died are sent after the lease.
+        send_email('test@user.com', 'Hello', '<p>Hello</p>')
+        db.session.commit()
+        self.app.config['MAIL_OUTBOX_LEASE'] = -1
+        try:
+            _claim(OutboxEmail.query.all())
+            with mail.record_messages() as outbox:
+                self.assertTrue(send_queued_emails() == 1)
+        finally:
+            self.app.config['MAIL_OUTBOX_LEASE'] = 600
+        self.assertTrue(len(outbox) == 1)
+
+    def test_purge_outbox(self):
+        # Ensure only emails sent or given up on long ago are deleted.
+        long_ago = datetime.datetime.now() - datetime.timedelta(days=40)
+        for recipient in ('sent@outbox.com', 'recent@outbox.com',
+                          'failed@outbox.com', 'retrying@outbox.com'):
+            send_email(recipient, 'Hello', '<p>Hello</p>')
+        db.session.commit()
+        emails = dict((email.recipient, email)
+                      for email in OutboxEmail.query)
+        emails['sent@outbox.com'].sent_on = long_ago
+        emails['recent@outbox.com'].sent_on = datetime.datetime.now()
+        for recipient, attempts in (('failed@outbox.com', 5),
+                                    ('retrying@outbox.com', 2)):
+            emails[recipient].created_on = long_ago
+            emails[recipient].attempts = attempts
+        db.session.commit()
+        self.assertTrue(purge_outbox(30, batch_size=1) == 2)
+        self.assertTrue(set(email.recipient for email in OutboxEmail.query) ==
+                        set(['recent@outbox.com', 'retrying@outbox.com']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# tests/test_hashing.py
+
+
+import unittest
+
+from project import db, hasher
+from project.hashing import _generate_password_hash
+from project.models import User
+from project.util import BaseTestCase
+
+
+class TestPasswordHasher(BaseTestCase):
+
+    def test_hash_and_check_on_pool(self):
+        # Ensure hashes made on the pool can be verified.
+        pw_hash = hasher.generate_password_hash('just_a_password')
+        self.assertTrue(hasher.check_password_hash(pw_hash, 'just_a_password'))
+        self.assertFalse(hasher.check_password_hash(pw_hash, 'not_it'))
+
+    def test_saturated_pool_returns_503(self):
+        # Ensure login fails fast when every pool slot is taken.
+        pool = hasher.pool
+        pool.get()
+        taken = 0
+        while pool.slots.acquire(False):
+            taken += 1
+        try:
+            response = self.client.post('/login', data=dict(
+                email='test@user.com', password='just_a_test_user'
+            ))
+        finally:
+            for _ in range(taken):
+                pool.slots.release()
+        self.assertTrue(response.status_code == 503)
+        self.assertTemplateUsed('errors/503.html')
+
+    def test_needs_rehash(self):
+        # Ensure only hashes of another cost or algorithm need a rehash.
+        self.assertFalse(hasher.needs_rehash(
+            hasher.generate_password_hash('just_a_password')))
+        self.assertTrue(hasher.needs_rehash(
+            _generate_password_hash('just_a_password', 5)))
+        self.assertTrue(hasher.needs_rehash('not-a-bcrypt-hash'))
+
+    def test_login_rehashes_outdated_hash(self):
+        # Ensure a successful login upgrades a hash of another cost.
+        user = User.query.filter_by(email='test@user.com').first()
+        user.password = _generate_password_hash('just_a_test_user', 5)
+        db.session.commit()
+        with self.client:
+            self.client.post('/login', data=dict(
+                email='test@user.com', password='just_a_test_user'
+            ), follow_redirects=True)
+        user = User.query.filter_by(email='test@user.com').first()
+        self.assertFalse(hasher.needs_rehash(user.password))
+        self.assertTrue(
+            hasher.check_password_hash(user.password, 'just_a_test_user'))
+
+
+if __name__ == '__main__':
+    unittest.main()
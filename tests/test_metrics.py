@@ -0,0 +1,111 @@
+# tests/test_metrics.py
+
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from project.metrics.registry import Counter, Gauge, Histogram, MmapValues, \
+    Registry, LOGINS
+from project.util import BaseTestCase
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_values_are_summed_across_processes(self):
+        # Ensure the files of every process are added up.
+        registry = Registry()
+        registry.configure(self.tmpdir)
+        counter = Counter('jobs_total', 'Jobs.', ['kind'], registry=registry)
+        counter.inc(kind='a')
+        # a second process writes its own file
+        other = MmapValues(os.path.join(self.tmpdir, 'metrics_0.db'))
+        other.inc('["jobs_total", [["kind", "a"]]]', 2)
+        self.assertTrue(counter.value(kind='a') == 3)
+
+    def test_mmap_file_grows(self):
+        # Ensure keys beyond the initial size are kept and can be re-read.
+        path = os.path.join(self.tmpdir, 'metrics_1.db')
+        values = MmapValues(path, initial_size=64)
+        for i in range(100):
+            values.inc('key%d' % i, i)
+        values.inc('key5', 1)
+        reopened = dict(MmapValues(path).items())
+        self.assertTrue(len(reopened) == 100)
+        self.assertTrue(reopened['key5'] == 6)
+
+    def test_nothing_is_recorded_until_configured(self):
+        # Ensure metrics cost nothing while disabled.
+        registry = Registry()
+        counter = Counter('jobs_total', 'Jobs.', registry=registry)
+        histogram = Histogram('work_seconds', 'Work.', registry=registry)
+        counter.inc()
+        histogram.observe(1)
+        with histogram.time():
+            pass
+        self.assertTrue(registry.collect() == {})
+        registry.configure()
+        counter.inc()
+        self.assertTrue(counter.value() == 1)
+
+    def test_gauges_of_exited_processes_are_dropped(self):
+        # Ensure a dead worker's gauge no longer counts, its counters do.
+        registry = Registry()
+        registry.configure(self.tmpdir)
+        gauge = Gauge('busy', 'Busy.', registry=registry)
+        counter = Counter('jobs_total', 'Jobs.', registry=registry)
+        gauge.inc(2)
+        exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited.wait()
+        other = MmapValues(os.path.join(self.tmpdir,
+                                        'metrics_%d.db' % exited.pid))
+        other.inc('["busy", []]', 5)
+        other.inc('["jobs_total", []]', 3)
+        self.assertTrue(gauge.value() == 2)
+        self.assertTrue(counter.value() == 3)
+
+    def test_histogram_renders_cumulative_buckets(self):
+        # Ensure buckets are rendered in the Prometheus text format.
+        registry = Registry()
+        registry.configure()
+        histogram = Histogram('work_seconds', 'Work.', buckets=(1, 5),
+                              registry=registry)
+        histogram.observe(0.5)
+        histogram.observe(3)
+        histogram.observe(7)
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE work_seconds histogram', lines)
+        self.assertIn('work_seconds_bucket{le="1.0"} 1.0', lines)
+        self.assertIn('work_seconds_bucket{le="5.0"} 2.0', lines)
+        self.assertIn('work_seconds_bucket{le="+Inf"} 3.0', lines)
+        self.assertIn('work_seconds_count 3.0', lines)
+
+
+class TestMetricsView(BaseTestCase):
+
+    def test_metrics_route(self):
+        # Ensure logins and their SQL show up on the metrics page.
+        before = LOGINS.value(result='success')
+        self.client.post('/login', data=dict(
+            email='test@user.com', password='just_a_test_user'
+        ))
+        self.assertTrue(LOGINS.value(result='success') == before + 1)
+        response = self.client.get('/metrics')
+        self.assertTrue(response.status_code == 200)
+        self.assertIn(b'logins_total{result="success"}', response.data)
+        self.assertIn(b'bcrypt_verify_seconds_count', response.data)
+        self.assertIn(b'db_query_seconds_count{endpoint="user.login"}',
+                      response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# tests/test_password_reset.py
+
+
+import datetime
+import unittest
+
+from project import db, hasher
+from project.models import User, PasswordResetToken
+from project.password_reset import issue_reset_token, digest_token, \
+    invalidate_reset_tokens, purge_expired_reset_tokens
+from project.util import BaseTestCase
+
+
+class TestPasswordReset(BaseTestCase):
+
+    def setUp(self):
+        self.user = User.query.filter_by(email='test@user.com').first()
+
+    def tearDown(self):
+        PasswordResetToken.query.delete()
+        db.session.commit()
+
+    def issue(self, expires_in=3600):
+        token = issue_reset_token(self.user)
+        db.session.flush()
+        row = PasswordResetToken.query.filter_by(digest=digest_token(token)).one()
+        row.expires_on = datetime.datetime.now() + \
+            datetime.timedelta(seconds=expires_in)
+        db.session.commit()
+        return token
+
+    def assertRefused(self, token):
+        response = self.client.get('/forgot/new/' + token)
+        self.assertRedirects(response, '/')
+        response = self.client.get('/')
+        self.assertIn(b'Can not reset the password, try again.',
+                      response.data)
+
+    def test_only_digest_is_stored(self):
+        # Ensure only a fixed size digest of the token is stored.
+        token = self.issue()
+        row = PasswordResetToken.query.one()
+        self.assertTrue(row.user_id == self.user.id)
+        self.assertTrue(len(row.digest) == 64)
+        self.assertTrue(token not in row.digest)
+
+    def test_token_is_single_use(self):
+        # Ensure a reset token can only be used once.
+        token = self.issue()
+        response = self.client.post('/forgot/new/' + token, data=dict(
+            password='new_password', confirm='new_password'))
+        self.assertRedirects(response, '/profile')
+        self.assertTrue(hasher.check_password_hash(
+            User.query.get(self.user.id).password, 'new_password'))
+        self.client.get('/logout')
+        self.assertRefused(token)
+        self.assertTrue(PasswordResetToken.query.count() == 0)
+
+    def test_expired_token_is_refused(self):
+        # Ensure an expired token is refused even before it is purged.
+        self.assertRefused(self.issue(expires_in=-1))
+
+    def test_unknown_token_is_refused(self):
+        # Ensure a token that was never issued is refused.
+        self.assertRefused('not-a-token')
+
+    def test_purge_expired(self):
+        # Ensure purging deletes expired tokens only, in batches.
+        for i in range(5):
+            self.issue(expires_in=-1)
+        valid = self.issue()
+        self.assertTrue(purge_expired_reset_tokens(batch_size=2) == 5)
+        self.assertTrue(PasswordResetToken.query.one().digest ==
+                        digest_token(valid))
+
+    def test_invalidate_all(self):
+        # Ensure outstanding tokens can be invalidated at once.
+        tokens = [self.issue() for i in range(3)]
+        self.assertTrue(invalidate_reset_tokens() == 3)
+        self.assertRefused(tokens[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
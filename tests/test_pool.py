@@ -0,0 +1,85 @@
+# tests/test_pool.py
+
+
+import unittest
+
+from flask import Blueprint
+
+from project import db
+from project.metrics.registry import REGISTRY, DB_POOL_IN_USE, \
+    DB_POOL_TIMEOUTS
+from project.models import User
+from project.pool import TimedQueuePool, _statement_timeout
+from project.util import TemporaryDatabaseTestCase
+
+
+# a view that needs a connection, registered on its own app
+pool_views = Blueprint('pool_views', __name__)
+
+
+@pool_views.route('/count')
+def count():
+    return str(User.query.count())
+
+
+class TestPool(TemporaryDatabaseTestCase):
+
+    blueprints = [pool_views]
+
+    def setUp(self):
+        super(TestPool, self).setUp()
+        db.create_all(app=self.app)
+        self.engine = db.get_engine(self.app)
+
+    def settings(self):
+        return dict(SQLALCHEMY_POOL_SIZE=1,
+                    SQLALCHEMY_MAX_OVERFLOW=0,
+                    SQLALCHEMY_POOL_FAIL_FAST=True,
+                    SQLALCHEMY_POOL_PRE_PING=True)
+
+    def test_pool_options(self):
+        # Ensure the configured pool is used.
+        pool = self.engine.pool
+        self.assertTrue(isinstance(pool, TimedQueuePool))
+        self.assertTrue(pool.size() == 1)
+        self.assertTrue(pool._timeout == 0)
+
+    def test_exhausted_pool_is_unavailable(self):
+        # Ensure an exhausted pool fails the request with a 503 right away.
+        timeouts = DB_POOL_TIMEOUTS.value()
+        client = self.app.test_client()
+        self.assertTrue(client.get('/count').data == b'0')
+        with self.engine.connect():
+            response = client.get('/count')
+        self.assertTrue(response.status_code == 503)
+        self.assertTrue(DB_POOL_TIMEOUTS.value() == timeouts + 1)
+        self.assertTrue(client.get('/count').status_code == 200)
+
+    def test_metrics(self):
+        # Ensure checkouts are timed and counted while in use.
+        sample = ('db_pool_checkout_seconds_count', ())
+        checkouts = REGISTRY.collect().get(sample, 0)
+        in_use = DB_POOL_IN_USE.value()
+        with self.engine.connect():
+            self.assertTrue(DB_POOL_IN_USE.value() == in_use + 1)
+        self.assertTrue(DB_POOL_IN_USE.value() == in_use)
+        self.assertTrue(REGISTRY.collect()[sample] == checkouts + 1)
+
+    def test_pre_ping(self):
+        # Ensure a connection the database dropped is replaced on checkout.
+        with self.engine.connect() as connection:
+            # the sqlite3 connection under the pool's proxy
+            dbapi_connection = connection.connection.connection
+        # while it waits in the pool
+        dbapi_connection.close()
+        self.assertTrue(self.engine.execute('SELECT 1').scalar() == 1)
+
+    def test_statement_timeout(self):
+        # Ensure the statement timeout is set where the database supports it.
+        self.assertTrue(_statement_timeout('postgresql+psycopg2', 1.5) ==
+                        'SET statement_timeout = 1500')
+        self.assertTrue(_statement_timeout('sqlite', 1.5) is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
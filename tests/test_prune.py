@@ -0,0 +1,88 @@
+# tests/test_prune.py
+
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from project import db
+from project.models import User, PasswordResetToken
+from project.password_reset import issue_reset_token
+from project.prune import prune, prune_unconfirmed_users, Pruner
+from project.util import BaseTestCase
+
+
+class TestPrune(BaseTestCase):
+
+    def tearDown(self):
+        User.query.filter(User.email != 'test@user.com').delete()
+        PasswordResetToken.query.delete()
+        db.session.commit()
+
+    def add_user(self, email, confirmed, days_ago):
+        user = User(email=email, password='password', confirmed=confirmed)
+        user.registered_on = datetime.datetime.now() - \
+            datetime.timedelta(days=days_ago)
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def test_prune_unconfirmed_users(self):
+        # Ensure only old unconfirmed users are deleted, in batches.
+        for i in range(5):
+            self.add_user('old%d@prune.com' % i, confirmed=False, days_ago=40)
+        self.add_user('new@prune.com', confirmed=False, days_ago=1)
+        self.add_user('confirmed@prune.com', confirmed=True, days_ago=40)
+        self.assertTrue(prune_unconfirmed_users(30, batch_size=2) == 5)
+        emails = set(user.email for user in User.query)
+        self.assertTrue(emails == set([
+            'test@user.com', 'new@prune.com', 'confirmed@prune.com']))
+
+    def test_prune_deletes_reset_tokens_of_pruned_users(self):
+        # Ensure pruned users do not leave reset tokens behind.
+        user = self.add_user('old@prune.com', confirmed=False, days_ago=40)
+        issue_reset_token(user)
+        db.session.commit()
+        self.assertTrue(prune_unconfirmed_users(30) == 1)
+        self.assertTrue(PasswordResetToken.query.count() == 0)
+
+    def test_prune_uses_config(self):
+        # Ensure prune() reports both tables with the configured age.
+        self.add_user('old@prune.com', confirmed=False, days_ago=40)
+        self.add_user('older@prune.com', confirmed=False, days_ago=100)
+        self.app.config['PRUNE_UNCONFIRMED_AFTER_DAYS'] = 60
+        try:
+            deleted = prune(sleep=0)
+        finally:
+            self.app.config['PRUNE_UNCONFIRMED_AFTER_DAYS'] = 30
+        self.assertTrue(deleted == {
+            'users': 1, 'password_reset_tokens': 0, 'email_outbox': 0})
+
+    def test_pruner_is_off_by_default(self):
+        # Ensure no background task is registered without an interval.
+        functions = len(self.app.before_first_request_funcs)
+        Pruner(self.app)
+        self.assertTrue(len(self.app.before_first_request_funcs) == functions)
+
+    def test_only_one_pruner_leads(self):
+        # Ensure one pruner holds the lock and another takes over after it.
+        tmpdir = tempfile.mkdtemp()
+        lock_file = self.app.config['PRUNE_LOCK_FILE']
+        self.app.config['PRUNE_LOCK_FILE'] = os.path.join(tmpdir, 'prune.lock')
+        try:
+            first, second = Pruner(), Pruner()
+            self.assertTrue(first.is_leader(self.app))
+            self.assertTrue(first.is_leader(self.app))
+            self.assertFalse(second.is_leader(self.app))
+            first._lock.close()
+            self.assertTrue(second.is_leader(self.app))
+            second._lock.close()
+        finally:
+            self.app.config['PRUNE_LOCK_FILE'] = lock_file
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
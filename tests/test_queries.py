@@ -0,0 +1,81 @@
+# tests/test_queries.py
+
+
+import unittest
+import warnings
+
+from flask import Blueprint
+
+from project import create_app, db
+from project.models import User
+from project.queries import RepeatedQueries, RepeatedQueryWarning
+from project.util import BaseTestCase
+
+
+# a view with an N+1 lookup, registered on its own app
+n_plus_one = Blueprint('n_plus_one', __name__)
+
+
+@n_plus_one.route('/n-plus-one')
+def lookups():
+    for user_id in (1, 2, 3):
+        User.query.get(user_id)
+    return 'ok'
+
+
+class TestQueryBudget(BaseTestCase):
+
+    def test_assert_max_queries(self):
+        # Ensure a block within its budget passes and reports its statements.
+        with self.assertMaxQueries(1) as queries:
+            User.query.filter_by(email='test@user.com').first()
+        self.assertTrue(queries.count == 1)
+        self.assertTrue('FROM users' in queries.statements[0][0])
+
+    def test_assert_max_queries_fails(self):
+        # Ensure going over the budget fails with the statements.
+        with self.assertRaises(AssertionError) as context:
+            with self.assertMaxQueries(1):
+                User.query.filter_by(email='test@user.com').first()
+                User.query.filter_by(email='other@user.com').first()
+        self.assertTrue('2 queries, expected at most 1' in
+                        str(context.exception))
+        self.assertTrue('other@user.com' in str(context.exception))
+
+
+class TestRepeatedQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('project.config.TestingConfig')
+        self.app.register_blueprint(n_plus_one)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_repeated_statement_warns(self):
+        # Ensure a statement repeated within a request is flagged.
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', RepeatedQueryWarning)
+            self.app.test_client().get('/n-plus-one')
+        self.assertTrue(len(caught) == 1)
+        message = str(caught[0].message)
+        self.assertTrue('GET /n-plus-one' in message)
+        self.assertTrue('3 times (3 distinct parameters)' in message)
+
+    def test_disabled(self):
+        # Ensure nothing is registered when the warning is disabled.
+        app = create_app('project.config.TestingConfig')
+        app.config['WARN_REPEATED_QUERIES'] = False
+        functions = len(app.before_request_funcs.get(None, []))
+        RepeatedQueries(app)
+        self.assertTrue(len(app.before_request_funcs.get(None, [])) ==
+                        functions)
+
+
+if __name__ == '__main__':
+    unittest.main()
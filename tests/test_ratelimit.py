@@ -0,0 +1,123 @@
+# tests/test_ratelimit.py
+
+
+import unittest
+
+from flask import Blueprint, Flask, request
+
+from project import hasher, limiter
+from project.ratelimit import RateLimiter, RateLimitExceeded
+from project.util import BaseTestCase, TemporaryDatabaseTestCase
+
+
+# a view telling the client's address, registered on its own app
+address_views = Blueprint('address_views', __name__)
+
+
+@address_views.route('/address')
+def address():
+    return request.remote_addr
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.config.update(
+            RATELIMIT_ENABLED=True, RATELIMITS={'test': (3, 60)},
+            RATELIMIT_BACKEND=None, RATELIMIT_MEMORY_SIZE=100)
+        self.limiter = RateLimiter(app)
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_rejects_past_the_limit(self):
+        # Ensure only the allowed number of attempts pass.
+        for _ in range(3):
+            self.limiter.hit('test', 'a')
+        self.assertRaises(RateLimitExceeded, self.limiter.hit, 'test', 'a')
+        # other identities are counted separately
+        self.limiter.hit('test', 'b')
+
+    def hits_allowed(self, identity, previous, seconds_into_window):
+        # attempts that pass with `previous` ones in the window before
+        self.limiter.clock = lambda: 100 * 60 + seconds_into_window
+        self.limiter.state.backend.set(
+            'ratelimit:test:%s:99' % identity, previous)
+        allowed = 0
+        try:
+            while allowed < 10:
+                self.limiter.hit('test', identity)
+                allowed += 1
+        except RateLimitExceeded:
+            return allowed
+
+    def test_previous_window_counts_while_it_overlaps(self):
+        # Ensure the previous window is weighted by how much still overlaps.
+        # 4 earlier attempts weigh 3 at a quarter into the window
+        self.assertTrue(self.hits_allowed('a', 4, 15) == 0)
+        # and 2 at half way, leaving one of the 3 allowed
+        self.assertTrue(self.hits_allowed('b', 4, 30) == 1)
+        # and 1 at three quarters
+        self.assertTrue(self.hits_allowed('c', 4, 45) == 2)
+        self.assertTrue(self.hits_allowed('d', 0, 45) == 3)
+
+
+class TestLoginRateLimit(BaseTestCase):
+
+    def setUp(self):
+        state = limiter.state
+        self.enabled, self.limits = state.enabled, state.limits
+        state.enabled = True
+        state.limits = dict(state.limits, login_email=(2, 60))
+        state.backend.clear()
+
+    def tearDown(self):
+        limiter.state.enabled, limiter.state.limits = \
+            self.enabled, self.limits
+
+    def test_login_is_limited_before_hashing(self):
+        # Ensure rejected logins never reach bcrypt.
+        for _ in range(2):
+            response = self.client.post('/login', data=dict(
+                email='test@user.com', password='wrong_password'
+            ))
+            self.assertTrue(response.status_code == 200)
+
+        def fail(*args):
+            raise AssertionError('bcrypt ran for a rejected login')
+
+        hasher._run = fail
+        try:
+            response = self.client.post('/login', data=dict(
+                email='TEST@user.com', password='just_a_test_user'
+            ))
+        finally:
+            del hasher._run
+        self.assertTrue(response.status_code == 429)
+        self.assertTemplateUsed('errors/429.html')
+
+
+class TestProxyCount(TemporaryDatabaseTestCase):
+
+    blueprints = [address_views]
+
+    def get_address(self, app):
+        return app.test_client().get('/address', headers={
+            'X-Forwarded-For': '10.0.0.1, 192.0.2.7'
+        }, environ_base={'REMOTE_ADDR': '127.0.0.1'}).data
+
+    def test_address_of_the_proxy_by_default(self):
+        # Ensure X-Forwarded-For is ignored unless proxies are configured.
+        self.assertTrue(self.get_address(self.app) == b'127.0.0.1')
+
+    def test_address_appended_by_the_proxy(self):
+        # Ensure the address the proxy saw is the client's.
+        app = self.create_app(PROXY_COUNT=1)
+        self.assertTrue(self.get_address(app) == b'192.0.2.7')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# tests/test_replicas.py
+
+
+import datetime
+import unittest
+
+from flask import Blueprint
+
+from project import db
+from project.models import User
+from project.util import TemporaryDatabaseTestCase
+
+
+# views that look users up, registered on their own app
+replica_views = Blueprint('replica_views', __name__)
+
+
+def _lookup(emails):
+    emails = emails.split(',')
+    found = set(email for (email,) in db.session.query(User.email).filter(
+        User.email.in_(emails)))
+    return ','.join('found' if email in found else 'missing'
+                    for email in emails)
+
+
+@replica_views.route('/lookup/<emails>')
+def lookup(emails):
+    return _lookup(emails)
+
+
+@replica_views.route('/lookup-for-update/<email>')
+def lookup_for_update(email):
+    user = User.query.filter_by(email=email).with_for_update().first()
+    return 'found' if user else 'missing'
+
+
+@replica_views.route('/register/<email>')
+def register(email):
+    db.session.add(User(email=email, password='password', confirmed=False))
+    db.session.commit()
+    return _lookup(email)
+
+
+class TestReplicas(TemporaryDatabaseTestCase):
+
+    blueprints = [replica_views]
+
+    def setUp(self):
+        super(TestReplicas, self).setUp()
+        with self.app.app_context():
+            # the replicas have not caught up with the primary's only user
+            for bind in [None, 'replica0', 'replica1']:
+                engine = db.get_engine(self.app, bind)
+                db.Model.metadata.create_all(engine)
+                engine.execute(User.__table__.insert(), dict(
+                    email='%s@user.com' % (bind or 'primary'),
+                    normalized_email='%s@user.com' % (bind or 'primary'),
+                    password='x', registered_on=datetime.datetime.now(),
+                    admin=False, confirmed=False))
+        self.client = self.app.test_client()
+
+    def settings(self):
+        return dict(SQLALCHEMY_REPLICAS=[self.uri('replica0'),
+                                         self.uri('replica1')])
+
+    def get(self, path, client=None):
+        return (client or self.client).get(path).data.decode('utf-8')
+
+    def test_reads_go_to_a_replica(self):
+        # Ensure the reads of a request go to a single replica.
+        for _ in range(5):
+            found = self.get('/lookup/primary@user.com,replica0@user.com,'
+                             'replica1@user.com')
+            self.assertTrue(found in ('missing,found,missing',
+                                      'missing,missing,found'))
+
+    def test_read_for_update_goes_to_the_primary(self):
+        # Ensure locking reads go to the primary.
+        self.assertTrue(self.get('/lookup-for-update/primary@user.com') ==
+                        'found')
+
+    def test_request_reads_its_writes(self):
+        # Ensure a request reads its own writes.
+        self.assertTrue(self.get('/register/new@user.com') == 'found')
+
+    def test_user_reads_the_primary_after_a_write(self):
+        # Ensure the writing user reads from the primary for a while.
+        self.get('/register/new@user.com')
+        self.assertTrue(self.get('/lookup/new@user.com') == 'found')
+        other = self.app.test_client()
+        self.assertTrue(self.get('/lookup/new@user.com', other) == 'missing')
+
+        self.app.config['SQLALCHEMY_REPLICA_STICKY_SECONDS'] = 0
+        self.get('/register/newer@user.com')
+        self.assertTrue(self.get('/lookup/newer@user.com') == 'missing')
+
+    def test_reads_outside_requests_go_to_the_primary(self):
+        # Ensure reads outside of a request go to the primary.
+        with self.app.app_context():
+            self.assertTrue(_lookup('primary@user.com') == 'found')
+            db.session.remove()
+        # as in manage.py commands
+        with self.app.test_request_context():
+            self.assertTrue(_lookup('primary@user.com') == 'found')
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,356 @@
+# tests/test_sharding.py
+
+
+import shutil
+import tempfile
+import unittest
+import warnings
+
+from sqlalchemy import event
+
+from project import db, hasher, mail
+from project.bulk import export_users, rebalance_users, seed_users, \
+    shard_users
+from project.email import send_email, send_queued_emails
+from project.models import OutboxEmail, User, PasswordResetToken
+from project.password_reset import issue_reset_token, \
+    purge_expired_reset_tokens
+from project.prune import prune_unconfirmed_users
+from project.queries import QueryRecorder, RepeatedQueryWarning
+from project.sharding import BUCKETS, ShardingError, bucket_shard, \
+    email_bucket, id_bucket, where_buckets
+from project.util import BaseTestCase, TemporaryDatabaseTestCase, \
+    create_temporary_app, dispose_engines, temporary_uri
+
+
+def shard_uris(tmpdir, shards):
+    return [temporary_uri(tmpdir, 'shard%d' % i) for i in range(shards)]
+
+
+def add_users(count, confirmed=True):
+    users = [User(email='user%d@shard.com' % i, password='password',
+                  confirmed=confirmed) for i in range(count)]
+    db.session.add_all(users)
+    db.session.commit()
+    return users
+
+
+def shard_emails(shard):
+    with db.session().using_shard(shard):
+        return set(row[0] for row in db.session.query(User.email))
+
+
+class TestBuckets(unittest.TestCase):
+
+    def test_jump_hash(self):
+        # Ensure buckets spread over the shards and only move to a new shard.
+        before = [bucket_shard(bucket, 3) for bucket in range(BUCKETS)]
+        after = [bucket_shard(bucket, 4) for bucket in range(BUCKETS)]
+        for shard in range(3):
+            self.assertTrue(200 < before.count(shard) < 480)
+        for old, new in zip(before, after):
+            self.assertTrue(new in (old, 3))
+        self.assertTrue(180 < after.count(3) < 340)
+
+    def test_where_buckets(self):
+        # Ensure lookups by id or email tell their bucket.
+        email = 'someone@shard.com'
+        self.assertTrue(where_buckets(
+            User.normalized_email == email) == set([email_bucket(email)]))
+        self.assertTrue(where_buckets(
+            db.and_(User.confirmed == True, User.id.in_([1, 1025, 2]))) ==
+            set([1, 2]))
+        self.assertTrue(where_buckets(
+            PasswordResetToken.user_id == 5) == set([5]))
+        self.assertTrue(where_buckets(User.id > 5) is None)
+        self.assertTrue(where_buckets(
+            db.or_(User.id == 1, User.id == 2)) is None)
+
+
+class TestShardRouting(BaseTestCase):
+    """The routing of the session, in the rolled back test transaction."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.sharded_app = create_temporary_app(
+            cls.tmpdir, SQLALCHEMY_USER_SHARDS=shard_uris(cls.tmpdir, 2))
+        db.create_all(app=cls.sharded_app)
+
+    @classmethod
+    def tearDownClass(cls):
+        dispose_engines(cls.sharded_app)
+        shutil.rmtree(cls.tmpdir)
+
+    def create_app(self):
+        return self.sharded_app
+
+    def test_users_land_on_their_shard(self):
+        # Ensure users are stored on the shard of their email, with an id in
+        # the same bucket.
+        users = add_users(20)
+        for user in users:
+            bucket = email_bucket(user.normalized_email)
+            self.assertTrue(id_bucket(user.id) == bucket)
+            self.assertTrue(user.email in
+                            shard_emails(bucket_shard(bucket, 2)))
+        self.assertTrue(len(shard_emails(0)) +
+                        len(shard_emails(1)) == 20)
+        self.assertTrue(shard_emails(0) and shard_emails(1))
+
+    def test_lookups(self):
+        # Ensure users are found by id and email, and counted over all shards.
+        users = add_users(10)
+        db.session.remove()
+        for user in users:
+            self.assertTrue(User.query.get(user.id).email == user.email)
+            self.assertTrue(User.query.filter_by(
+                normalized_email=user.normalized_email).one().id == user.id)
+        self.assertTrue(User.query.count() == 10)
+        self.assertTrue(len(User.query.filter_by(confirmed=True).all()) == 10)
+        ids = [user.id for user in users[:4]]
+        self.assertTrue(User.query.filter(User.id.in_(ids)).count() == 4)
+
+    def test_fan_out_is_not_a_repeated_query(self):
+        # Ensure a lookup sent to every shard is not flagged as repeated.
+        user = add_users(1)[0]
+        token = issue_reset_token(user)
+        db.session.commit()
+        recorders = [
+            QueryRecorder(db.get_engine(self.app, 'users_shard%d' % shard))
+            for shard in range(2)]
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', RepeatedQueryWarning)
+            with recorders[0], recorders[1]:
+                response = self.client.get('/forgot/new/' + token)
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(len(caught) == 0)
+        for queries in recorders:
+            self.assertTrue('password_reset_tokens' in str(queries))
+
+    def test_statement_without_a_shard_is_refused(self):
+        # Ensure statements that name no shard are refused.
+        self.assertRaises(ShardingError, db.session.execute,
+                          User.__table__.delete())
+        db.session.rollback()
+
+    def test_register_and_reset_password(self):
+        # Ensure registering, the duplicate check and resetting a password work
+        # across shards.
+        client = self.app.test_client()
+        data = dict(email='new@shard.com', password='new_password',
+                    confirm='new_password')
+        self.assertTrue(client.post('/register', data=data).status_code ==
+                        302)
+        client.get('/logout')
+        response = client.post('/register', data=data)
+        self.assertIn(b'Email already registered', response.data)
+
+        user = User.query.filter_by(email='new@shard.com').one()
+        token = issue_reset_token(user)
+        db.session.commit()
+        shard = bucket_shard(id_bucket(user.id), 2)
+        with db.session().using_shard(shard):
+            self.assertTrue(PasswordResetToken.query.count() == 1)
+        response = client.post('/forgot/new/' + token, data=dict(
+            password='newer_password', confirm='newer_password'))
+        self.assertTrue(response.location.endswith('/profile'))
+        self.assertTrue(hasher.check_password_hash(
+            User.query.get(user.id).password, 'newer_password'))
+        self.assertTrue(PasswordResetToken.query.count() == 0)
+
+
+class TestSharding(TemporaryDatabaseTestCase):
+    """Maintenance over real shard databases, and adding a shard."""
+
+    def setUp(self):
+        super(TestSharding, self).setUp()
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        super(TestSharding, self).tearDown()
+
+    def settings(self):
+        return dict(SQLALCHEMY_USER_SHARDS=shard_uris(self.tmpdir, 2))
+
+    def switch_app(self, shards):
+        # the same databases, with another number of shards
+        db.session.remove()
+        self.context.pop()
+        dispose_engines(self.app)
+        self.app = self.create_app(
+            SQLALCHEMY_USER_SHARDS=shard_uris(self.tmpdir, shards))
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def test_outbox_of_every_shard_is_drained(self):
+        # Ensure queued emails are kept on the shard of their recipient and
+        # sent from every shard.
+        for i in range(10):
+            send_email('User%d@Shard.com' % i, 'Hello', '<p>Hello</p>')
+        db.session.commit()
+        for i in range(10):
+            shard = bucket_shard(email_bucket('user%d@shard.com' % i), 2)
+            with db.session().using_shard(shard):
+                self.assertTrue(OutboxEmail.query.filter_by(
+                    recipient='User%d@Shard.com' % i).count() == 1)
+        with mail.record_messages() as outbox:
+            self.assertTrue(send_queued_emails(batch_size=10) == 10)
+        self.assertTrue(len(outbox) == 10)
+        self.assertTrue(OutboxEmail.query.filter(
+            OutboxEmail.sent_on == None).count() == 0)  # noqa
+
+    def test_user_and_emails_commit_together(self):
+        # Ensure registering and asking for a reset link commit the user, the
+        # token and the email in one transaction on the user's shard.
+        engines = [db.get_engine(self.app, bind)
+                   for bind in [None, 'users_shard0', 'users_shard1']]
+        commits = []
+
+        def on_commit(connection):
+            commits.append(connection.engine)
+
+        for engine in engines:
+            event.listen(engine, 'commit', on_commit)
+        try:
+            client = self.app.test_client()
+            client.post('/register', data=dict(
+                email='new@shard.com', password='new_password',
+                confirm='new_password'))
+            client.get('/logout')
+            client.post('/forgot', data=dict(email='new@shard.com'))
+        finally:
+            for engine in engines:
+                event.remove(engine, 'commit', on_commit)
+        shard = bucket_shard(email_bucket('new@shard.com'), 2)
+        self.assertTrue(commits == [engines[shard + 1]] * 2)
+        with db.session().using_shard(shard):
+            self.assertTrue(OutboxEmail.query.count() == 2)
+            self.assertTrue(PasswordResetToken.query.count() == 1)
+
+    def test_maintenance_covers_every_shard(self):
+        # Ensure maintenance commands go through every shard.
+        add_users(10, confirmed=False)
+        users = User.query.all()
+        for user in users:
+            issue_reset_token(user)
+            user.registered_on = user.registered_on.replace(year=2000)
+        db.session.commit()
+
+        out = tempfile.TemporaryFile('w+')
+        self.assertTrue(export_users(out, page_size=3) == 10)
+        out.close()
+        PasswordResetToken.query.update(dict(
+            expires_on=users[0].registered_on), synchronize_session=False)
+        db.session.commit()
+        self.assertTrue(purge_expired_reset_tokens(batch_size=3) == 10)
+        self.assertTrue(prune_unconfirmed_users(30, batch_size=3) == 10)
+        self.assertTrue(User.query.count() == 0)
+
+    def test_export_commits_each_page(self):
+        # Ensure every page of an export is read in a transaction of its own.
+        add_users(10)
+        pages = 0
+        for shard in range(2):
+            # the last page is the empty one
+            pages += (len(shard_emails(shard)) + 2) // 3 + 1
+        commits = []
+
+        def on_commit(connection):
+            commits.append(connection)
+
+        engines = [db.get_engine(self.app, 'users_shard%d' % shard)
+                   for shard in range(2)]
+        for engine in engines:
+            event.listen(engine, 'commit', on_commit)
+        try:
+            db.session.remove()
+            out = tempfile.TemporaryFile('w+')
+            self.assertTrue(export_users(out, page_size=3) == 10)
+            out.close()
+        finally:
+            for engine in engines:
+                event.remove(engine, 'commit', on_commit)
+        self.assertTrue(len(commits) == pages)
+
+    def test_seed_users(self):
+        # Ensure seeded users get sharded ids, and emails numbered from 1.
+        self.assertTrue(seed_users(50, batch_size=20, seed=1) == 50)
+        users = User.query.all()
+        self.assertTrue(len(users) == 50)
+        numbers = sorted(int(user.email.split('@')[0].split('.')[-1])
+                         for user in users)
+        self.assertTrue(numbers == list(range(1, 51)))
+        for user in users:
+            self.assertTrue(
+                id_bucket(user.id) == email_bucket(user.normalized_email))
+
+    def test_rebalance_after_adding_a_shard(self):
+        # Ensure adding a shard moves only the users it takes over.
+        users = add_users(40)
+        issue_reset_token(users[0])
+        db.session.commit()
+        self.switch_app(3)
+        moving = [user for user in users
+                  if bucket_shard(id_bucket(user.id), 3) == 2]
+        self.assertTrue(moving)
+        # looked for on the new shard until they are moved
+        self.assertTrue(User.query.get(moving[0].id) is None)
+
+        self.assertTrue(rebalance_users(batch_size=7) == len(moving))
+        self.assertTrue(User.query.count() == 40)
+        self.assertTrue(shard_emails(2) ==
+                        set(user.email for user in moving))
+        for user in users:
+            self.assertTrue(User.query.get(user.id).email == user.email)
+        self.assertTrue(PasswordResetToken.query.one().user_id == users[0].id)
+        # nothing is left to move
+        self.assertTrue(rebalance_users() == 0)
+
+    def test_shard_users_of_an_unsharded_database(self):
+        # Ensure users created before sharding move to their shard, with ids in
+        # the bucket of their email, their reset tokens and queued emails.
+        self.switch_app(0)
+        users = add_users(10)
+        seed_users(5, seed=1)
+        token = issue_reset_token(users[0])
+        send_email(users[1].email, 'Hello', '<p>Hello</p>')
+        db.session.commit()
+        self.assertTrue(
+            sorted(user.id for user in users) == list(range(1, 11)))
+
+        self.switch_app(2)
+        # looked for on the shards until they are moved
+        self.assertTrue(User.query.count() == 0)
+        self.assertTrue(shard_users(batch_size=4) == 15)
+        for table in ('users', 'password_reset_tokens', 'email_outbox'):
+            self.assertTrue(db.engine.execute(
+                'SELECT count(*) FROM %s' % table).scalar() == 0)
+        self.assertTrue(OutboxEmail.query.filter_by(
+            recipient=users[1].email).count() == 1)
+        moved = User.query.all()
+        self.assertTrue(len(moved) == 15)
+        self.assertTrue(shard_emails(0) and shard_emails(1))
+        for user in moved:
+            self.assertTrue(
+                id_bucket(user.id) == email_bucket(user.normalized_email))
+            self.assertTrue(User.query.get(user.id).email == user.email)
+
+        client = self.app.test_client()
+        response = client.post('/forgot/new/' + token, data=dict(
+            password='newer_password', confirm='newer_password'))
+        self.assertTrue(response.location.endswith('/profile'))
+        self.assertTrue(hasher.check_password_hash(User.query.filter_by(
+            email=users[0].email).one().password, 'newer_password'))
+        self.assertTrue(PasswordResetToken.query.count() == 0)
+        # nothing is left to move
+        self.assertTrue(shard_users() == 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
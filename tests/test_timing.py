@@ -0,0 +1,31 @@
+# tests/test_timing.py
+
+
+import unittest
+
+from project.util import BaseTestCase
+
+
+class TestServerTiming(BaseTestCase):
+
+    def test_header_reports_template_time(self):
+        # Ensure rendering time is reported for a plain page.
+        response = self.client.get('/login')
+        header = response.headers['Server-Timing']
+        self.assertIn('template;dur=', header)
+        self.assertIn('total;dur=', header)
+        self.assertNotIn('bcrypt', header)
+
+    def test_header_reports_login_phases(self):
+        # Ensure SQL and bcrypt time are reported for a login.
+        response = self.client.post('/login', data=dict(
+            email='test@user.com', password='just_a_test_user'
+        ))
+        header = response.headers['Server-Timing']
+        self.assertIn('db;dur=', header)
+        self.assertIn('bcrypt;dur=', header)
+        self.assertIn('desc="1 call"', header)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# tests/test_token.py
+
+
+import unittest
+
+from itsdangerous import URLSafeTimedSerializer
+
+from project.token import tokens, OK, EXPIRED, BAD_SIGNATURE, \
+    generate_confirmation_token, confirm_token, \
+    generate_password_reset_token, confirm_password_reset_token
+from project.util import BaseTestCase
+
+
+class TestTokenService(BaseTestCase):
+
+    def setUp(self):
+        self.secret_key = self.app.config['SECRET_KEY']
+
+    def tearDown(self):
+        self.app.config['SECRET_KEY'] = self.secret_key
+        self.app.config['SECRET_KEY_FALLBACKS'] = []
+
+    def test_ok(self):
+        # Ensure a valid token returns its value.
+        result = tokens.loads('confirm', tokens.dumps('confirm', 'a@b.com'), 60)
+        self.assertTrue(result.ok)
+        self.assertTrue(result.status == OK)
+        self.assertTrue(result.value == 'a@b.com')
+
+    def test_expired(self):
+        # Ensure an expired token is reported as expired.
+        result = tokens.loads('confirm', tokens.dumps('confirm', 'a@b.com'), -1)
+        self.assertFalse(result.ok)
+        self.assertTrue(result.status == EXPIRED)
+        self.assertTrue(result.value is None)
+
+    def test_bad_signature(self):
+        # Ensure a tampered token is reported as a bad signature.
+        payload, signature = tokens.dumps('confirm', 'a@b.com').rsplit('.', 1)
+        result = tokens.loads('confirm', payload + '.' + signature[::-1], 60)
+        self.assertTrue(result.status == BAD_SIGNATURE)
+        result = tokens.loads('confirm', 'not a token', 60)
+        self.assertTrue(result.status == BAD_SIGNATURE)
+
+    def test_purposes_do_not_mix(self):
+        # Ensure a token made for one purpose is refused for another.
+        token = generate_confirmation_token('test@user.com')
+        self.assertFalse(confirm_password_reset_token(token))
+        token = generate_password_reset_token('test@user.com')
+        self.assertFalse(confirm_token(token))
+        self.assertTrue(confirm_password_reset_token(token) == 'test@user.com')
+
+    def test_confirmation_tokens_are_compatible(self):
+        # Ensure confirmation tokens sent before the service are accepted.
+        serializer = URLSafeTimedSerializer(self.app.config['SECRET_KEY'])
+        token = serializer.dumps(
+            'test@user.com', salt=self.app.config['SECURITY_PASSWORD_SALT'])
+        self.assertTrue(confirm_token(token) == 'test@user.com')
+        self.assertTrue(generate_confirmation_token('test@user.com') == token)
+
+    def test_key_rotation(self):
+        # Ensure tokens of a retired key are accepted until it is dropped.
+        token = tokens.dumps('confirm', 'a@b.com')
+        self.app.config['SECRET_KEY'] = 'a new key'
+        self.assertTrue(tokens.loads('confirm', token, 60).status == BAD_SIGNATURE)
+        self.app.config['SECRET_KEY_FALLBACKS'] = [self.secret_key]
+        self.assertTrue(tokens.loads('confirm', token, 60).value == 'a@b.com')
+        new_token = tokens.dumps('confirm', 'a@b.com')
+        self.assertTrue(new_token != token)
+        self.assertTrue(tokens.loads('confirm', new_token, 60).ok)
+
+    def test_serializers_are_cached(self):
+        # Ensure the serializers are created once per key and purpose.
+        first = tokens._get_serializers('confirm')
+        self.assertTrue(tokens._get_serializers('confirm')[0] is first[0])
+        self.assertTrue(tokens._get_serializers('reset')[0] is not first[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,26 @@
+import re
 import datetime
 import unittest
 
 from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 
-from project import db
-from project.models import User
+from project import db, user_cache
+from project.models import User, OutboxEmail
 from project.util import BaseTestCase
 from project.user.forms import RegisterForm, \
     LoginForm, ChangePasswordForm, ForgotForm
 from project.token import generate_confirmation_token, confirm_token
 
 
+def sent_reset_token():
+    # the token in the last password reset email
+    email = OutboxEmail.query.filter_by(subject='Reset your password').order_by(
+        OutboxEmail.id.desc()).first()
+    return re.search(r'/forgot/new/([^"<]+)', email.html).group(1)
+
+
 class TestUserForms(BaseTestCase):
 
     def test_validate_success_register_form(self):
@@ -27,15 +37,6 @@ class TestUserForms(BaseTestCase):
             password='example', confirm='')
         self.assertFalse(form.validate())
 
-    def test_validate_email_already_registered(self):
-        # Ensure user can't register when a duplicate email is used
-        form = RegisterForm(
-            email='test@user.com',
-            password='just_a_test_user',
-            confirm='just_a_test_user'
-        )
-        self.assertFalse(form.validate())
-
     def test_validate_success_login_form(self):
         # Ensure correct data validates.
         form = LoginForm(email='test@user.com', password='just_a_test_user')
@@ -93,6 +94,56 @@ class TestUserViews(BaseTestCase):
             self.assertTrue(current_user.is_authenticated())
             self.assertTemplateUsed('main/index.html')
 
+    def test_register_email_already_registered(self):
+        # Ensure user can't register when a duplicate email is used
+        with self.client:
+            response = self.client.post('/register', data=dict(
+                email='test@user.com',
+                password='just_a_test_user',
+                confirm='just_a_test_user'
+            ), follow_redirects=True)
+            self.assertTrue(response.status_code == 200)
+            self.assertIn(b'Email already registered', response.data)
+            self.assertTemplateUsed('user/register.html')
+            self.assertFalse(current_user.is_authenticated())
+
+    def test_register_email_differs_only_in_case(self):
+        # Ensure emails are unique regardless of case.
+        with self.client:
+            response = self.client.post('/register', data=dict(
+                email='Test@User.com',
+                password='just_a_test_user',
+                confirm='just_a_test_user'
+            ), follow_redirects=True)
+            self.assertIn(b'Email already registered', response.data)
+            self.assertFalse(current_user.is_authenticated())
+
+    def test_register_other_integrity_error_is_raised(self):
+        # Ensure only a duplicate email is reported as one.
+        existing = User.query.filter_by(email='test@user.com').first()
+
+        def reuse_id(mapper, connection, user):
+            user.id = existing.id
+
+        event.listen(User, 'before_insert', reuse_id)
+        try:
+            self.assertRaises(IntegrityError, self.client.post, '/register',
+                              data=dict(email='new@user.com',
+                                        password='just_a_test_user',
+                                        confirm='just_a_test_user'))
+        finally:
+            event.remove(User, 'before_insert', reuse_id)
+
+    def test_login_email_is_case_insensitive(self):
+        # Ensure login matches the email regardless of case.
+        with self.client:
+            self.client.post(
+                '/login',
+                data=dict(email="TEST@user.com", password="just_a_test_user"),
+                follow_redirects=True
+            )
+            self.assertTrue(current_user.email == "test@user.com")
+
     def test_incorrect_login(self):
         # Ensure login behaves correctly with incorrect credentials.
         with self.client:
@@ -177,7 +228,7 @@ class TestUserViews(BaseTestCase):
             self.client.post('/forgot', data=dict(
                 email='test@user.com',
             ), follow_redirects=True)
-            token = generate_confirmation_token('test@user.com')
+            token = sent_reset_token()
             response = self.client.get('/forgot/new/'+token, follow_redirects=True)
             self.assertTemplateUsed('user/forgot_new.html')
             self.assertIn(
@@ -188,11 +239,14 @@ class TestUserViews(BaseTestCase):
 
     def test_reset_forgotten_password_valid_token_correct_login(self):
         # Ensure user can confirm account with valid token.
+        user = User.query.filter_by(email='test@user.com').first()
+        user.confirmed = True
+        db.session.commit()
         with self.client:
             self.client.post('/forgot', data=dict(
                 email='test@user.com',
             ), follow_redirects=True)
-            token = generate_confirmation_token('test@user.com')
+            token = sent_reset_token()
             response = self.client.get('/forgot/new/'+token, follow_redirects=True)
             self.assertTemplateUsed('user/forgot_new.html')
             self.assertIn(
@@ -226,11 +280,14 @@ class TestUserViews(BaseTestCase):
 
     def test_reset_forgotten_password_valid_token_invalid_login(self):
         # Ensure user can confirm account with valid token.
+        user = User.query.filter_by(email='test@user.com').first()
+        user.confirmed = True
+        db.session.commit()
         with self.client:
             self.client.post('/forgot', data=dict(
                 email='test@user.com',
             ), follow_redirects=True)
-            token = generate_confirmation_token('test@user.com')
+            token = sent_reset_token()
             response = self.client.get('/forgot/new/'+token, follow_redirects=True)
             self.assertTemplateUsed('user/forgot_new.html')
             self.assertIn(
@@ -265,5 +322,67 @@ class TestUserViews(BaseTestCase):
             self.assertTemplateUsed('user/login.html')
 
 
+class TestUserQueryCounts(BaseTestCase):
+
+    def queries(self, n):
+        # Start cold, like a new request handled by another worker.
+        user_cache.clear()
+        db.session.remove()
+        return self.assertMaxQueries(n)
+
+    def login(self):
+        self.client.post('/login', data=dict(
+            email='test@user.com', password='just_a_test_user'
+        ))
+
+    def test_login_queries(self):
+        # Ensure login only looks the user up.
+        with self.queries(1):
+            self.login()
+
+    def test_register_queries(self):
+        # Ensure registering does not look the email up before inserting.
+        with self.queries(2):
+            self.client.post('/register', data=dict(
+                email='new@user.com',
+                password='new_user', confirm='new_user'
+            ))
+
+    def test_forgot_queries(self):
+        # Ensure the form and the view share one user lookup, then the
+        # token and the email are inserted.
+        with self.queries(3):
+            self.client.post('/forgot', data=dict(email='test@user.com'))
+
+    def test_forgot_new_queries(self):
+        # Ensure resetting a password looks the user up once.
+        self.client.post('/forgot', data=dict(email='test@user.com'))
+        token = sent_reset_token()
+        with self.queries(3):
+            self.client.post('/forgot/new/' + token, data=dict(
+                password='just_a_test_user', confirm='just_a_test_user'
+            ))
+
+    def test_confirm_email_queries(self):
+        # Ensure the loader and the view share one user lookup.
+        with self.client:
+            self.login()
+            token = generate_confirmation_token('test@user.com')
+            with self.queries(2):
+                self.client.get('/confirm/' + token)
+
+    def test_profile_queries(self):
+        # Ensure the loader and the view share one user lookup.
+        user = User.query.filter_by(email='test@user.com').first()
+        user.confirmed = True
+        db.session.commit()
+        with self.client:
+            self.login()
+            with self.queries(2):
+                self.client.post('/profile', data=dict(
+                    password='just_a_test_user', confirm='just_a_test_user'
+                ))
+
+
 if __name__ == '__main__':
     unittest.main()
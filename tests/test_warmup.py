@@ -0,0 +1,46 @@
+# tests/test_warmup.py
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from project import create_app
+from project.warmup import set_bytecode_cache, warm_up
+
+
+class TestWarmUp(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app('project.config.TestingConfig')
+        self.app.config['JINJA_BYTECODE_CACHE_DIR'] = self.directory
+        set_bytecode_cache(self.app)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_templates_are_compiled(self):
+        # Ensure every template is compiled into the bytecode cache.
+        timings = warm_up(self.app)
+        self.assertTrue(set(timings) == set(['templates', 'urls', 'db', 'token']))
+        templates = self.app.jinja_loader.list_templates()
+        self.assertTrue('user/login.html' in templates)
+        self.assertTrue(len(os.listdir(self.directory)) == len(templates))
+
+    def test_bytecode_cache_is_shared(self):
+        # Ensure a later app loads the compiled templates from the cache.
+        warm_up(self.app)
+        app = create_app('project.config.TestingConfig')
+        app.config['JINJA_BYTECODE_CACHE_DIR'] = self.directory
+        set_bytecode_cache(app)
+        dumped = []
+        app.jinja_env.bytecode_cache.dump_bytecode = dumped.append
+        response = app.test_client().get('/login')
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(dumped == [])
+
+
+if __name__ == '__main__':
+    unittest.main()